@@ -46,10 +46,19 @@
 
 import calendar
 import sys
+import os
 import time
 import optparse
+import json
+import base64
+import shutil
+import tempfile
+import io
 import lib.xcairo as xcairo
 import lib.holiday as holiday
+import lib.holidaydb as holidaydb
+import lib.theme as theme
+import lib.cache as cache
 import lib
 
 from lib.plugin import *
@@ -169,12 +178,31 @@ def get_parser():
                     "-W or -H pixels; 'w' suffix swaps width & height [%default]")
     parser.add_option("--border", type="float", default=3,
                     help="set border size (in mm) [%default]")
+    parser.add_option("--png-colors", type="int", default=0,
+                    help="write indexed-colour (palette) PNG files using at most PNG_COLORS colours (2-256); "
+                    "colours are kept exact when possible, otherwise they are quantised; 0 writes 32-bit PNG [%default]")
+    parser.add_option("--png-max-error", type="float", default=3.0,
+                    help="maximum RMS colour error (0-255) allowed when quantising for --png-colors; "
+                    "if exceeded, a 32-bit PNG is written instead [%default]")
+    parser.add_option("--cache-dir", metavar="DIR",
+                    help="keep rendered files in cache directory DIR; a render with the same theme, holidays, "
+                    "options and version as a cached one reuses the cached files, leaving identical "
+                    "output files untouched (PDF files get a fixed creation date, see SOURCE_DATE_EPOCH)")
+    parser.add_option("--cache-size", type="float", default=256,
+                    help="maximum size (in MB) of the --cache-dir directory; least recently used renders "
+                    "are evicted [%default]")
     parser.add_option("-H", "--with-holidays", action="append", dest="holidays",
                     help="load holiday file (can be used multiple times)")
     parser.add_option("--short-monthnames", action="store_true", default=False,
                       help="user the short version of month names (defined in language file) [%default]")
     parser.add_option("--long-daynames", action="store_true", default=False,
                     help="user the long version of day names (defined in language file) [%default]")
+    parser.add_option("--holiday-cache", metavar="DIR",
+                    help="keep holiday files in compiled form in directory DIR, so that unchanged files "
+                    "are loaded without parsing")
+    parser.add_option("--holiday-db", metavar="FILE",
+                    help="import holiday files into SQLite database FILE and query fixed date holidays "
+                    "from it one month range at a time; files already imported are loaded without parsing")
     parser.add_option("-T", "--terse-holidays", action="store_false", dest="multiday_holidays",
                     default=True, help="do not print holiday end markers and omit dots")
 
@@ -187,14 +215,66 @@ def get_parser():
                     help="modify a style variable, e.g. dom.frame_thickness=0")
     parser.add_option("--geom-var", action="append", dest="geom_assign",
                     help="modify a geometry variable")
+    parser.add_option("--worker", action="store_true", default=False,
+                    help="run as a persistent worker: read JSON-lines render requests from standard input "
+                    "and write a JSON-lines result for each one to standard output; plugins, holiday files "
+                    "and fonts stay loaded between requests")
     return parser
 
 
-def main_program():
+def load_plugins(options):
+    """import the language, style, geometry and layout plugins selected in I{options}
+
+    @rtype: (module,module,module,module)
+    @return: tuple (Language,Style,Geometry,Layout)
+    """
+    plugin_paths = get_plugin_paths()
+    Language = import_plugin(plugin_paths, "lang", "language", "languages", "--list-languages", options.lang)
+    Style = import_plugin(plugin_paths, "style", "style", "styles", "--list-styles", options.style)
+    Geometry = import_plugin(plugin_paths, "geom", "geometry", "geometries", "--list-geometries", options.geom)
+    Layout = import_plugin(plugin_paths, "layouts", "layout", "layouts", "--list-layouts", options.layout)
+    return (Language, Style, Geometry, Layout)
+
+_providers = None
+"""holiday providers kept loaded in worker mode (see L{run_worker}), indexed by
+(style, holiday files, holiday database, multi-day markers); C{None} when not in worker mode"""
+
+def get_holiday_provider(S, options):
+    """return a holiday provider for compiled style I{S} with the holiday files requested in I{options} loaded
+
+    In worker mode, providers are kept in L{_providers} and reused, as long as the
+    holiday files do not change.
+
+    @rtype: holiday.HolidayProvider
+    """
+    files = tuple((f, os.path.getmtime(f) if os.path.exists(f) else None) for f in options.holidays or [])
+    styles = (S.dom, S.dom_weekend, S.dom_holiday, S.dom_weekend_holiday, S.dom_multi, S.dom_weekend_multi)
+    key = (styles, files, options.holiday_db, options.multiday_holidays)
+    if _providers is not None and key in _providers:
+        return _providers[key]
+    if options.holiday_db:
+        hprovider = holidaydb.SQLiteHolidayProvider(options.holiday_db, *(styles + (options.multiday_holidays,)))
+    else:
+        hprovider = holiday.HolidayProvider(*(styles + (options.multiday_holidays,)))
+
+    if options.holidays:
+        for f in options.holidays:
+            hprovider.load_holiday_file(f, options.holiday_cache)
+    if _providers is not None:
+        _providers[key] = hprovider
+    return hprovider
+
+def main_program(argv = None):
+    """parse the command line I{argv} (C{sys.argv} by default) and render the requested calendar
+
+    @rtype: [str,...]
+    @return: list of files written, or C{None} if nothing was rendered
+    """
     parser = get_parser()
 
-    sys.argv,argv2 = lib.extract_parser_args(sys.argv,parser)
-    (options,args) = parser.parse_args()
+    if argv is None: argv = sys.argv
+    argv,argv2 = lib.extract_parser_args(argv,parser)
+    (options,args) = parser.parse_args(argv[1:])
 
     list_and_exit = False
     if options.list_languages:
@@ -215,11 +295,13 @@ def main_program():
         list_and_exit = True
     if list_and_exit: return
 
-    plugin_paths = get_plugin_paths()
-    Language = import_plugin(plugin_paths, "lang", "language", "languages", "--list-languages", options.lang)
-    Style = import_plugin(plugin_paths, "style", "style", "styles", "--list-styles", options.style)
-    Geometry = import_plugin(plugin_paths, "geom", "geometry", "geometries", "--list-geometries", options.geom)
-    Layout = import_plugin(plugin_paths, "layouts", "layout", "layouts", "--list-layouts", options.layout)
+    if options.worker:
+        if _providers is not None:
+            raise lib.Abort("callirhoe: --worker is not allowed in worker requests")
+        run_worker()
+        return
+
+    Language, Style, Geometry, Layout = load_plugins(options)
 
     for x in argv2:
         if '=' in x: x = x[0:x.find('=')]
@@ -279,14 +361,18 @@ def main_program():
     xcairo.XDPI = options.dpi
     Geometry.pagespec = options.paper
     Geometry.border = options.border
-
-    hprovider = holiday.HolidayProvider(Style.dom, Style.dom_weekend,
-                                 Style.dom_holiday, Style.dom_weekend_holiday,
-                                 Style.dom_multi, Style.dom_weekend_multi, options.multiday_holidays)
-
-    if options.holidays:
-        for f in options.holidays:
-            hprovider.load_holiday_file(f)
+    if options.png_colors != 0 and not 2 <= options.png_colors <= 256:
+        raise lib.Abort("callirhoe: --png-colors should be 0 or between 2 and 256")
+    Geometry.png_colors = options.png_colors
+    Geometry.png_max_error = options.png_max_error
+    if options.cache_dir or 'SOURCE_DATE_EPOCH' in os.environ:
+        epoch = os.environ.get('SOURCE_DATE_EPOCH', '0')
+        try:
+            Geometry.pdf_date = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(int(epoch)))
+        except (ValueError, OverflowError, OSError):
+            raise lib.Abort("callirhoe: invalid SOURCE_DATE_EPOCH '%s', should be a number of seconds since 1970-01-01" % epoch)
+    else:
+        Geometry.pdf_date = None
 
     if options.long_daynames:
         Language.day_name = Language.long_day_name
@@ -298,9 +384,170 @@ def main_program():
     else:
         Language.month_name = Language.long_month_name
 
-    renderer = Layout.CalendarRenderer(Outfile, Year, Month, MonthSpan,
-                                        (Style,Geometry,Language), hprovider, lib._version, loptions)
-    renderer.render()
+    Theme = theme.compile_theme(Style, Geometry, Language, options.dpi)
+    hprovider = get_holiday_provider(Theme[0], options)
+
+    if not options.cache_dir:
+        renderer = Layout.CalendarRenderer(Outfile, Year, Month, MonthSpan,
+                                            Theme, hprovider, lib._version, loptions)
+        return renderer.render()
+
+    key = cache.render_key(lib._version, xcairo.cairo_version(), Layout.__name__,
+                           sorted(vars(loptions).items()), Theme, options.dpi,
+                           cache.holidays_in_range(hprovider, Year, Month, MonthSpan),
+                           Year, Month, MonthSpan, os.path.splitext(Outfile)[1].lower())
+    rcache = cache.RenderCache(options.cache_dir, int(options.cache_size*2**20))
+    base = os.path.splitext(Outfile)[0]
+    files = rcache.lookup(key)
+    if files is not None:
+        try:
+            return cache.install(files, base)
+        except OSError:
+            pass # evicted meanwhile by another process, render it again
+    # render next to the output, so that existing outputs are replaced atomically
+    tmpdir = tempfile.mkdtemp(dir = os.path.dirname(Outfile) or '.')
+    try:
+        tmpfile = os.path.join(tmpdir, os.path.basename(Outfile))
+        renderer = Layout.CalendarRenderer(tmpfile, Year, Month, MonthSpan,
+                                            Theme, hprovider, lib._version, loptions)
+        files = rcache.store(key, os.path.splitext(tmpfile)[0], renderer.render())
+        return cache.install(files, base)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors = True)
+
+def _worker_prepare(argv):
+    """load plugins, holiday files and fonts needed by a worker request, in the worker process itself
+
+    Errors are ignored here; they are reported when the request is actually run.
+    """
+    stderr = sys.stderr
+    sys.stderr = io.StringIO()
+    try:
+        parser = get_parser()
+        argv,argv2 = lib.extract_parser_args(argv,parser)
+        (options,args) = parser.parse_args(argv[1:])
+        Language, Style, Geometry, Layout = load_plugins(options)
+        get_holiday_provider(theme.compile_module(Style, options.dpi), options)
+        if Style.__name__ not in _fonts:
+            xcairo.preload_fonts([getattr(c, a) for c in vars(Style).values() if isinstance(c, type)
+                                  for a in ('font', 'header_font', 'footer_font') if hasattr(c, a)])
+            _fonts.add(Style.__name__)
+    except (Exception, SystemExit):
+        pass
+    finally:
+        sys.stderr = stderr
+
+_fonts = set()
+"""styles whose fonts have been preloaded by L{_worker_prepare}"""
+
+_worker_formats = ('pdf', 'png')
+"""output formats of inline worker requests"""
+
+def _worker_request(req):
+    """run a single worker request and return the result object
+
+    @rtype: dict
+    """
+    result = { 'id': req.get('id') }
+    tmpdir = None
+    stdout = sys.stdout
+    # anything printed while rendering must not mix with the results
+    sys.stdout = sys.stderr
+    try:
+        args = req.get('args', [])
+        if not isinstance(args, list) or not all(isinstance(a, str) for a in args):
+            raise lib.Abort("callirhoe: request 'args' should be a list of strings")
+        if req.get('inline'):
+            fmt = req.get('format', 'pdf')
+            if fmt not in _worker_formats:
+                raise lib.Abort("callirhoe: invalid request 'format' %s, should be one of %s" %
+                                (json.dumps(fmt), ', '.join(_worker_formats)))
+            tmpdir = tempfile.mkdtemp(prefix='callirhoe')
+            outfile = os.path.join(tmpdir, 'calendar.' + fmt)
+        elif 'output' in req:
+            outfile = req['output']
+        else:
+            raise lib.Abort("callirhoe: request has neither 'output' nor 'inline'")
+        files = main_program(['callirhoe'] + args + [outfile])
+        if not files:
+            raise lib.Abort("callirhoe: nothing rendered")
+        if tmpdir:
+            data = []
+            for f in files:
+                with open(f, 'rb') as fp:
+                    data.append(base64.b64encode(fp.read()).decode('ascii'))
+            result['data'] = data
+        else:
+            result['files'] = files
+        result['ok'] = True
+    except lib.Abort as e:
+        result.update(ok = False, error = str(e.args[0]))
+    except SystemExit as e:
+        result.update(ok = False, error = "exit status %s" % e.code if isinstance(e.code, int) or e.code is None else str(e.code))
+    except Exception as e:
+        result.update(ok = False, error = "%s: %s" % (type(e).__name__, e))
+    finally:
+        sys.stdout = stdout
+        if tmpdir: shutil.rmtree(tmpdir, ignore_errors=True)
+    return result
+
+def run_worker(fin = None, fout = None):
+    """serve JSON-lines render requests until end of input
+
+    Each input line is a JSON object of the form::
+
+        {"id": 1, "args": ["-s", "rainbow", "1", "2021"], "output": "jan.pdf"}
+        {"id": 2, "args": ["--paper=-800:-600", "1", "2021"], "inline": true, "format": "png"}
+
+    where C{args} are ordinary callirhoe arguments (without the output file). Results are
+    written one per line, in request order, as C{{"id": ..., "ok": true, "files": [...]}} or,
+    for inline requests, C{{"id": ..., "ok": true, "data": [base64,...]}}, one item per output
+    file; failures give C{{"id": ..., "ok": false, "error": "..."}}.
+
+    Plugins, holiday files and fonts are loaded once by the worker process. Where C{os.fork()}
+    is available, every request is then rendered in a forked child, so that option and
+    C{--style-var} side effects on the loaded plugins do not carry over to later requests.
+    """
+    global _providers
+    if fin is None: fin = sys.stdin
+    if fout is None: fout = sys.stdout
+    _providers = dict()
+    for line in fin:
+        line = line.strip()
+        if not line: continue
+        try:
+            req = json.loads(line)
+            if not isinstance(req, dict): raise ValueError("request is not an object")
+        except ValueError as e:
+            fout.write(json.dumps({ 'id': None, 'ok': False, 'error': "invalid request: %s" % e }) + '\n')
+            fout.flush()
+            continue
+        if hasattr(os, 'fork'):
+            if isinstance(req.get('args', []), list):
+                _worker_prepare(['callirhoe'] + req.get('args', []) + ['x.pdf'])
+            fout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                # the child must always answer, or the parent would take the next reply for this one
+                status = 1
+                try:
+                    try:
+                        result = _worker_request(req)
+                    except BaseException as e:
+                        result = { 'id': req.get('id'), 'ok': False, 'error': "%s: %s" % (type(e).__name__, e) }
+                    fout.write(json.dumps(result) + '\n')
+                    fout.flush()
+                    status = 0
+                finally:
+                    os._exit(status)
+            status = os.waitpid(pid, 0)[1]
+            if status != 0:
+                fout.write(json.dumps({ 'id': req.get('id'), 'ok': False,
+                                        'error': "worker process failed (status %d)" % status }) + '\n')
+        else:
+            fout.write(json.dumps(_worker_request(req)) + '\n')
+        fout.flush()
 
 
 if __name__ == "__main__":
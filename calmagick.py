@@ -33,9 +33,26 @@ import random
 import optparse
 import queue
 import threading
+import concurrent.futures
+import re
+import time
+import shutil
+import hashlib
+from array import array
+from itertools import accumulate
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    from PIL import Image, ImageFilter
+except ImportError:
+    Image = None
 
 import lib
 from lib.geom import rect_rel_scale
+from lib.pipeline import Stage, Pipeline
+from lib.cache import render_key, ValueCache, RenderCache, install
 
 # MAYBE-TODO
 # move to python 3?
@@ -68,70 +85,138 @@ def _bound(x, lower, upper):
     if x > upper: return upper
     return x
 
+_PNM_TOKEN = re.compile(br'(?:\s|#[^\r\n]*[\r\n])*([^\s#]+)')
+"""PNM header token, possibly preceded by whitespace and comments"""
+
 class PNMImage(object):
-    """class to represent an PNM grayscale image given in P2 format
+    """class to represent an PNM grayscale image given in P5 (binary) or P2 (plain) format
 
-    @ivar data: image data as 2-dimensional array (list of lists)
+    @ivar data: image data as 2-dimensional numpy array, or, if numpy is not available,
+    as flat C{array} in row-major order
     @ivar size: tuple M{(width,height)} of image dimensions
     @ivar maxval: maximum grayscale value
-    @ivar _rsum_cache: used by L{_rsum()} to remember results
-    @ivar xsum: 2-dimensional array of running x-sums for each line, used for efficient
-    computation of block averages, resulting in M{O(H)} complexity, instead of M{O(W*H)},
-    where M{W,H} the image dimensions
-    """
-    def __init__(self, strlist):
-        self.data = [];
-        state = 0;
-        for i in range(len(strlist)):
-            # skip comments
-            if strlist[i].startswith(b'#'): continue
-            # skip empty lines
-            if len(strlist[i]) == 0: continue
-            # parse header
-            if state == 0:
-                if not strlist[i].startswith(b'P2'):
-                    raise RuntimeError('invalid PNM image format: %s' % strlist[i])
-                state += 1
-            # parse size
-            elif state == 1:
-                w,h = list(map(int,strlist[i].split()))
-                if w != h:
-                    raise RuntimeError('non-square PNM image')
-                self.size = (w,h)
-                state += 1
-            # parse max value
-            elif state == 2:
-                self.maxval = int(strlist[i])
-                state += 1
-            # bitmap
+    @ivar sat: summed-area table of size M{(W+1)*(H+1)}, where M{W,H} the image dimensions;
+    M{sat[y][x]} is the sum of all pixels above and left of M{(x,y)}, so that any block sum is
+    computed in M{O(1)}; a 2-dimensional numpy array, or, if numpy is not available, a flat
+    C{array} in row-major order
+    """
+    def __init__(self, data):
+        tokens = []
+        pos = 0
+        while len(tokens) < 4:
+            m = _PNM_TOKEN.match(data, pos)
+            if m is None:
+                raise RuntimeError('invalid PNM image header')
+            tokens.append(m.group(1))
+            pos = m.end()
+        if tokens[0] not in (b'P5', b'P2'):
+            raise RuntimeError('invalid PNM image format: %s' % tokens[0])
+        w,h,self.maxval = list(map(int,tokens[1:]))
+        if w != h:
+            raise RuntimeError('non-square PNM image')
+        self.size = (w,h)
+        pos += 1 # single whitespace before raster
+        n = w*h
+        if tokens[0] == b'P2':
+            values = list(map(int,data[pos:].split()[:n]))
+        else:
+            wide = self.maxval > 255
+            if len(data) < pos + n*(1 + wide):
+                raise RuntimeError('truncated PNM image')
+        if numpy is not None:
+            if tokens[0] == b'P2':
+                self._set_data(numpy.array(values, dtype=numpy.int64).reshape(h,w))
             else:
-                data = ' '.join([s.decode('utf-8') for s in strlist[i:] if not s.startswith(b'#')])
-                intlist = list(map(int,data.split()))
-                self.data = [intlist[x:x+w] for x in range(0, len(intlist), w)]
-                break
-
-        self._rsum_cache=(-1,-1,0) # y,x,s
-#        self.xsum = [map(lambda x: sum(self.data[y][0:x]), range(w+1)) for y in range(0,h)]
-        self.xsum = [[self._rsum(y,x) for x in range(w+1)] for y in range(0,h)]
-
-    def _rsum(self,y,x):
-        """running sum with cache
-
-        @rtype: int
-        """
-        if self._rsum_cache[0] == y and self._rsum_cache[1] == x:
-            s = self._rsum_cache[2] + self.data[y][x-1]
+                self._set_data(numpy.frombuffer(data, dtype='>u2' if wide else 'u1', count=n, offset=pos).reshape(h,w))
         else:
-            s = sum(self.data[y][0:x])
-        self._rsum_cache = (y,x+1,s)
-        return s
+            if tokens[0] == b'P2':
+                self.data = array('l', values)
+            else:
+                self.data = array('H' if wide else 'B', data[pos:pos + n*(1 + wide)])
+                if wide and sys.byteorder == 'little': self.data.byteswap()
+            self.sat = array('q', bytes(8*(w+1)))
+            for y in range(h):
+                row = accumulate(self.data[y*w:(y+1)*w], initial=0)
+                self.sat.extend(s + a for s, a in zip(row, self.sat[y*(w+1):(y+1)*(w+1)]))
+
+    def _set_data(self, data):
+        """set image data from 2-dimensional numpy array I{data} and compute L{sat}"""
+        h,w = data.shape
+        self.data = data
+        self.sat = numpy.zeros((h+1,w+1), dtype=numpy.int64)
+        numpy.cumsum(numpy.cumsum(data, axis=0, dtype=numpy.int64), axis=1, out=self.sat[1:,1:])
+
+    def scaled(self, q):
+        """returns the image scaled down to M{(q,q)} pixels, averaging blocks with L{sat}
+        and stretching the result to the full intensity range (as C{-normalize} does)
+
+        @rtype: PNMImage
+        @note: requires numpy
+        """
+        n = self.size[0]
+        b = numpy.array([(i*n + q//2)//q for i in range(q+1)])
+        s = self.sat[numpy.ix_(b,b)]
+        d = numpy.diff(b)
+        avg = (s[1:,1:] - s[:-1,1:] - s[1:,:-1] + s[:-1,:-1])/numpy.outer(d,d).astype(float)
+        lo, hi = avg.min(), avg.max()
+        if hi > lo: avg = (avg - lo)*(self.maxval/(hi - lo))
+        return PNMImage.from_array(numpy.rint(avg).astype(numpy.int64), self.maxval)
+
+    @staticmethod
+    def from_array(data, maxval):
+        """returns an image with data from square 2-dimensional numpy array I{data}
+
+        @rtype: PNMImage
+        """
+        if data.shape[0] != data.shape[1]:
+            raise RuntimeError('non-square PNM image')
+        img = PNMImage.__new__(PNMImage)
+        img.size = (data.shape[1],data.shape[0])
+        img.maxval = maxval
+        img._set_data(data)
+        return img
 
     def block_avg(self, x, y, szx, szy):
         """returns the average intensity of a block of size M{(szx,szy)} at pos (top-left) M{(x,y)}
 
         @rtype: float
         """
-        return float(sum([(self.xsum[y][x+szx] - self.xsum[y][x]) for y in range(y,y+szy)]))/(szx*szy)
+        if numpy is not None:
+            s = self.sat
+            return float(s[y+szy,x+szx] - s[y,x+szx] - s[y+szy,x] + s[y,x])/(szx*szy)
+        s, stride = self.sat, self.size[0] + 1
+        k1, k2 = y*stride + x, (y+szy)*stride + x
+        return float(s[k2+szx] - s[k1+szx] - s[k2] + s[k1])/(szx*szy)
+
+    def block_avgs(self, szx, szy, window = None):
+        """returns the average intensities of all blocks of size M{(szx,szy)}, computed at once
+
+        @param window: tuple M{(x0,y0,x1,y1)}, to compute only blocks at positions
+        M{x0 <= x <= x1, y0 <= y <= y1}
+        @rtype: numpy.ndarray
+        @return: 2-dimensional array, indexed by block position M{(y-y0,x-x0)}
+        @note: requires numpy
+        """
+        w,h = self.size
+        x0,y0,x1,y1 = window if window else (0,0,w-szx,h-szy)
+        s = self.sat
+        return (s[y0+szy:y1+szy+1,x0+szx:x1+szx+1] - s[y0:y1+1,x0+szx:x1+szx+1] -
+                s[y0+szy:y1+szy+1,x0:x1+1] + s[y0:y1+1,x0:x1+1])/float(szx*szy)
+
+    def _best_blocks(self, sz, windows, k):
+        """returns the I{k} blocks of size I{sz} with the lowest intensity, within I{windows}
+        (see L{block_avgs}), ordered by intensity and then by position in row-major order
+
+        @rtype: [(float,int,int),...]
+        @return: list of tuples M{(avg,x,y)}
+        """
+        found = set()
+        for x0,y0,x1,y1 in windows:
+            avg = self.block_avgs(sz[0], sz[1], (x0,y0,x1,y1))
+            for i in numpy.argsort(avg, axis=None, kind='stable')[:k]:
+                y,x = divmod(int(i), avg.shape[1])
+                found.add((float(avg.flat[i]), y0 + y, x0 + x))
+        return [(a,x,y) for a,y,x in sorted(found)[:k]]
 
     def lowest_block_avg(self, szx, szy, at_least = 0):
         """returns the M{(szx,szy)}-sized block with intensity as close to M{at_least} as possible
@@ -142,6 +227,16 @@ class PNMImage(object):
         """
         w,h = self.size
         best = (self.maxval,(1,1),(0,0),(szx,szy)) # avg, (szx_ratio,szy_ratio), (x,y), (szx,szy)
+        if numpy is not None:
+            # same result as the scan below: first block (in row-major order) at or below
+            # at_least, otherwise first block of minimal intensity
+            avg = self.block_avgs(szx, szy)
+            if avg.size == 0: return best
+            hits = numpy.flatnonzero((avg <= at_least) & (avg < best[0]))
+            k = hits[0] if len(hits) else avg.argmin()
+            if not avg.flat[k] < best[0]: return best
+            y,x = divmod(int(k), avg.shape[1])
+            return (float(avg.flat[k]), (float(szx)/w,float(szy)/h), (x,y), (szx,szy))
         for y in range(0,h-szy+1):
             for x in range(0,w-szx+1):
                 cur = (self.block_avg(x,y,szx,szy), (float(szx)/w,float(szy)/h), (x,y), (szx,szy))
@@ -168,16 +263,7 @@ class PNMImage(object):
 
         @rtype: (float,(float,float),(int,int),(int,int),float)
         """
-        w,h = self.size
-        sz_lo = _bound(int(w*size_range[0]+0.5),1,w)
-        sz_hi = _bound(int(w*size_range[1]+0.5),1,w)
-        szv_range = list(range(sz_lo, sz_hi+1))
-        if rr == 1:
-            sz_range = list(zip(szv_range, szv_range))
-        elif rr > 1:
-            sz_range = list(zip(szv_range, [_bound(int(x/rr+0.5),1,w) for x in szv_range]))
-        else:
-            sz_range = list(zip([_bound(int(x*rr+0.5),1,w) for x in szv_range], szv_range))
+        sz_range = _block_sizes(self.size[0], size_range, rr)
         best = self.lowest_block_avg(*sz_range[0])
         # we do not use at_least because non-global minimum, when relaxed, may jump well above threshold
         entropy_thres = max(at_least, best[0]*(1+relax))
@@ -187,6 +273,139 @@ class PNMImage(object):
             if cur[0] <= entropy_thres: return cur + (best[0],)
         return best + (best[0],) # avg, (szx_ratio,szy_ratio), (x,y), (szx,szy), best_avg
 
+    def fit_rect_pyramid(self, quantum, size_range = (0.333, 0.8), at_least = 7, relax = 0.2, rr = 1.0,
+                         candidates = 4):
+        """coarse-to-fine variant of L{fit_rect}
+
+        The rectangle is first fitted (by L{fit_rect}) on the image scaled down to M{(quantum,quantum)}
+        pixels. Then, at doubling resolutions up to the full image size, only sizes and positions within
+        one pixel (of the previous resolution) from the I{candidates} best blocks of the previous
+        resolution are searched, choosing the size as L{fit_rect} does.
+
+        @param candidates: number of blocks refined at each resolution
+        @rtype: (float,(float,float),(int,int),(int,int),float)
+        @note: requires numpy
+        """
+        n = self.size[0]
+        if quantum >= n: return self.fit_rect(size_range, at_least, relax, rr)
+        img = self.scaled(quantum)
+        best = img.fit_rect(size_range, at_least, relax, rr)
+        sz = best[3]
+        blocks = img._best_blocks(sz, [(0, 0, quantum - sz[0], quantum - sz[1])], candidates)
+        q = quantum
+        k = 0 if rr >= 1 else 1 # 'best-fit' dimension
+        while q < n:
+            q2 = min(2*q, n)
+            img = self.scaled(q2) if q2 < n else self
+            f = float(q2)/q
+            sizes = [z for z in _block_sizes(q2, size_range, rr)
+                     if (sz[k] - 1)*f <= z[k] <= (sz[k] + 1)*f] or _block_sizes(q2, size_range, rr)
+            def windows(z):
+                result = []
+                for a,x,y in blocks:
+                    x1, y1 = min(q2 - z[0], int((x + 1)*f + 0.999)), min(q2 - z[1], int((y + 1)*f + 0.999))
+                    result.append((min(x1, max(0, int((x - 1)*f))), min(y1, max(0, int((y - 1)*f))), x1, y1))
+                return result
+            smallest = img._best_blocks(sizes[0], windows(sizes[0]), candidates)
+            entropy_thres = max(at_least, smallest[0][0]*(1+relax))
+            for z in reversed(sizes):
+                cur = img._best_blocks(z, windows(z), candidates) if z != sizes[0] else smallest
+                if cur[0][0] <= entropy_thres: break
+            sz, blocks, q = z, cur, q2
+        a,x,y = blocks[0]
+        return (a, (float(sz[0])/n,float(sz[1])/n), (x,y), sz, smallest[0][0])
+
+
+def _lab_lightness(rgb):
+    """returns the Lab lightness (scaled to [0,1]) of sRGB data I{rgb} (in [0,1])
+
+    @rtype: numpy.ndarray
+    """
+    lin = numpy.where(rgb <= 0.04045, rgb/12.92, ((rgb + 0.055)/1.055)**2.4)
+    y = lin[...,0]*0.2126 + lin[...,1]*0.7152 + lin[...,2]*0.0722
+    f = numpy.where(y > 216.0/24389, numpy.cbrt(y), (24389.0/27*y + 16)/116)
+    return (116*f - 16)/100
+
+def _normalize(a):
+    """stretch array I{a} to [0,1], clipping the darkest 2% and the brightest 1%, as
+    ImageMagick C{-normalize} does
+
+    @rtype: numpy.ndarray
+    """
+    lo, hi = numpy.percentile(a, (2, 99))
+    if hi <= lo: return numpy.zeros_like(a)
+    return numpy.clip((a - lo)/(hi - lo), 0, 1)
+
+class PILAnalysis(object):
+    """in-process photo analysis using Pillow and numpy, as an alternative to ImageMagick
+
+    The photo is decoded once, scaled to at most 262144 pixels (as C{_IM_entropy_head});
+    the entropy map and region luminance are computed from this buffer.
+
+    @ivar size: tuple M{(width,height)} of photo dimensions
+    @ivar image: scaled photo (C{PIL.Image} in RGB mode)
+    @ivar lum: Lab lightness of L{image}, as 2-dimensional numpy array in [0,1]
+    """
+    def __init__(self, img):
+        im = Image.open(img)
+        self.size = w,h = im.size
+        f = min(1.0, (262144.0/(w*h))**0.5)
+        sz = (max(1,int(w*f)), max(1,int(h*f)))
+        im.draft('RGB', sz) # JPEG: decode at reduced scale
+        im = im.convert('RGB')
+        if im.size != sz: im = im.resize(sz, Image.BOX)
+        self.image = im
+        self.lum = _lab_lightness(numpy.asarray(im, dtype=float)/255)
+
+    def entropy_map(self, quantum, alt = False, negate = False):
+        """compute the entropy map quantized to M{(quantum,quantum)}, as C{_IM_entropy_args()}
+
+        @rtype: PNMImage
+        """
+        rgb = numpy.asarray(self.image, dtype=float)/255
+        if alt:
+            blur = numpy.asarray(self.image.filter(ImageFilter.GaussianBlur(2)), dtype=float)/255
+            e = numpy.abs(rgb - blur)
+        else:
+            # Sobel kernel rotated by 90 degrees, lighten composition: max(|gx|,|gy|), kernel scaled to 1
+            p = numpy.pad(rgb, ((1,1),(1,1),(0,0)), mode='edge')
+            gx = (p[:-2,2:] + 2*p[1:-1,2:] + p[2:,2:]) - (p[:-2,:-2] + 2*p[1:-1,:-2] + p[2:,:-2])
+            gy = (p[2:,:-2] + 2*p[2:,1:-1] + p[2:,2:]) - (p[:-2,:-2] + 2*p[:-2,1:-1] + p[:-2,2:])
+            e = numpy.maximum(numpy.abs(gx), numpy.abs(gy))/4
+        e = _normalize(_lab_lightness(numpy.clip(e, 0, 1)))
+        e = numpy.asarray(Image.fromarray(e.astype(numpy.float32), 'F').resize((quantum,quantum), Image.BOX))
+        e = _normalize(e)
+        if negate: e = 1 - e
+        return PNMImage.from_array(numpy.rint(e*255).astype(numpy.int64), 255)
+
+    def luminance(self, geometry):
+        """get average luminance of region I{geometry} as a float in [0,255], as L{_IM_get_image_luminance}
+
+        @param geometry: IM geometry tuple(I{width,height,x,y}) in photo coordinates
+        @rtype: float
+        """
+        w,h = self.size
+        sh,sw = self.lum.shape
+        x0, y0 = int(geometry[2]*sw/w), int(geometry[3]*sh/h)
+        x1 = max(x0 + 1, int((geometry[2] + geometry[0])*sw/w + 0.5))
+        y1 = max(y0 + 1, int((geometry[3] + geometry[1])*sh/h + 0.5))
+        return 255.0*float(self.lum[y0:y1,x0:x1].mean())
+
+def _block_sizes(w, size_range, rr):
+    """returns the block sizes searched by L{PNMImage.fit_rect} in a M{(w,w)} image
+
+    @rtype: [(int,int),...]
+    @return: list of M{(szx,szy)} tuples, in increasing size
+    """
+    sz_lo = _bound(int(w*size_range[0]+0.5),1,w)
+    sz_hi = _bound(int(w*size_range[1]+0.5),1,w)
+    szv_range = list(range(sz_lo, sz_hi+1))
+    if rr == 1:
+        return list(zip(szv_range, szv_range))
+    elif rr > 1:
+        return list(zip(szv_range, [_bound(int(x/rr+0.5),1,w) for x in szv_range]))
+    else:
+        return list(zip([_bound(int(x*rr+0.5),1,w) for x in szv_range], szv_range))
 
 def get_parser():
     """get the argument parser object
@@ -211,6 +430,12 @@ months are requested.""", version="callirhoe.CalMagick " + lib._version + '\n' +
                     "'auto' adds YEAR_MONTH_ prefix only when input photos are randomized or more months than photos are requested; 'yes' will always add prefix [%default]")
     parser.add_option("--quantum", type="int", default=60,
                     help="choose quantization level for entropy computation [%default]")
+    parser.add_option("--fine-quantum", type="int", default=0,
+                    help="for min/max placement: compute entropy at this (higher) quantization level and refine the "
+                    "placement found at QUANTUM, doubling the level at each step, up to FINE_QUANTUM; requires numpy; "
+                    "0 disables refinement [%default]")
+    parser.add_option("--candidates", type="int", default=4,
+                    help="number of best placements refined at each level of --fine-quantum [%default]")
     parser.add_option("--placement", type="choice", choices="min max N S W E NW NE SW SE center random".split(),
                     default="min", help="choose placement algorithm among {min, max, "
                     "N, S, W, E, NW, NE, SW, SE, center, random} [%default]")
@@ -241,6 +466,17 @@ months are requested.""", version="callirhoe.CalMagick " + lib._version + '\n' +
     parser.add_option("--alt",  action="store_true", default=False,
                     help="use an alternate entropy computation algorithm; although for most cases it should be no better than the default one, "
                     "for some cases it might produce better results (yet to be verified)")
+    parser.add_option("--backend", type="choice", choices=['magick','pil'], default='magick',
+                    help="image analysis backend among {magick, pil}: 'magick' runs ImageMagick for image size, entropy "
+                    "and luminance; 'pil' decodes each photo once in-process and computes them with Pillow and numpy, "
+                    "using ImageMagick only for the final composition (and for photos with --pre-magick arguments) [%default]")
+    parser.add_option("--placement-cache", default=None, metavar="DIR",
+                    help="keep computed photo placements (rectangle and luminance) in directory DIR, so that they are "
+                    "reused by later runs with the same photo and placement options; DIR may be shared by "
+                    "concurrent runs and hosts")
+    parser.add_option("--hash-photos", action="store_true", default=False,
+                    help="identify photos in the placement cache by their contents, instead of their path and "
+                    "modification time")
     parser.add_option("-v", "--verbose",  action="store_true", default=False,
                     help="print progress messages")
 
@@ -260,6 +496,30 @@ photos.""")
     cal.add_option('-j', "--jobs", type="int", default=1,
                     help="set parallel job count (total number of threads) for the --range iteration; although python "
                     "threads are not true processes, they help running the external programs efficiently [%default]")
+    cal.add_option("--pool", type="choice", choices=['thread','process'], default='thread',
+                    help="with --jobs: 'thread' runs each job in one of JOBS threads; 'process' additionally computes "
+                    "photo placement (entropy and luminance), which is CPU-bound, in a pool of JOBS worker processes, "
+                    "while the threads run callirhoe and the final composition [%default]")
+    cal.add_option("--pipeline", action="store_true", default=False,
+                    help="for --range: run jobs as a pipeline of stages (analyse, render, composite, write), each with its "
+                    "own worker threads and a bounded queue in front of it, so that stages overlap across photos; "
+                    "stage utilisation is reported at the end")
+    cal.add_option("--stage-jobs", default=None, metavar="A,R,C,W",
+                    help="with --pipeline: number of worker threads of the analyse, render, composite and write stages "
+                    "[JOBS,JOBS,JOBS,1]")
+    cal.add_option("--queue-size", type="int", default=4,
+                    help="with --pipeline: capacity of the queue in front of each stage [%default]")
+    cal.add_option("--force", action="store_true", default=False,
+                    help="rebuild all output images; by default, an output is skipped if it was written by an earlier "
+                    "run from the same photo, options and callirhoe arguments, as recorded in a hidden sidecar file "
+                    "next to it")
+    cal.add_option("--overlay-cache", default=None, metavar="DIR",
+                    help="keep calendar images rendered by callirhoe in directory DIR, so that jobs (of this or later "
+                    "runs) needing a calendar of the same style, size, month and arguments reuse it instead of running "
+                    "callirhoe")
+    cal.add_option("--overlay-cache-size", type="int", default=256, metavar="MB",
+                    help="maximum total size of cached calendar images, in MB; least recently used ones are "
+                    "removed first [%default]")
     cal.add_option("--sample", type="int", default=None,
                     help="choose SAMPLE random images from the input and use in round-robin fashion (see --range option); if "
                     "SAMPLE=0 then the sample size is chosen to as big as possible, either equal to the month span defined with --range, or "
@@ -314,6 +574,21 @@ def check_parsed_options(options):
     else:
         if options.prefix == 'auto': options.prefix = 'yes'
     if options.jobs < 1: options.jobs = 1
+    if options.candidates < 1: options.candidates = 1
+    if options.pipeline and options.test != 'none':
+        raise lib.Abort("calmagick: you cannot specify both --pipeline and --test options")
+    if options.stage_jobs:
+        try:
+            workers = [max(1, int(z)) for z in options.stage_jobs.split(',')]
+        except ValueError:
+            workers = []
+        if len(workers) != 4:
+            raise lib.Abort("calmagick: invalid --stage-jobs format '%s'" % options.stage_jobs)
+        options.stage_jobs = workers
+    else:
+        options.stage_jobs = [options.jobs]*3 + [1]
+    if options.backend == 'pil' and (Image is None or numpy is None):
+        raise lib.Abort("calmagick: --backend=pil requires Pillow and numpy")
 
 def parse_magick_args():
     """extract arguments from command-line that will be passed to ImageMagick
@@ -412,7 +687,7 @@ def _IM_entropy_args(alt=False):
     """
     return _IM_entropy_head + _IM_entropy_alg[alt] + _IM_entropy_tail
 
-def _entropy_placement(img, size, args, options, r):
+def _entropy_placement(img, size, args, options, r, analysis = None):
     """get rectangle of minimal/maximal entropy
 
     @param img: image file
@@ -420,6 +695,7 @@ def _entropy_placement(img, size, args, options, r):
     @param args: ImageMagick pre-processing argument list (see C{--pre-magick})
     @param options: (command-line) options object
     @param r: rectangle ratio, 0=match input ratio
+    @param analysis: L{PILAnalysis} object to compute entropy with, instead of ImageMagick
     @rtype: (int,int,int,int)
     @return: IM geometry tuple(I{width,height,x,y})
     """
@@ -428,13 +704,22 @@ def _entropy_placement(img, size, args, options, r):
     if r == 0: r = R
     if options.verbose:
         print("Calculating image entropy...")
-    qresize = '%dx%d!' % ((options.quantum,)*2)
-    pnm_entropy = PNMImage(subprocess.check_output([_prog_im, img] + args + _IM_entropy_args(options.alt) +
-    [qresize, '-normalize'] + (['-negate'] if options.placement == 'max' else []) + "-compress None pnm:-".split()).splitlines())
+    pyramid = numpy is not None and options.fine_quantum > options.quantum
+    quantum = options.fine_quantum if pyramid else options.quantum
+    qresize = '%dx%d!' % ((quantum,)*2)
+    if analysis is not None:
+        pnm_entropy = analysis.entropy_map(quantum, options.alt, options.placement == 'max')
+    else:
+        pnm_entropy = PNMImage(subprocess.check_output([_prog_im, img] + args + _IM_entropy_args(options.alt) +
+        [qresize, '-normalize'] + (['-negate'] if options.placement == 'max' else []) + "-depth 8 pgm:-".split()))
 
     # find optimal fit
     if options.verbose: print("Fitting... ", end=' ')
-    best = pnm_entropy.fit_rect((options.min_size,options.max_size), options.low_entropy, options.relax, r/R)
+    if pyramid:
+        best = pnm_entropy.fit_rect_pyramid(options.quantum, (options.min_size,options.max_size), options.low_entropy,
+                                            options.relax, r/R, options.candidates)
+    else:
+        best = pnm_entropy.fit_rect((options.min_size,options.max_size), options.low_entropy, options.relax, r/R)
     if options.verbose:
         print("ent=%0.2f frac=(%0.2f,%0.2f) pos=(%d,%d) bs=(%d,%d) min=%0.2f r=%0.2f" % (
             best[0], best[1][0], best[1][1], best[2][0], best[2][1], best[3][0], best[3][1], best[4], R*best[3][0]/best[3][1]))
@@ -482,6 +767,206 @@ _cache = dict() # {'filename': (geometry, is_dark)}
 _mutex = threading.Lock()
 """mutex for cache access"""
 
+def _file_hash(path):
+    """return the sha256 digest of the contents of file I{path}
+
+    @rtype: str
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def placement_key(img, options, magick_args):
+    """return the key of a photo placement in the persistent placement cache (C{--placement-cache})
+
+    The key depends on the identity of the photo file, which is its path, size and modification
+    time, or, with C{--hash-photos}, its size and contents, and on every option affecting placement.
+
+    @rtype: str
+    """
+    st = os.stat(img)
+    if options.hash_photos:
+        ident = (st.st_size, _file_hash(img))
+    else:
+        ident = (os.path.abspath(img), st.st_size, st.st_mtime_ns)
+    return render_key('placement', ident, options.quantum, options.fine_quantum, options.candidates,
+                      options.placement, options.min_size, options.max_size, options.ratio, options.alt,
+                      magick_args[0], options.low_entropy, options.relax, options.negative, options.backend)
+
+def load_placement(img, options, magick_args):
+    """look up a photo placement in the persistent placement cache
+
+    @rtype: ((int,int,int,int),bool)
+    @return: tuple (geometry, dark), or C{None} if not found or caching is disabled
+    """
+    if not options.placement_cache or options.placement == 'random': return None
+    value = ValueCache(options.placement_cache).get(placement_key(img, options, magick_args))
+    if value is None: return None
+    return (tuple(value[0]), value[1])
+
+def save_placement(img, options, magick_args, placement):
+    """store a photo placement (geometry, dark) in the persistent placement cache, if enabled"""
+    if not options.placement_cache or options.placement == 'random': return
+    ValueCache(options.placement_cache).put(placement_key(img, options, magick_args), list(placement))
+
+def output_key(img, options, callirhoe_args, magick_args):
+    """return the hash of everything an output image depends on: the photo and placement
+    options (see L{placement_key}), callirhoe arguments (and the identity of files among them,
+    e.g. holiday files), the current date where callirhoe defaults to it (see L{default_date}),
+    callirhoe and its plugins (see L{callirhoe_identity}) and composition options
+
+    @rtype: str
+    """
+    files = [(a, os.stat(a).st_size, os.stat(a).st_mtime_ns) for a in callirhoe_args if os.path.isfile(a)]
+    return render_key('output', lib._version, placement_key(img, options, magick_args), callirhoe_args, files,
+                      default_date(options), callirhoe_identity(options.style, callirhoe_args), options.style,
+                      options.vanilla, options.brightness, options.saturation, magick_args)
+
+def _stamp_file(outimg):
+    """return the sidecar file recording the input key of output I{outimg}
+
+    @rtype: str
+    """
+    head, tail = os.path.split(outimg)
+    return os.path.join(head, '.' + tail + '.calmagick')
+
+def is_current(outimg, stamp):
+    """return C{True} if output I{outimg} exists and was written from inputs with key I{stamp}
+
+    @rtype: bool
+    """
+    if not os.path.exists(outimg): return False
+    try:
+        with open(_stamp_file(outimg)) as f:
+            return f.read().strip() == stamp
+    except (IOError, OSError):
+        return False
+
+_written = set()
+"""outputs written by this run, as recorded by L{record_output}"""
+
+def record_output(outimg, stamp):
+    """record input key I{stamp} of output I{outimg} in its sidecar file"""
+    sidecar = _stamp_file(outimg)
+    tmp = "%s.%d.%d.tmp" % (sidecar, os.getpid(), threading.get_ident())
+    with open(tmp, 'w') as f:
+        f.write(stamp + '\n')
+    os.replace(tmp, sidecar)
+    with _mutex:
+        _written.add(outimg)
+
+def forget_output(outimg):
+    """remove the sidecar file of output I{outimg}, if any, before it is overwritten"""
+    try:
+        os.remove(_stamp_file(outimg))
+    except OSError:
+        pass
+
+def default_date(options):
+    """return the current (year, month), which callirhoe uses for missing or zero month and year
+    arguments, in single photo mode; with C{--range}, arguments are always explicit
+
+    @rtype: (int,int)
+    @return: tuple (year, month), or C{None} with C{--range}
+    """
+    return None if options.range else tuple(time.localtime()[0:2])
+
+_plugin_options = { 'lang': ('-l', '--lang', 'EN'), 'geom': ('-g', '--geometry', 'default'),
+                    'layouts': ('-t', '--layout', 'classic') }
+"""callirhoe options selecting plugins, by plugin category: (short option, long option, default)"""
+
+def _plugin_choice(args, short, long, default):
+    """return the value of callirhoe option I{short}/I{long} among I{args} (the last one given)"""
+    value = default
+    for i, a in enumerate(args):
+        if a in (short, long) and i + 1 < len(args): value = args[i+1]
+        elif a.startswith(long + '='): value = a[len(long)+1:]
+        elif a.startswith(short) and len(a) > len(short): value = a[len(short):]
+    return value
+
+_identities = dict()
+"""memoized results of L{callirhoe_identity}"""
+
+def callirhoe_identity(style, args):
+    """return the identity of the callirhoe program found in C{PATH} and of the style, language,
+    geometry and layout plugin files it loads for I{style} and arguments I{args}
+
+    Plugins are looked up as callirhoe does, in C{~/.callirhoe} and next to the program, and
+    identified by their contents; plugins packaged inside the program are covered by its identity.
+
+    @rtype: tuple
+    """
+    choice = [('style', style)] + [(cat, _plugin_choice(args, *opts)) for cat, opts in sorted(_plugin_options.items())]
+    key = tuple(choice)
+    with _mutex:
+        if key in _identities: return _identities[key]
+    prog = shutil.which('callirhoe')
+    if prog is None:
+        result = (None,)
+    else:
+        prog = os.path.realpath(prog)
+        st = os.stat(prog)
+        result = [(prog, st.st_size, st.st_mtime_ns)]
+        for cat, name in choice:
+            for path in (os.path.expanduser("~/.callirhoe"), os.path.dirname(prog)):
+                plugin = os.path.join(path, cat, name + '.py')
+                if os.path.isfile(plugin):
+                    result.append((cat, name, _file_hash(plugin)))
+                    break
+        result = tuple(result)
+    with _mutex:
+        _identities[key] = result
+    return result
+
+class OverlayCache(object):
+    """calendar images rendered by callirhoe, indexed by everything they depend on, so that jobs
+    needing the same calendar (same style, size, month and arguments) do not render it again
+
+    Images are kept in a L{lib.cache.RenderCache} in directory I{path} and hard-linked (or copied)
+    to the files of the jobs using them.
+
+    @ivar store: L{lib.cache.RenderCache} object
+    """
+    def __init__(self, path, max_size):
+        self.store = RenderCache(path, max_size)
+
+    @staticmethod
+    def key(style, size, args, today):
+        """return the key of a calendar image rendered by L{run_callirhoe}, including the
+        identity of files among I{args} (e.g. holiday files) and of callirhoe itself
+        (see L{callirhoe_identity})
+
+        @param today: current date, as returned by L{default_date}
+        @rtype: str
+        """
+        files = [(a, os.stat(a).st_size, os.stat(a).st_mtime_ns) for a in args if os.path.isfile(a)]
+        return render_key('overlay', lib._version, style, tuple(size), args, files, today,
+                          callirhoe_identity(style, args))
+
+    def fetch(self, key, calimg):
+        """write the cached image I{key} to file I{calimg}
+
+        @rtype: bool
+        @return: C{False} on a cache miss
+        """
+        files = self.store.lookup(key)
+        if files is None: return False
+        try:
+            install(files, calimg)
+        except OSError:
+            # evicted meanwhile
+            return False
+        return True
+
+    def put(self, key, calimg):
+        """store file I{calimg} as cached image I{key}"""
+        self.store.store(key, calimg, [calimg])
+
+_overlays = None
+"""L{OverlayCache} object used by L{compose_calendar} and L{run_pipeline}, or C{None}"""
+
 def get_cache(num_photos, num_months):
     """returns a reference to the cache object, or None if caching is disabled
 
@@ -493,7 +978,74 @@ def get_cache(num_photos, num_months):
     if q < 1 or r == 0: return None
     return _cache if (num_photos / r <= 6) else None;
 
-def compose_calendar(img, outimg, options, callirhoe_args, magick_args, stats=None, cache=None):
+def _placement_geometry(img, options, magick_args, stats=None):
+    """get image dimensions and compute the calendar rectangle
+
+    @rtype: ((int,int,int,int),(int,int),PILAnalysis)
+    @return: tuple (geometry, size, analysis), where I{analysis} is the L{PILAnalysis} object
+    used, or C{None}
+    """
+    analysis = None
+    if options.verbose:
+        if stats: print("[%d/%d]" % stats, end=' ')
+        print("Extracting image info...")
+    if options.backend == 'pil' and not magick_args[0]:
+        analysis = PILAnalysis(img)
+        w,h = analysis.size
+    else:
+        w,h = _IM_get_image_size(img, magick_args[0])
+    if options.verbose:
+        print("%s %dx%d %dmp R=%0.2f" % (img, w, h, int(w*h/1000000.0+0.5), float(w)/h))
+
+    if '/' in options.ratio:
+        tmp = options.ratio.split('/')
+        calratio = float(lib.atoi(tmp[0],1))/lib.atoi(tmp[1],1)
+    else:
+        calratio = float(options.ratio)
+    if options.placement == 'min' or options.placement == 'max':
+        geometry = _entropy_placement(img, (w,h), magick_args[0], options, calratio, analysis)
+    else:
+        geometry = _manual_placement((w,h), options, calratio)
+    return (geometry, (w,h), analysis)
+
+def _is_dark(img, geometry, options, magick_args, analysis=None):
+    """measure the luminance of the calendar rectangle and decide whether a negative overlay is needed
+
+    @rtype: bool
+    """
+    if options.verbose: print("Measuring luminance...", end=' ')
+    if options.negative > 0 and options.negative < 255:
+        if analysis is not None:
+            luma = analysis.luminance(geometry)
+        else:
+            luma = _IM_get_image_luminance(img, magick_args[0], geometry)
+        if options.verbose: print("(%s)" % luma, end=' ')
+    else:
+        luma = 255 - options.negative
+    dark = luma < options.negative
+    if options.verbose: print("DARK" if dark else "LIGHT")
+    return dark
+
+def compute_placement(img, options, magick_args, stats=None):
+    """compute the calendar rectangle of a photo and whether a negative overlay is needed
+
+    This is the CPU-bound part of L{compose_calendar}, run in worker processes
+    when C{--pool=process} is requested.
+
+    @rtype: ((int,int,int,int),bool)
+    @return: tuple (geometry, dark)
+    """
+    placement = load_placement(img, options, magick_args)
+    if placement is None:
+        geometry, size, analysis = _placement_geometry(img, options, magick_args, stats)
+        placement = (geometry, _is_dark(img, geometry, options, magick_args, analysis))
+        save_placement(img, options, magick_args, placement)
+    elif options.verbose:
+        if stats: print("[%d/%d]" % stats, end=' ')
+        print("Reusing image info from placement cache...", placement[0], "DARK" if placement[1] else "LIGHT")
+    return placement
+
+def compose_calendar(img, outimg, options, callirhoe_args, magick_args, stats=None, cache=None, stamp=None, placement=None):
     """performs calendar composition on a photo image
 
     @param img: photo file
@@ -503,10 +1055,15 @@ def compose_calendar(img, outimg, options, callirhoe_args, magick_args, stats=No
     @param magick_args: [pre,in,post]-magick argument list
     @param stats: if not C{None}: tuple(I{current,total}) counting input photos
     @param cache: if cache enabled, points to the cache dictionary
+    @param stamp: input key of the output (see L{output_key}), recorded when the output is written,
+    or C{None}
+    @param placement: tuple (geometry, dark) already computed by L{compute_placement}, or C{None}
     """
     # get image info (dimensions)
-    geometry, dark = None, None
-    if cache is not None:
+    geometry, dark, size, analysis = None, None, None, None
+    if placement is not None:
+        geometry, dark = placement
+    elif cache is not None:
         with _mutex:
             if img in cache:
                 geometry, dark = cache[img]
@@ -514,26 +1071,21 @@ def compose_calendar(img, outimg, options, callirhoe_args, magick_args, stats=No
             if stats: print("[%d/%d]" % stats, end=' ')
             print("Reusing image info from cache...", geometry, "DARK" if dark else "LIGHT")
 
-    if geometry is None:
-        if options.verbose:
-            if stats: print("[%d/%d]" % stats, end=' ')
-            print("Extracting image info...")
-        w,h = _IM_get_image_size(img, magick_args[0])
-        qresize = '%dx%d!' % ((options.quantum,)*2)
-        if options.verbose:
-            print("%s %dx%d %dmp R=%0.2f" % (img, w, h, int(w*h/1000000.0+0.5), float(w)/h))
+    if geometry is None and options.test == 'none':
+        placement = load_placement(img, options, magick_args)
+        if placement is not None:
+            geometry, dark = placement
+            if options.verbose:
+                if stats: print("[%d/%d]" % stats, end=' ')
+                print("Reusing image info from placement cache...", geometry, "DARK" if dark else "LIGHT")
 
-        if '/' in options.ratio:
-            tmp = options.ratio.split('/')
-            calratio = float(lib.atoi(tmp[0],1))/lib.atoi(tmp[1],1)
-        else:
-            calratio = float(options.ratio)
-        if options.placement == 'min' or options.placement == 'max':
-            geometry = _entropy_placement(img, (w,h), magick_args[0], options, calratio)
-        else:
-            geometry = _manual_placement((w,h), options, calratio)
+    if geometry is None:
+        geometry, size, analysis = _placement_geometry(img, options, magick_args, stats)
 
     if options.test != 'none':
+        if options.test in ('quant', 'quantimg'):
+            w,h = size or _IM_get_image_size(img, magick_args[0])
+            qresize = '%dx%d!' % ((options.quantum,)*2)
         if options.test == 'area':
             subprocess.call([_prog_im, img] + magick_args[0] + ['-region', '%dx%d+%d+%d' % geometry,
                 '-negate', outimg])
@@ -554,40 +1106,156 @@ def compose_calendar(img, outimg, options, callirhoe_args, magick_args, stats=No
         return
 
     # generate callirhoe calendar
-    if options.verbose: print("Generating calendar image (%s) ... [&]" % options.style)
     if not options.vanilla: callirhoe_args = callirhoe_args + ['--no-footer', '--border=0']
     calimg = mktemp('.png')
     try:
-        pcal = run_callirhoe(options.style, geometry[0:2], callirhoe_args, calimg)
+        pcal = None
+        if _overlays is not None:
+            overlay_key = OverlayCache.key(options.style, geometry[0:2], callirhoe_args, default_date(options))
+        if _overlays is not None and _overlays.fetch(overlay_key, calimg):
+            if options.verbose: print("Reusing calendar image (%s) from overlay cache..." % options.style)
+        else:
+            if options.verbose: print("Generating calendar image (%s) ... [&]" % options.style)
+            pcal = run_callirhoe(options.style, geometry[0:2], callirhoe_args, calimg)
 
         if dark is None:
             # measure luminance
-            if options.verbose: print("Measuring luminance...", end=' ')
-            if options.negative > 0 and options.negative < 255:
-                luma = _IM_get_image_luminance(img, magick_args[0], geometry)
-                if options.verbose: print("(%s)" % luma, end=' ')
-            else:
-                luma = 255 - options.negative
-            dark = luma < options.negative
-            if options.verbose: print("DARK" if dark else "LIGHT")
+            dark = _is_dark(img, geometry, options, magick_args, analysis)
+            save_placement(img, options, magick_args, (geometry, dark))
             if cache is not None:
                 with _mutex:
                     cache[img] = (geometry, dark)
 
-        pcal.wait()
-        if pcal.returncode != 0: raise RuntimeError("calmagick: calendar creation failed")
-
-        # perform final composition
-        if options.verbose: print("Composing overlay (%s)..." % outimg)
-        overlay = ['(', '-negate', calimg, ')'] if dark else [calimg]
-        subprocess.call([_prog_im, img] + magick_args[0] + ['-region', '%dx%d+%d+%d' % geometry] +
-            ([] if options.brightness == 0 else ['-brightness-contrast', '%d' % (-options.brightness if dark else options.brightness)]) +
-            ([] if options.saturation == 100 else ['-modulate', '100,%d' % options.saturation]) + magick_args[1] +
-            ['-compose', 'over'] +  overlay + ['-geometry', '+%d+%d' % geometry[2:], '-composite'] +
-            magick_args[2] + [outimg])
+        if pcal is not None:
+            pcal.wait()
+            if pcal.returncode != 0: raise RuntimeError("calmagick: calendar creation failed")
+            if _overlays is not None: _overlays.put(overlay_key, calimg)
+
+        # perform final composition; the output is no longer current until it succeeds
+        if stamp is not None: forget_output(outimg)
+        _compose_overlay(img, calimg, outimg, geometry, dark, options, magick_args)
+        if stamp is not None: record_output(outimg, stamp)
     finally:
         os.remove(calimg)
 
+def _compose_overlay(img, calimg, outimg, geometry, dark, options, magick_args):
+    """overlay calendar image I{calimg} on photo I{img} at I{geometry}, writing I{outimg}
+
+    @raise RuntimeError: if ImageMagick fails
+    """
+    if options.verbose: print("Composing overlay (%s)..." % outimg)
+    overlay = ['(', '-negate', calimg, ')'] if dark else [calimg]
+    status = subprocess.call([_prog_im, img] + magick_args[0] + ['-region', '%dx%d+%d+%d' % geometry] +
+        ([] if options.brightness == 0 else ['-brightness-contrast', '%d' % (-options.brightness if dark else options.brightness)]) +
+        ([] if options.saturation == 100 else ['-modulate', '100,%d' % options.saturation]) + magick_args[1] +
+        ['-compose', 'over'] +  overlay + ['-geometry', '+%d+%d' % geometry[2:], '-composite'] +
+        magick_args[2] + [outimg])
+    if status != 0: raise RuntimeError("calmagick: composition of '%s' failed" % outimg)
+
+class PipelineJob(object):
+    """state of a photo job, going through the stages of L{run_pipeline} in pipeline mode
+
+    @ivar img: photo file
+    @ivar outimg: output file
+    @ivar callirhoe_args: extra argument list to pass to callirhoe
+    @ivar stats: tuple(I{current,total}) counting input photos
+    @ivar stamp: input key of the output (see L{output_key}), or C{None}
+    @ivar placement: tuple (geometry, dark), set by the analysis stage
+    @ivar calimg: calendar image file, set by the render stage
+    @ivar tmpimg: composed image file, set by the composite stage and moved to L{outimg}
+    by the write stage
+    """
+    def __init__(self, img, outimg, callirhoe_args, stats):
+        self.img = img
+        self.outimg = outimg
+        self.callirhoe_args = callirhoe_args
+        self.stats = stats
+        self.stamp = None
+        self.placement = None
+        self.calimg = None
+        self.tmpimg = None
+
+    def cleanup(self):
+        """remove temporary files"""
+        for f in (self.calimg, self.tmpimg):
+            if f and os.path.exists(f): os.remove(f)
+        self.calimg = self.tmpimg = None
+
+def run_pipeline(jobs, options, magick_args, cache=None, pool=None):
+    """run photo jobs through a pipeline of stages (analyse, render, composite, write), each
+    with its own worker threads (see C{--stage-jobs}) and a bounded input queue
+
+    @param jobs: iterable of L{PipelineJob} objects
+    @param cache: if cache enabled, points to the cache dictionary
+    @param pool: C{concurrent.futures.ProcessPoolExecutor} to compute placements with, or C{None}
+    @rtype: lib.pipeline.Pipeline
+    @return: the pipeline, after all jobs have gone through it
+    """
+    placements = dict() # img -> Future, shared by jobs when caching
+
+    def analyse(job):
+        placement = None
+        if cache is not None:
+            with _mutex:
+                placement = cache.get(job.img)
+        if placement is None:
+            if pool is not None:
+                with _mutex:
+                    future = placements.get(job.img)
+                    if future is None:
+                        future = pool.submit(compute_placement, job.img, options, magick_args, job.stats)
+                        if cache is not None: placements[job.img] = future
+                placement = future.result()
+            else:
+                placement = compute_placement(job.img, options, magick_args, job.stats)
+            if cache is not None:
+                with _mutex:
+                    cache[job.img] = placement
+        job.placement = placement
+        return job
+
+    def render(job):
+        args = job.callirhoe_args if options.vanilla else job.callirhoe_args + ['--no-footer', '--border=0']
+        size = job.placement[0][0:2]
+        job.calimg = mktemp('.png')
+        if _overlays is not None:
+            key = OverlayCache.key(options.style, size, args, default_date(options))
+            if _overlays.fetch(key, job.calimg):
+                if options.verbose: print("Reusing calendar image (%s) from overlay cache..." % options.style)
+                return job
+        if options.verbose: print("Generating calendar image (%s) ..." % options.style)
+        pcal = run_callirhoe(options.style, size, args, job.calimg)
+        if pcal.wait() != 0: raise RuntimeError("calmagick: calendar creation failed")
+        if _overlays is not None: _overlays.put(key, job.calimg)
+        return job
+
+    def composite(job):
+        # on failure, the pipeline discards the job, so the existing output is left untouched
+        fd, job.tmpimg = tempfile.mkstemp(suffix=os.path.splitext(job.outimg)[1], dir=os.path.dirname(job.outimg) or '.')
+        os.close(fd)
+        _compose_overlay(job.img, job.calimg, job.tmpimg, job.placement[0], job.placement[1], options, magick_args)
+        if os.path.getsize(job.tmpimg) == 0:
+            # e.g. ImageMagick wrote numbered files for a multi-frame result instead
+            raise RuntimeError("calmagick: composition of '%s' produced no output" % job.outimg)
+        os.remove(job.calimg)
+        job.calimg = None
+        return job
+
+    def write(job):
+        os.replace(job.tmpimg, job.outimg)
+        job.tmpimg = None
+        if job.stamp is not None: record_output(job.outimg, job.stamp)
+        return job
+
+    workers = options.stage_jobs
+    p = Pipeline([Stage('analyse', analyse, workers[0], options.queue_size),
+                  Stage('render', render, workers[1], options.queue_size),
+                  Stage('composite', composite, workers[2], options.queue_size),
+                  Stage('write', write, workers[3], options.queue_size)],
+                 discard = PipelineJob.cleanup)
+    p.run(jobs)
+    return p
+
 def parse_range(s,hint=None):
     """returns list of (I{Month,Year}) tuples for a given range
 
@@ -613,18 +1281,23 @@ def parse_range(s,hint=None):
 def range_worker(q,ev,i):
     """worker thread for a (I{Month,Year}) tuple
 
+    Queue items are tuples (I{args}, I{future}), where I{args} is the argument tuple of
+    L{compose_calendar} and I{future} is either C{None} or a C{concurrent.futures.Future}
+    of L{compute_placement} for the photo, computed by a worker process.
+
     @param ev: Event used to consume remaining items in case of error
     @param q: Queue object to consume items from
     @param i: Thread number
     """
     while True:
         if ev.is_set():
-            q.get()
+            args, future = q.get()
+            if future is not None: future.cancel()
             q.task_done()
         else:
-            item = q.get()
+            args, future = q.get()
             try:
-                compose_calendar(*item)
+                compose_calendar(*args, placement = future.result() if future is not None else None)
             except Exception as e:
                 print("Exception in Thread-%d: %s" % (i,e.args), file=sys.stderr)
                 ev.set()
@@ -652,6 +1325,10 @@ def main_program():
         # this way we get an exception if outdir exists and is a normal file
         os.mkdir(options.outdir)
 
+    global _overlays
+    if options.overlay_cache and options.test == 'none':
+        _overlays = OverlayCache(options.overlay_cache, options.overlay_cache_size*1024*1024)
+
     if options.range:
         flist = sorted(glob.glob(args[0]))
         mrange = parse_range(options.range,hint=len(flist))
@@ -661,7 +1338,11 @@ def main_program():
         nf = len(flist)
         if nf > 0:
             if len(mrange) > nf and options.prefix == 'no?': options.prefix = 'yes'
-            if options.jobs > 1:
+            pool = None
+            if options.pool == 'process' and (options.jobs > 1 or options.pipeline):
+                pool = concurrent.futures.ProcessPoolExecutor(options.jobs)
+                placements = dict()
+            if options.jobs > 1 and not options.pipeline:
                 q = queue.Queue()
                 ev = threading.Event()
                 for i in range(options.jobs):
@@ -670,23 +1351,54 @@ def main_program():
                      t.start()
 
             cache = get_cache(nf, len(mrange));
+            jobs = []
+            skipped = 0
             for i in range(len(mrange)):
                 img = flist[i % nf]
                 m,y = mrange[i]
                 prefix = '' if options.prefix.startswith('no') else '%04d-%02d_' % (y,m)
                 outimg = get_outfile(img,options.outdir,prefix,options.format)
-                args = (img, outimg, options, [str(m), str(y)] + argv2, magick_args,
-                        (i+1,len(mrange)), cache)
-                if options.jobs > 1: q.put(args)
-                else: compose_calendar(*args)
-
-            if options.jobs > 1: q.join()
+                job = PipelineJob(img, outimg, [str(m), str(y)] + argv2, (i+1,len(mrange)))
+                if options.test == 'none':
+                    job.stamp = output_key(img, options, job.callirhoe_args, magick_args)
+                    if not options.force and is_current(outimg, job.stamp):
+                        if options.verbose: print("[%d/%d] %s is up to date" % (job.stats + (outimg,)))
+                        skipped += 1
+                        continue
+                jobs.append(job)
+
+            if options.pipeline:
+                run_pipeline(jobs, options, magick_args, cache, pool).report()
+            else:
+                for job in jobs:
+                    args = (job.img, job.outimg, options, job.callirhoe_args, magick_args, job.stats, cache, job.stamp)
+                    future = None
+                    if pool is not None:
+                        # with caching, each photo is placed only once
+                        future = placements.get(job.img) if cache is not None else None
+                        if future is None:
+                            future = pool.submit(compute_placement, job.img, options, magick_args, job.stats)
+                            if cache is not None: placements[job.img] = future
+                    if options.jobs > 1: q.put((args, future))
+                    else: compose_calendar(*args)
+
+                if options.jobs > 1: q.join()
+            if pool is not None: pool.shutdown()
+            if options.test == 'none':
+                rebuilt = len([job for job in jobs if job.outimg in _written])
+                print("calmagick: %d rebuilt, %d up to date, %d failed" % (rebuilt, skipped, len(jobs) - rebuilt))
     else:
         img = args[0]
         if not os.path.isfile(img):
             raise lib.Abort("calmagick: input image '%s' does not exist" % img)
         outimg = get_outfile(img,options.outdir,'',options.format,options.outfile)
-        compose_calendar(img, outimg, options, argv2, magick_args)
+        stamp = None
+        if options.test == 'none':
+            stamp = output_key(img, options, argv2, magick_args)
+            if not options.force and is_current(outimg, stamp):
+                if options.verbose: print("%s is up to date" % outimg)
+                return
+        compose_calendar(img, outimg, options, argv2, magick_args, stamp=stamp)
 
 if __name__ == '__main__':
     try:
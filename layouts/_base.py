@@ -20,6 +20,8 @@
 import optparse
 from lib.xcairo import *
 from lib.geom import *
+from lib.trace import DrawTracer
+from lib.caltable import CalendarTable
 from math import floor, ceil, sqrt
 
 def get_parser(layout_name):
@@ -70,6 +72,14 @@ def get_parser(layout_name):
                       help="swap month colors for even/odd years")
     parser.add_option("--fractal", action="store_true", default=False,
                       help="2x2 fractal layout; overrides rows=2, cols=2, z-order=increasing")
+    parser.add_option("--batch-draw", action="store_true", default=False,
+                      help="draw day cell backgrounds with one path per color and month grid lines as merged "
+                      "paths; output looks the same, with smaller PDF files and faster PNG rendering")
+    parser.add_option("--reuse-forms", action="store_true", default=False,
+                      help="draw repeated static elements (day name bars, empty cells, footer) once and reuse "
+                      "them; in PDF output they are stored once, as form objects, resulting in smaller files")
+    parser.add_option("--trace-draw", action="store_true", default=False,
+                      help="count drawing operations per month and page, estimate overdraw, and print a report")
     return parser
 
 
@@ -83,8 +93,10 @@ class DayCell(object):
     @ivar theme: (Style class,Geometry class,Language module) tuple
     @type show_day_name: bool
     @ivar show_day_name: whether day name is displayed
+    @ivar week_of_year: ISO week number of the day, computed from the date if C{None}
     """
-    def __init__(self, day, header, footer, theme, show_day_name, options, lightweight = False):
+    def __init__(self, day, header, footer, theme, show_day_name, options, lightweight = False,
+                 week_of_year = None):
         self.day = day
         self.header = header
         self.footer = footer
@@ -92,16 +104,27 @@ class DayCell(object):
         self.show_day_name = show_day_name
         self.options = options
         self.lightweight = lightweight
+        self.week_of_year = week_of_year
 
-    def _draw_short(self, cr, rect):
+    def draw_frame(self, cr, rect, batch = None):
+        """render the day cell box, or add it to I{batch} if it is not C{None}
+
+        @type batch: L{BoxBatch}
+        """
+        S = self.theme[0]
+        if batch is not None:
+            batch.add(rect, S.frame, S.bg, S.frame_thickness_dots, lightweight = self.lightweight)
+        else:
+            draw_box(cr, rect, S.frame, S.bg, S.frame_thickness_dots, 
+                     lightweight = self.lightweight)
+
+    def _draw_short(self, cr, rect, frame = True):
         """render the day cell in short mode"""
         S,G,L = self.theme
         x, y, w, h = rect
         day_of_week, cell_date = self.day
-        S_bg = S.bg
         #if day_of_week >= 5 and (week_of_year & 1): S_bg = color_scale(S.bg,0.9)
-        draw_box(cr, rect, S.frame, S_bg, mm_to_dots(S.frame_thickness), 
-                 lightweight = self.lightweight)
+        if frame: self.draw_frame(cr, rect)
         R = rect_rel_scale(rect, G.size[0], G.size[1])
         if self.show_day_name:
             Rdom, Rdow = rect_hsplit(R, *G.mw_split)
@@ -115,7 +138,7 @@ class DayCell(object):
         if self.options.iso_week and (day_of_week == 0 or cell_date.day == 1 and not getattr(self.options, 'phantom_days', False)):
             Rweek = rect_rel_scale(rect, 0.95, G.size[1] if self.header else 0.95)
             Rweek = rect_vsplit(rect_hsplit(Rweek,0.2)[0], 0.2)[0]
-            week_of_year = cell_date.isocalendar()[1];
+            week_of_year = self.week_of_year or cell_date.isocalendar()[1]
             draw_str(cr, text = "%s%d" % (L.week_of_year_prefix,week_of_year), rect = Rweek, scaling = -1, stroke_rgba = S.fg,
                     align = (2,2), font = S.font, measure = "%s88" % (L.week_of_year_prefix,))
         # draw name of day
@@ -133,15 +156,13 @@ class DayCell(object):
             draw_str(cr, text = self.footer, rect = R, scaling = -1, stroke_rgba = S.footer,
                 font = S.footer_font, measure = "MgMgMg")
 
-    def _draw_long(self, cr, rect):
+    def _draw_long(self, cr, rect, frame = True):
         """render the day cell in long mode"""
         S,G,L = self.theme
         x, y, w, h = rect
         day_of_week, cell_date = self.day
-        S_bg = S.bg
         #if day_of_week >= 5 and (week_of_year & 1): S_bg = tuple(reversed(S.bg))
-        draw_box(cr, rect, S.frame, S_bg, mm_to_dots(S.frame_thickness),
-                 lightweight = self.lightweight)
+        if frame: self.draw_frame(cr, rect)
         R1, Rhf = rect_hsplit(rect, *G.hf_hsplit)
         if self.show_day_name:
             R = rect_rel_scale(R1, G.size[2], G.size[3])
@@ -155,7 +176,7 @@ class DayCell(object):
         # draw week number
         if self.options.iso_week and (day_of_week == 0 or cell_date.day == 1):
             Rweek = rect_vsplit(rect_hsplit(rect,0.125)[0], 0.25)[0]
-            week_of_year = cell_date.isocalendar()[1];
+            week_of_year = self.week_of_year or cell_date.isocalendar()[1]
             draw_str(cr, text = "%s%d" % (L.week_of_year_prefix,week_of_year), rect = Rweek, scaling = -1, stroke_rgba = S.fg,
                     align = (2,2), font = S.font, measure = "%s88" % (L.week_of_year_prefix,))
         # draw name of day
@@ -172,15 +193,17 @@ class DayCell(object):
             draw_str(cr, text = self.footer, rect = Rf, scaling = -1, stroke_rgba = S.footer, align = (1,2),
                  font = S.footer_font)
 
-    def draw(self, cr, rect):
+    def draw(self, cr, rect, frame = True):
         """automatically render a short or long day cell depending on threshold given in options
 
         If C{rect} ratio is less than C{self.options.short_daycell_ratio} then short mode is chosen, otherwise long mode.
+
+        @param frame: if C{False}, the cell box is assumed to be already drawn (see L{draw_frame})
         """
         if rect_ratio(rect) < self.options.short_daycell_ratio:
-            self._draw_short(cr, rect)
+            self._draw_short(cr, rect, frame)
         else:
-            self._draw_long(cr, rect)
+            self._draw_long(cr, rect, frame)
 
 
 class CalendarRenderer(object):
@@ -190,10 +213,12 @@ class CalendarRenderer(object):
     @ivar Year: year of first month
     @ivar Month: first month
     @ivar MonthSpan: month span
-    @ivar Theme: (Style module,Geometry module,Language module) tuple
+    @ivar Theme: (Style,Geometry,Language) tuple of compiled L{lib.theme.Record} objects
     @ivar holiday_provider: L{HolidayProvider} object
     @ivar version_string: callirhoe version string
     @ivar options: parser options object
+    @ivar forms: L{FormCache} object for reusable graphics, C{None} if disabled
+    @ivar caltable: L{CalendarTable} of the rendered month range
     """
     def __init__(self, Outfile, Year, Month, MonthSpan, Theme, holiday_provider, version_string, options):
         self.Outfile = Outfile
@@ -204,6 +229,9 @@ class CalendarRenderer(object):
         self.holiday_provider = holiday_provider
         self.version_string = version_string
         self.options = options
+        self.forms = None
+        self.caltable = CalendarTable(Year, Month, MonthSpan)
+        self._month_tables = dict()
 
     def _draw_month(self, cr, rect, month, year):
         """this method renders a calendar month, it B{should be overridden} in any subclass
@@ -215,6 +243,27 @@ class CalendarRenderer(object):
         """
         raise NotImplementedError("base _draw_month() should be overridden")
 
+    def _month_holidays(self, year, month):
+        """return the holiday data of a month, as L{HolidayProvider.month_table}, computed once per page
+
+        @rtype: [(str,str,int,Style),...]
+        """
+        table = self._month_tables.get((year, month))
+        if table is None:
+            table = self._month_tables[(year, month)] = self.holiday_provider.month_table(year, month)
+        return table
+
+    def _draw_footer_str(self, cr, text, rect, align, slant):
+        """render a footer string, reusing it from L{forms} if enabled"""
+        S,G,L = self.Theme
+        def _draw(cr, R):
+            draw_str(cr, text = text, rect = R, stroke_rgba = (0,0,0,0.5), scaling = -1,
+                     align = align, font = (extract_font_name(S.month.font),slant,0))
+        if self.forms is not None:
+            self.forms.draw(cr, ('footer', text, align, slant), rect, _draw)
+        else:
+            _draw(cr, rect)
+
 #1   1   1
 #2   2   1
 #3   3   1
@@ -233,8 +282,13 @@ class CalendarRenderer(object):
 #rows = 0
 #cols = 0
     def render(self):
-        """main calendar rendering routine"""
+        """main calendar rendering routine
+
+        @rtype: [str,...]
+        @return: list of files written
+        """
         S,G,L = self.Theme
+        self.holiday_provider.prefetch(self.Year, self.Month, self.MonthSpan)
         if self.options.fractal:
             rows = cols = 2
         else:
@@ -242,18 +296,20 @@ class CalendarRenderer(object):
 
 
         if self.options.symmetric:
-            G.month.symmetric = True
+            G = G._replace(month = G.month._replace(symmetric = True))
         if self.options.padding is not None:
-            G.month.padding = self.options.padding
+            G = G._replace(month = G.month._replace(padding = self.options.padding))
         if self.options.no_shadow == True:
-            S.month.box_shadow = False
+            S = S._replace(month = S.month._replace(box_shadow = False))
         if self.Year % 2: self.options.swap_colors = not self.options.swap_colors
         if self.options.swap_colors:
-            S.month.color_map_bg = (S.month.color_map_bg[1], S.month.color_map_bg[0])
-            S.month.color_map_fg = (S.month.color_map_fg[1], S.month.color_map_fg[0])
+            S = S._replace(month = S.month._replace(
+                color_map_bg = (S.month.color_map_bg[1], S.month.color_map_bg[0]),
+                color_map_fg = (S.month.color_map_fg[1], S.month.color_map_fg[0])))
 
         try:
-            page = PageWriter(self.Outfile, G.pagespec, not self.options.opaque, G.landscape, G.border)
+            page = PageWriter(self.Outfile, G.pagespec, not self.options.opaque, G.landscape, G.border,
+                              G.png_colors, G.png_max_error, G.pdf_date)
         except InvalidFormat as e:
             print("invalid output format", e.args[0], file=sys.stderr)
             sys.exit(1)
@@ -275,7 +331,8 @@ class CalendarRenderer(object):
             rows = int(ceil(self.MonthSpan*1.0/cols))
         elif cols == 0:
             cols = int(ceil(self.MonthSpan*1.0/rows))
-        G.landscape = page.landscape  # PNG is pseudo-landscape (portrait with width>height)
+        G = G._replace(landscape = page.landscape)  # PNG is pseudo-landscape (portrait with width>height)
+        self.Theme = (S,G,L)
 
         if not self.options.no_footer:
             V0 = VLayout(page.Text_rect, 40, (1,)*4)
@@ -301,6 +358,10 @@ class CalendarRenderer(object):
                 if num_placed >= self.MonthSpan: break
 
         num_pages_written = 0
+        self.forms = FormCache() if self.options.reuse_forms else None
+        tracer = DrawTracer() if self.options.trace_draw else None
+        z = int(page.landscape)
+        cr = tracer.begin_page(page.cr, (page.Size[z], page.Size[1-z])) if tracer else page.cr
 
         z_order = "increasing" if self.options.fractal else self.options.z_order
         if z_order == "auto":
@@ -310,13 +371,17 @@ class CalendarRenderer(object):
                 z_order = "increasing"
         total_placed = 0
         for p in page_layout:  # [[(month,year),...],...]
+            # keep the holiday data of this page's months (and their phantom days) only
+            self._month_tables.clear()
             num_placed = 0
             yy = [p[0][1]]
             if z_order == "decreasing": p.reverse()
             for (m,y) in p:
                 k = len(p) - num_placed - 1 if z_order == "decreasing" else num_placed
-                self._draw_month(page.cr, grid.item_seq(k, self.options.grid_order == "column"),
+                if tracer: tracer.begin_month(m, y)
+                self._draw_month(cr, grid.item_seq(k, self.options.grid_order == "column"),
                            month=m, year=y)
+                if tracer: tracer.end_month()
                 num_placed += 1
                 total_placed += 1
                 if y > yy[-1]:
@@ -325,12 +390,10 @@ class CalendarRenderer(object):
             valid_page = not self.options.fractal or num_pages_written == 0
             if not self.options.month_with_year and not self.options.no_footer and valid_page:
                 year_str = str(yy[0]) if yy[0] == yy[-1] else "%s – %s" % (yy[0],yy[-1])
-                draw_str(page.cr, text = year_str, rect = Rc, stroke_rgba = (0,0,0,0.5), scaling = -1,
-                         align = (0,0), font = (extract_font_name(S.month.font),0,0))
+                self._draw_footer_str(cr, year_str, Rc, (0,0), 0)
             if not self.options.no_footer and valid_page:
-                draw_str(page.cr, text = "rendered by Callirhoe ver. %s" % self.version_string,
-                         rect=Rc, stroke_rgba=(0, 0, 0, 0.5), scaling=-1, align=(1, 0),
-                         font=(extract_font_name(S.month.font), 1, 0))
+                self._draw_footer_str(cr, "rendered by Callirhoe ver. %s" % self.version_string,
+                                      Rc, (1,0), 1)
             num_pages_written += 1
             if self.options.fractal:
                 if total_placed < self.MonthSpan-1:
@@ -345,3 +408,7 @@ class CalendarRenderer(object):
                 page.end_page()
                 if num_pages_written < num_pages:
                     page.new_page()
+                    cr = tracer.begin_page(page.cr, (page.Size[z], page.Size[1-z])) if tracer else page.cr
+        if tracer: tracer.report()
+        page.finish()
+        return page.outfiles
@@ -37,7 +37,9 @@ class CalendarRenderer(_base.CalendarRenderer):
         S,G,L = self.Theme
         make_sloppy_rect(cr, rect, G.month.sloppy_dx, G.month.sloppy_dy, G.month.sloppy_rot)
 
-        day, span = calendar.monthrange(year, month)
+        T = self.caltable
+        day, span = T.monthrange(year, month)
+        holidays = self._month_holidays(year, month)
         mmeasure = 'A'*max(list(map(len,L.month_name)))
         if self.options.month_with_year:
             mmeasure += 'A'*(len(str(year))+1)
@@ -52,29 +54,48 @@ class CalendarRenderer(_base.CalendarRenderer):
             shad = (f,-f) if G.landscape else (f,f)
             draw_shadow(cr, rect_from_origin(rect), shad)
             
+        batch = BoxBatch() if self.options.batch_draw else None
+        if batch is not None:
+            box = batch.add
+        else:
+            box = lambda *args, **kwargs: draw_box(cr, *args, **kwargs)
+        cells = []
+
         # draw day cells
         for dom in range(1,rows+1):
             R = dom_grid.item(dom-1)
             if dom <= span:
-                holiday_tuple = self.holiday_provider(year, month, dom, day)
-                day_style = holiday_tuple[2]
-                dcell = _base.DayCell(day = (day, date(year, month, dom)), header = holiday_tuple[0], footer = holiday_tuple[1],
-                                      theme = (day_style, G.dom, L), show_day_name = True, options = self.options)
-                dcell.draw(cr, R)
+                holiday_tuple = holidays[dom - 1]
+                day_style = holiday_tuple[3]
+                cell_date = T.date(year, month, dom)
+                dcell = _base.DayCell(day = (day, cell_date), header = holiday_tuple[0], footer = holiday_tuple[1],
+                                      theme = (day_style, G.dom, L), show_day_name = True, options = self.options,
+                                      week_of_year = T.iso_week(cell_date))
+                if batch is not None:
+                    dcell.draw_frame(cr, R, batch)
+                    cells.append((dcell, R))
+                else:
+                    dcell.draw(cr, R)
             else:
                 day_style = S.dom
-                draw_box(cr, rect = R, stroke_rgba = day_style.frame, fill_rgba = day_style.bg,
-                         stroke_width = mm_to_dots(day_style.frame_thickness))
+                box(rect = R, stroke_rgba = day_style.frame, fill_rgba = day_style.bg,
+                    stroke_width = day_style.frame_thickness_dots)
             day = (day + 1) % 7
+
+        # in batch mode, text goes on top of the boxes drawn so far
+        if batch is not None:
+            batch.flush(cr)
+            for dcell, R in cells:
+                dcell.draw(cr, R, frame = False)
             
         # draw month title (name)
         mcolor = S.month.color_map_bg[year%2][month]
         mcolor_fg = S.month.color_map_fg[year%2][month]
         R_mb = grid.item(0)
         draw_box(cr, rect = R_mb, stroke_rgba = S.month.frame, fill_rgba = mcolor,
-                 stroke_width = mm_to_dots(S.month.frame_thickness)) # title box
+                 stroke_width = S.month.frame_thickness_dots) # title box
         draw_box(cr, rect = rect_from_origin(rect), stroke_rgba = S.month.frame, fill_rgba = (),
-                 stroke_width = mm_to_dots(S.month.frame_thickness)) # full box
+                 stroke_width = S.month.frame_thickness_dots) # full box
         R_text = rect_rel_scale(R_mb, 1, 0.5)
         mshad = None
         if S.month.text_shadow:
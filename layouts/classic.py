@@ -36,25 +36,48 @@ parser.add_option("--iso-week", action="store_true", default=False,
                   help="show ISO week number (starts on Monday)")
 
 
-def _weekrows_of_month(year, month):
-    """returns the number of Monday-Sunday ranges (or subsets of) that a month contains, which are 4, 5 or 6
-
-    @rtype: int
-    """
-    day,span = calendar.monthrange(year, month)
-    if day == 0 and span == 28: return 4
-    if day == 5 and span == 31: return 6
-    if day == 6 and span >= 30: return 6
-    return 5
-
 class CalendarRenderer(_base.CalendarRenderer):
     """classic tiles layout class"""
+    def _draw_day_name(self, cr, rect, col, wmeasure):
+        """render the name of day I{col} in the day name bar cell I{rect}"""
+        S,G,L = self.Theme
+        R_text = rect_rel_scale(rect, 1, 0.5)
+        draw_str(cr, text = L.day_name[col], rect = R_text, scaling = -1, stroke_rgba = S.dow.fg,
+                 align = (2,0), font = S.dow.font, measure = wmeasure)
+
+    def _draw_day_name_bar(self, cr, rect, wmeasure, batch = None):
+        """render the day name bar; if I{batch} is given, boxes are added to it and names are not drawn"""
+        S,G,L = self.Theme
+        R_dnc = HLayout(rect, 7) # day name cells = 1/7-th of day name bar
+        for col in range(7):
+            R = R_dnc.item(col)
+            args = dict(rect = R, stroke_rgba = None if self.options.lightweight else S.dom.frame,
+                        fill_rgba = S.dom.bg if col < 5 else S.dom_weekend.bg,
+                        stroke_width = S.dow.frame_thickness_dots,
+                        lightweight = self.options.lightweight)
+            if batch is not None:
+                batch.add(**args)
+            else:
+                draw_box(cr, **args)
+                self._draw_day_name(cr, R, col, wmeasure)
+
+    def _draw_empty_cell(self, cr, rect, day_style, batch = None):
+        """render an empty day cell, or add it to I{batch}"""
+        args = dict(rect = rect, stroke_rgba = day_style.frame, fill_rgba = day_style.bg,
+                    stroke_width = day_style.frame_thickness_dots,
+                    lightweight = self.options.lightweight)
+        if batch is not None:
+            batch.add(**args)
+        else:
+            draw_box(cr, **args)
+
     def _draw_month(self, cr, rect, month, year):
         S,G,L = self.Theme
         make_sloppy_rect(cr, rect, G.month.sloppy_dx, G.month.sloppy_dy, G.month.sloppy_rot)
 
-        day, span = calendar.monthrange(year, month)
-        weekrows = 6 if G.month.symmetric else _weekrows_of_month(year, month)
+        T = self.caltable
+        day, span = T.monthrange(year, month)
+        weekrows = 6 if G.month.symmetric else T.weekrows(year, month)
         dom = -day + 1;
         wmeasure = 'A'*max(list(map(len,L.day_name)))
         mmeasure = 'A'*max(list(map(len,L.month_name)))
@@ -72,7 +95,6 @@ class CalendarRenderer(_base.CalendarRenderer):
         grid = GLayout(rect2, 7, 7)
         # 61.8% - 38.2% split (golden)
         R_mb, R_db = rect_vsplit(grid.item_span(1, 7, 0, 0), 0.618)  # month name bar, day name bar
-        R_dnc = HLayout(R_db, 7) # day name cells = 1/7-th of day name bar
         dom_grid = GLayout(grid.item_span(6, 7, 1, 0), weekrows, 7)
         
         # draw box shadow
@@ -81,64 +103,64 @@ class CalendarRenderer(_base.CalendarRenderer):
             shad = (f,-f) if G.landscape else (f,f)
             draw_shadow(cr, rect_from_origin(rect), shad)
             
+        batch = BoxBatch() if self.options.batch_draw else None
+
         # draw day names
-        for col in range(7):
-            R = R_dnc.item(col)
-            draw_box(cr, rect = R, stroke_rgba = None if self.options.lightweight else S.dom.frame,
-                     fill_rgba = S.dom.bg if col < 5 else S.dom_weekend.bg,
-                     stroke_width = mm_to_dots(S.dow.frame_thickness), 
-                     lightweight = self.options.lightweight)
-            R_text = rect_rel_scale(R, 1, 0.5)
-            draw_str(cr, text = L.day_name[col], rect = R_text, scaling = -1, stroke_rgba = S.dow.fg,
-                     align = (2,0), font = S.dow.font, measure = wmeasure)
+        if self.forms is not None:
+            self.forms.draw(cr, 'day_names', R_db,
+                            lambda cr, R: self._draw_day_name_bar(cr, R, wmeasure))
+        else:
+            self._draw_day_name_bar(cr, R_db, wmeasure, batch)
             
         # draw day cells
+        cells = []
         for row in range(weekrows):
             for col in range(7):
                 R = dom_grid.item(row, col)
                 is_normal = dom > 0 and dom <= span
-                if is_normal or self.options.phantom_days:
-                    real_year, real_month, real_dom = year, month, dom
-
-                    # handle phantom days
-                    if dom < 1:
-                        real_month -= 1
-                        if real_month < 1:
-                            real_month = 12
-                            real_year -= 1
-                        real_dom += calendar.monthrange(real_year, real_month)[1]
-                    elif dom > span:
-                        real_month += 1
-                        if real_month > 12:
-                            real_month = 1
-                            real_year += 1
-                        real_dom -= span
-
-                    holiday_tuple = self.holiday_provider(real_year, real_month, real_dom, col)
+                if is_normal or self.options.phantom_days and T.has_date(year, month, dom):
+                    # phantom days map to the previous or next month (none past datetime.date.max)
+                    cell_date = T.date(year, month, dom)
+                    holiday_tuple = self._month_holidays(cell_date.year, cell_date.month)[cell_date.day - 1]
                     if is_normal:
-                        day_style = holiday_tuple[2]
+                        day_style = holiday_tuple[3]
                     else:
                         day_style = S.dom_weekend_phantom if col >= 5 else S.dom_phantom
-                    dcell = _base.DayCell(day = (col, date(real_year, real_month, real_dom)), header = holiday_tuple[0], footer = holiday_tuple[1],
+                    dcell = _base.DayCell(day = (col, cell_date), header = holiday_tuple[0], footer = holiday_tuple[1],
                                           theme = (day_style, G.dom, L), show_day_name = False, 
-                                          options = self.options )
-                    dcell.draw(cr, R)
+                                          options = self.options, week_of_year = T.iso_week(cell_date))
+                    if batch is not None:
+                        dcell.draw_frame(cr, R, batch)
+                        cells.append((dcell, R))
+                    else:
+                        dcell.draw(cr, R)
                 else:
                     day_style = S.dom_weekend if col >= 5 else S.dom
-                    draw_box(cr, rect = R, stroke_rgba = day_style.frame, fill_rgba = day_style.bg,
-                             stroke_width = mm_to_dots(day_style.frame_thickness),
-                             lightweight = self.options.lightweight)
+                    if batch is None and self.forms is not None:
+                        self.forms.draw(cr, ('empty', col >= 5), R,
+                                        lambda cr, R: self._draw_empty_cell(cr, R, day_style))
+                    else:
+                        self._draw_empty_cell(cr, R, day_style, batch)
                 dom += 1
+
+        # in batch mode, text goes on top of the boxes drawn so far
+        if batch is not None:
+            batch.flush(cr)
+            if self.forms is None:
+                for col in range(7):
+                    self._draw_day_name(cr, HLayout(R_db, 7).item(col), col, wmeasure)
+            for dcell, R in cells:
+                dcell.draw(cr, R, frame = False)
                 
         # draw month title (name)
         mcolor = S.month.color_map_bg[year%2][month]
         mcolor_fg = S.month.color_map_fg[year%2][month]
         draw_box(cr, rect = R_mb, stroke_rgba = None if self.options.lightweight else S.month.frame, 
                  fill_rgba = mcolor,
-                 stroke_width = mm_to_dots(S.month.frame_thickness),
+                 stroke_width = S.month.frame_thickness_dots,
                  lightweight = self.options.lightweight) # title box
         draw_box(cr, rect = rect_from_origin(rect), stroke_rgba = S.month.frame, fill_rgba = (),
-                 stroke_width = mm_to_dots(S.month.frame_thickness),
+                 stroke_width = S.month.frame_thickness_dots,
                  lightweight = self.options.lightweight) # full box
         R_text = rect_rel_scale(R_mb, 1, 0.5)
         mshad = None
@@ -70,18 +70,23 @@ def get_parser(layout_name):
                       help="swap month colors for even/odd years")
     parser.add_option("--fractal", action="store_true", default=False,
                       help=optparse.SUPPRESS_HELP)
+    parser.add_option("--reuse-forms", action="store_true", default=False,
+                      help="draw repeated static elements (day name bars, empty cells, footer) once and reuse "
+                      "them; in PDF output they are stored once, as form objects, resulting in smaller files")
+    parser.add_option("--trace-draw", action="store_true", default=False,
+                      help="count drawing operations per month and page, estimate overdraw, and print a report")
     return parser
 
 parser = get_parser(__name__)
 
-def _draw_day_cell(cr, rect, day, header, footer, theme, show_day_name, text_height=None):
+def _draw_day_cell(cr, rect, day, header, footer, theme, show_day_name, text_height=None, week_nr=None):
     ds,G,L = theme
     year, month, day_of_month, day_of_week = day
-    draw_box(cr, rect, ds.bg, ds.bg, mm_to_dots(ds.frame_thickness))
+    draw_box(cr, rect, ds.bg, ds.bg, ds.frame_thickness_dots)
 
     if day_of_month > 1:
       x, y, w, h = rect
-      draw_line(cr, (x, y, w, 0), ds.frame, mm_to_dots(ds.frame_thickness))
+      draw_line(cr, (x, y, w, 0), ds.frame, ds.frame_thickness_dots)
 
     if (text_height is not None) and (text_height > 0):
       x, y, w, h = rect
@@ -118,7 +123,8 @@ def _draw_day_cell(cr, rect, day, header, footer, theme, show_day_name, text_hei
             font = ds.font, measure = "Mo")
         # week number
         if day_of_week == 0 or (day_of_month == 1 and month == 1):
-          week_nr = date(year, month, day_of_month).isocalendar()[1]
+          if week_nr is None:
+            week_nr = date(year, month, day_of_month).isocalendar()[1]
           draw_str(cr, text = "%s%d" % (L.week_of_year_prefix, week_nr), rect = Rmiddle_top,
               scaling = -1, stroke_rgba = ds.fg, align = (0,valign),
               font = ds.header_font, measure = "%s88" % (L.week_of_year_prefix,))
@@ -138,7 +144,9 @@ class CalendarRenderer(_base.CalendarRenderer):
         S,G,L = self.Theme
         make_sloppy_rect(cr, rect, G.month.sloppy_dx, G.month.sloppy_dy, G.month.sloppy_rot)
 
-        day, span = calendar.monthrange(year, month)
+        T = self.caltable
+        day, span = T.monthrange(year, month)
+        holidays = self._month_holidays(year, month)
         wmeasure = 'A'*max(list(map(len,L.day_name)))
         mmeasure = 'A'*max(list(map(len,L.month_name)))
 
@@ -159,14 +167,14 @@ class CalendarRenderer(_base.CalendarRenderer):
         # draw day cells
         for dom in range(1,span+1):
             R = dom_grid.item(dom-1)
-            holiday_tuple = self.holiday_provider(year, month, dom, day)
-            day_style = holiday_tuple[2]
+            holiday_tuple = holidays[dom - 1]
+            day_style = holiday_tuple[3]
             header = holiday_tuple[0]
             footer = holiday_tuple[1]
             _draw_day_cell(cr, rect = R, day = (year, month, dom, day),
                           header = header, footer = footer,
                           theme = (day_style, G.dom, L), show_day_name = True,
-                          text_height = text_height)
+                          text_height = text_height, week_nr = T.iso_week(T.date(year, month, dom)))
 
             day = (day + 1) % 7
 
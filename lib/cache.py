@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+#    callirhoe - high quality calendar rendering
+#    Copyright (C) 2012-2020 George M. Tzoumas
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see http://www.gnu.org/licenses/
+
+# *****************************************
+#                                         #
+"""  content-addressed render cache      """
+#                                         #
+# *****************************************
+
+import os
+import json
+import socket
+import threading
+import shutil
+import hashlib
+import filecmp
+import tempfile
+from datetime import date, MAXYEAR
+
+def render_key(*parts):
+    """return the canonical hash of a render, given all the values it depends on
+
+    Parts are serialized by C{repr()}, so they should be built from strings, numbers,
+    tuples, sorted lists and L{lib.theme.Record} objects.
+
+    @rtype: str
+    """
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+def holidays_in_range(provider, year, month, span, margin = 14):
+    """return the holiday data of a month range, as used by the layouts
+
+    Days up to I{margin} days before and after the range are included, since layouts
+    may also draw days of adjacent months.
+
+    @param provider: L{lib.holiday.HolidayProvider} object
+    @rtype: tuple
+    """
+    y2, m2 = divmod(month - 1 + span, 12)
+    end = date(year + y2, m2 + 1, 1).toordinal() if year + y2 <= MAXYEAR else date.max.toordinal() + 1
+    # clamp the margin to the valid date range
+    o1 = max(date(year, month, 1).toordinal() - margin, date.min.toordinal())
+    o2 = min(end + margin, date.max.toordinal() + 1)
+    result = []
+    for o in range(o1, o2):
+        d = date.fromordinal(o)
+        result.append(provider(d.year, d.month, d.day, d.weekday()))
+    return tuple(result)
+
+def _link_or_copy(src, dst):
+    """hard-link I{src} as I{dst}, copying it if linking is not possible"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+class RenderCache(object):
+    """local cache of rendered files, indexed by L{render_key}, with size-based LRU eviction
+
+    Each entry is a directory holding the output files of a render and a manifest
+    with their filename suffixes (relative to the output base name), so that a cached
+    render can be reused for any output filename. The modification time of the
+    manifest is the last use time of the entry.
+
+    @ivar path: cache directory
+    @ivar max_size: maximum total size (in bytes) of cached files
+    """
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _entry(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def lookup(self, key):
+        """return the files of cache entry I{key}, marking it as recently used
+
+        @rtype: [(str,str),...]
+        @return: list of (suffix, cached file) tuples, or C{None} on a cache miss
+        """
+        entry = self._entry(key)
+        manifest = os.path.join(entry, self.MANIFEST)
+        try:
+            with open(manifest) as f:
+                suffixes = json.load(f)
+            os.utime(manifest, None)
+        except (IOError, OSError, ValueError):
+            return None
+        files = [(s, os.path.join(entry, str(i))) for i, s in enumerate(suffixes)]
+        if not all(os.path.exists(f) for s, f in files):
+            return None
+        return files
+
+    def store(self, key, base, outfiles):
+        """store files I{outfiles} written for output base name I{base} as entry I{key}
+
+        @rtype: [(str,str),...]
+        @return: list of (suffix, file) tuples for I{outfiles}, as in L{lookup}
+        """
+        entry = self._entry(key)
+        if not os.path.isdir(os.path.dirname(entry)):
+            os.makedirs(os.path.dirname(entry))
+        tmp = tempfile.mkdtemp(dir = os.path.dirname(entry))
+        suffixes = [f[len(base):] for f in outfiles]
+        for i, f in enumerate(outfiles):
+            _link_or_copy(f, os.path.join(tmp, str(i)))
+        with open(os.path.join(tmp, self.MANIFEST), 'w') as f:
+            json.dump(suffixes, f)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # stored concurrently by another process
+            shutil.rmtree(tmp, ignore_errors = True)
+        self.evict()
+        return list(zip(suffixes, outfiles))
+
+    def evict(self):
+        """remove least recently used entries until the cache fits in L{max_size}"""
+        entries = []
+        total = 0
+        for sub in os.listdir(self.path):
+            subdir = os.path.join(self.path, sub)
+            if not os.path.isdir(subdir): continue
+            for key in os.listdir(subdir):
+                entry = os.path.join(subdir, key)
+                try:
+                    used = os.path.getmtime(os.path.join(entry, self.MANIFEST))
+                    size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                except OSError:
+                    continue
+                entries.append((used, size, entry))
+                total += size
+        entries.sort()
+        while total > self.max_size and entries:
+            used, size, entry = entries.pop(0)
+            shutil.rmtree(entry, ignore_errors = True)
+            total -= size
+
+class ValueCache(object):
+    """local cache of small JSON-serializable values, indexed by L{render_key}
+
+    Each value is kept in its own file, written to a temporary file (named after the host
+    process and thread) and then renamed, so that readers never see partial entries; the cache
+    can thus be shared by concurrent processes, even on different hosts sharing a filesystem.
+
+    @ivar path: cache directory
+    """
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path): raise
+
+    def _entry(self, key):
+        return os.path.join(self.path, key[:2], key + '.json')
+
+    def get(self, key):
+        """return the value of entry I{key}, or C{None} on a cache miss"""
+        try:
+            with open(self._entry(key)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, key, value):
+        """store I{value} as entry I{key}, replacing any previous value"""
+        entry = self._entry(key)
+        d = os.path.dirname(entry)
+        if not os.path.isdir(d):
+            try:
+                os.makedirs(d)
+            except OSError:
+                if not os.path.isdir(d): raise
+        tmp = "%s.%s.%d.%d.tmp" % (entry, socket.gethostname(), os.getpid(), threading.get_ident())
+        with open(tmp, 'w') as f:
+            json.dump(value, f)
+        os.replace(tmp, entry)
+
+def install(files, base):
+    """install cached files as outputs with base name I{base}
+
+    Outputs already identical to the cached files are left untouched, so that they
+    keep their modification time; others are replaced atomically by a hard link (or copy).
+
+    @param files: list of (suffix, cached file) tuples, as returned by L{RenderCache.lookup}
+    @rtype: [str,...]
+    @return: list of output files
+    """
+    result = []
+    for suffix, src in files:
+        dst = base + suffix
+        if not (os.path.exists(dst) and filecmp.cmp(src, dst, shallow = False)):
+            tmp = "%s.%d.tmp" % (dst, os.getpid())
+            _link_or_copy(src, tmp)
+            os.replace(tmp, dst)
+        result.append(dst)
+    return result
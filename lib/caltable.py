@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+#    callirhoe - high quality calendar rendering
+#    Copyright (C) 2012-2020 George M. Tzoumas
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see http://www.gnu.org/licenses/
+
+# *****************************************
+#                                         #
+"""   precomputed calendar arithmetic     """
+#                                         #
+# *****************************************
+
+from array import array
+from datetime import date, MINYEAR, MAXYEAR
+
+class CalendarTable(object):
+    """month and day tables for a month range, computed at once
+
+    Months are indexed by I{year*12 + month - 1}, days by ordinal. The table also
+    covers I{margin} months before and after the range, so that days of adjacent
+    months (phantom days) can be looked up as well, as far as they lie within
+    C{datetime.MINYEAR} and C{datetime.MAXYEAR}.
+
+    @ivar base: index of the first month in the table
+    @ivar first_ordinal: ordinal of the first day in the table
+    @ivar first_weekday: array of the weekday (0=Monday) of the 1st of each month
+    @ivar length: array of the number of days of each month
+    @ivar weeks: array of the ISO week number of each day
+    @ivar dates: list of C{datetime.date} objects of each day
+    """
+    def __init__(self, year, month, span, margin = 1):
+        k1 = year*12 + month - 1
+        before = max(0, min(margin, k1 - MINYEAR*12))
+        after = max(0, min(margin, MAXYEAR*12 + 11 - (k1 + span - 1)))
+        self.base = k1 - before
+        n = span + before + after
+        # the month after December of MAXYEAR starts right after date.max
+        firsts = array('l', (date((self.base + k)//12, (self.base + k)%12 + 1, 1).toordinal()
+                             if self.base + k < (MAXYEAR + 1)*12 else date.max.toordinal() + 1
+                             for k in range(n + 1)))
+        self.first_ordinal = o1 = firsts[0]
+        self.first_weekday = array('b', ((o - 1) % 7 for o in firsts[:n]))
+        self.length = array('b', (firsts[k+1] - firsts[k] for k in range(n)))
+        self._offsets = array('l', (o - o1 for o in firsts))
+        self.dates = [date.fromordinal(o) for o in range(o1, firsts[n])]
+        # one isocalendar() call per week, starting from the Monday on or before o1
+        self.weeks = array('b')
+        monday = o1 - self.first_weekday[0]
+        while monday < firsts[n]:
+            self.weeks.extend((date.fromordinal(monday).isocalendar()[1],)*7)
+            monday += 7
+        del self.weeks[:self.first_weekday[0]]
+        del self.weeks[len(self.dates):]
+
+    def monthrange(self, year, month):
+        """return weekday of first day and number of days of a month, as C{calendar.monthrange()}
+
+        @rtype: (int,int)
+        """
+        k = year*12 + month - 1 - self.base
+        return (self.first_weekday[k], self.length[k])
+
+    def weekrows(self, year, month):
+        """return the number of Monday-Sunday ranges (or subsets of) that a month contains, which are 4, 5 or 6
+
+        @rtype: int
+        """
+        k = year*12 + month - 1 - self.base
+        return (self.first_weekday[k] + self.length[k] + 6)//7
+
+    def _index(self, year, month, dom):
+        """return the index in L{dates} of day I{dom} of a month, or -1 if it is not in the table
+
+        @rtype: int
+        """
+        k = year*12 + month - 1 - self.base
+        if not 0 <= k < len(self.length): return -1
+        i = self._offsets[k] + dom - 1
+        return i if 0 <= i < len(self.dates) else -1
+
+    def has_date(self, year, month, dom):
+        """return C{True} if day I{dom} of a month (see L{date}) is in the table
+
+        @rtype: bool
+        """
+        return self._index(year, month, dom) >= 0
+
+    def date(self, year, month, dom):
+        """return the date of day I{dom} of a month; I{dom} may lie outside the month
+        (e.g. 0 is the last day of the previous month)
+
+        @raise ValueError: if the day is not in the table
+        @rtype: datetime.date
+        """
+        i = self._index(year, month, dom)
+        if i < 0:
+            raise ValueError("day %d of month %d/%d out of calendar table range" % (dom, month, year))
+        return self.dates[i]
+
+    def iso_week(self, d):
+        """return the ISO week number of date I{d}, as C{d.isocalendar()[1]}
+
+        @rtype: int
+        """
+        return self.weeks[d.toordinal() - self.first_ordinal]
@@ -22,7 +22,24 @@
 #                                         #
 # *****************************************
 
+import os
+import sys
+import struct
+import hashlib
+import re
+import calendar
+from array import array
 from datetime import date, timedelta
+from collections import OrderedDict
+try:
+    from . import ical
+except ImportError:  # run as a script
+    import ical
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 def _get_orthodox_easter(year):
     """compute date of orthodox easter
@@ -54,6 +71,70 @@ def _get_catholic_easter(year):
     emonth,edate = divmod(h + l - 7*m + 114,31)
     return date(year, emonth, edate+1)
 
+def _feast_ordinals(y):
+    """compute the day ordinals of orthodox easter, catholic easter and St George's day
+    (orthodox calendar) of year I{y}, with the same arithmetic as L{_get_orthodox_easter}
+    and L{_get_catholic_easter}
+
+    Only integer arithmetic is used, so I{y} can be an int or a numpy integer array,
+    computing all years at once.
+
+    @rtype: (int,int,int)
+    """
+    leap = (y % 4 == 0) & (y % 100 != 0) | (y % 400 == 0)
+    jan0 = 365*(y - 1) + (y - 1)//4 - (y - 1)//100 + (y - 1)//400   # ordinal of Dec 31 of y-1
+    # orthodox
+    y4 = (19*(y % 19) + 15) % 30
+    y5 = (2*(y % 4) + 4*(y % 7) + 6*(y4 + 1)) % 7
+    orth = jan0 + 90 + leap + 4 + y4 + y5
+    # St George, moved after easter if it falls on or before it
+    apr23 = jan0 + 113 + leap
+    george = apr23 + (orth >= apr23)*(orth + 1 - apr23)
+    # catholic
+    a, b, c = y % 19, y // 100, y % 100
+    d, e = b // 4, b % 4
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19*a + b - d - g + 15) % 30
+    i, k = c // 4, c % 4
+    l = (32 + 2*e + 2*i - h - k) % 7
+    m = (a + 11*h + 22*l) // 451
+    n = h + l - 7*m + 114
+    cath = jan0 + 59 + leap + 31*(n//31 - 3) + n % 31 + 1
+    return (orth, cath, george)
+
+def movable_feasts(year1, year2):
+    """compute movable feast tables for years I{year1} up to (excluding) I{year2}, in one
+    vectorized pass if numpy is available
+
+    @rtype: ([int,...],[int,...],[int,...])
+    @return: lists of day ordinals of orthodox easter, catholic easter and St George's day
+    (see L{_feast_ordinals}), indexed by I{year-year1}
+    """
+    if numpy is not None:
+        return tuple(z.tolist() for z in _feast_ordinals(numpy.arange(year1, year2, dtype=numpy.int64)))
+    return tuple(map(list, zip(*[_feast_ordinals(y) for y in range(year1, year2)])))
+
+_FEAST_BLOCK = 400
+_feast_blocks = dict()
+"""movable feast tables computed so far, in blocks of L{_FEAST_BLOCK} years, indexed by block number"""
+
+def _feasts_of_year(y):
+    """return orthodox easter, catholic easter and St George's day of year I{y}, looking
+    them up in L{_feast_blocks}
+
+    @rtype: (datetime.date,datetime.date,datetime.date)
+    """
+    blk, i = divmod(y, _FEAST_BLOCK)
+    tables = _feast_blocks.get(blk)
+    if tables is None:
+        y1 = max(1, blk*_FEAST_BLOCK)
+        tables = movable_feasts(y1, min((blk + 1)*_FEAST_BLOCK, 10000))
+        if y1 > blk*_FEAST_BLOCK:  # year 0 does not exist
+            tables = tuple([None] + z for z in tables)
+        _feast_blocks[blk] = tables
+    return tuple(date.fromordinal(z[i]) for z in tables)
+
 def _strip_empty(sl):
     """strip empty strings from list I{sl}
 
@@ -96,6 +177,7 @@ class Holiday(object):
         self.header_list = _strip_empty(header)
         self.footer_list = _strip_empty(footer)
         self.flags = self._parse_flags(flags_str)
+        self._strings = None
 
     def merge_with(self, hol_list):
         """merge a list of holiday objects into this object"""
@@ -103,20 +185,31 @@ class Holiday(object):
             self.header_list.extend(hol.header_list)
             self.footer_list.extend(hol.footer_list)
             self.flags |= hol.flags
+        self._strings = None
+
+    def strings(self):
+        """return the comma-separated strings for L{header_list} and L{footer_list},
+        computed once after the last merge
+
+        @rtype: (str,str)
+        """
+        if self._strings is None:
+            self._strings = (_flatten(self.header_list), _flatten(self.footer_list))
+        return self._strings
 
     def header(self):
         """return a comma-separated string for L{header_list}
 
         @rtype: str
         """
-        return _flatten(self.header_list)
+        return self.strings()[0]
 
     def footer(self):
         """return a comma-separated string for L{footer_list}
 
         @rtype: str
         """
-        return _flatten(self.footer_list)
+        return self.strings()[1]
 
     def __str__(self):
         """string representation for debugging purposes
@@ -164,6 +257,78 @@ def _decode_date_str(ddef):
         return (int(ddef[:4]),int(ddef[4:6]),int(ddef[-2:]))
     raise ValueError("invalid date definition '%s'" % ddef)
 
+_ANNUAL, _MONTHLY, _FIXED, _ORTH_EASTER, _GEORGE, _CATH_EASTER = range(6)
+
+_COMPILED_MAGIC = b'CHD' + (b'l' if sys.byteorder == 'little' else b'b')
+_COMPILED_HEADER = struct.Struct('=4sqq32sii')
+"""compiled holiday file header: magic, source size, source mtime (ns), source sha256,
+number of records, size of string table"""
+
+def _write_compiled(path, key, records):
+    """write holiday I{records} in compiled form
+
+    The file consists of L{_COMPILED_HEADER}, an int32 table of 6 entries per record
+    (with strings replaced by string table indices, -1 for C{None}) and a string table
+    of NUL-terminated UTF-8 strings.
+
+    @param key: tuple (size,mtime,sha256) of the source file
+    """
+    strings = dict()
+    table = array('i')
+    for rec in records:
+        table.extend(rec[:3])
+        for s in rec[3:]:
+            table.append(-1 if s is None else strings.setdefault(s, len(strings)))
+    strtab = ''.join(t + '\0' for t in sorted(strings, key=strings.get)).encode('utf-8')
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(_COMPILED_HEADER.pack(_COMPILED_MAGIC, key[0], key[1], key[2], len(records), len(strtab)))
+        f.write(table.tobytes())
+        f.write(strtab)
+    os.replace(tmp, path)
+
+def _read_compiled(path):
+    """read a compiled holiday file written by L{_write_compiled}
+
+    @rtype: (int,int,bytes,[(int,int,int,str,str,str),...])
+    @return: tuple (size,mtime,sha256,records), or C{None} if I{path} is missing or invalid
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except (IOError, OSError):
+        return None
+    if len(data) < _COMPILED_HEADER.size: return None
+    magic, size, mtime, digest, nrec, nstr = _COMPILED_HEADER.unpack_from(data)
+    start = _COMPILED_HEADER.size
+    end = start + 24*nrec
+    if magic != _COMPILED_MAGIC or len(data) != end + nstr: return None
+    if nstr and data[-1:] != b'\0': return None
+    try:
+        strings = data[end:-1].decode('utf-8').split('\0') if nstr else []
+    except UnicodeDecodeError:
+        return None
+    table = array('i', data[start:end])
+    if any(i >= len(strings) for i in table[3::6] + table[4::6] + table[5::6]): return None
+    def _str(i): return None if i < 0 else strings[i]
+    records = [(table[k], table[k+1], table[k+2], _str(table[k+3]), _str(table[k+4]), _str(table[k+5]))
+               for k in range(0, len(table), 6)]
+    return (size, mtime, digest, records)
+
+def _annotate_range(events, seq, dt1, dt2, hols, first, last):
+    """add the days of multi-day event I{dt1}-I{dt2} that lie in I{first}-I{last} to dict I{events}
+    (indexed by C{date()}, holding lists of I{(seq,Holiday)} tuples), with begin/end/first-of-month
+    markers from I{hols} (see L{HolidayProvider._multi_holiday_tuple})"""
+    dt = max(dt1, first)
+    last = min(dt2, last)
+    while dt <= last:
+        if dt == dt1: hol = hols[0]
+        elif dt == dt2: hol = hols[1]
+        elif dt.day == 1: hol = hols[2]
+        else: hol = hols[3]
+        events.setdefault(dt, []).append((seq, hol))
+        dt += timedelta(1)
+
 class HolidayProvider(object):
     """class holding the holidays throught the year(s)
 
@@ -171,7 +336,15 @@ class HolidayProvider(object):
     each dict entry is actually a list of L{Holiday} objects. This is also true for the other
     instance variables: L{monthly}, L{fixed}, L{orth_easter}, L{george}, L{cath_easter}.
     @ivar monthly: event occuring monthly, indexed by int I{day}
-    @ivar fixed: fixed date events, indexed by a C{date()} object
+    @ivar fixed: fixed date (single-day) events, indexed by a C{date()} object; list entries
+    are I{(seq,Holiday)} tuples, where I{seq} is the loading order of the event
+    @ivar fixed_years: dates of L{fixed} events, indexed by year
+    @ivar multi: multi-day fixed date events, as a list of I{(seq,date1,date2,hols)} intervals,
+    where I{hols} is a tuple returned by L{_multi_holiday_tuple}
+    @ivar multi_years: intervals of L{multi} overlapping each year, indexed by year
+    @ivar recurring: recurring events (from iCalendar files), as a list of I{(seq,rule,span,hol)}
+    tuples, where I{rule} is a L{lib.ical.RecurrenceRule}, I{span} the duration in days and I{hol}
+    a L{Holiday} object (or a L{_multi_holiday_tuple} if I{span}>1)
     @ivar orth_easter: dict of events relative to the orthodox easter Sunday, indexed by
     an integer days offset
     @ivar george: events occuring on St George's day (orthodox calendar special computation)
@@ -179,11 +352,14 @@ class HolidayProvider(object):
     an integer days offset
     @ivar cache: for each year requested, all holidays occuring
     within that year (annual, monthly, easter-based etc.) are precomputed and stored into
-    dict C{cache}, indexed by a C{date()} object
-    @ivar ycache: set holding cached years; each new year requested, triggers a cache-fill
-    operation
+    a dict indexed by a C{date()} object; C{cache} holds these dicts, indexed by year, in
+    least recently used order
+    @ivar cache_years: maximum number of years kept in L{cache}
+    @ivar cache_hits: number of lookups of a year already in L{cache}
+    @ivar cache_misses: number of lookups that triggered a cache-fill operation
     """
-    def __init__(self, s_normal, s_weekend, s_holiday, s_weekend_holiday, s_multi, s_weekend_multi, multiday_markers=True):
+    def __init__(self, s_normal, s_weekend, s_holiday, s_weekend_holiday, s_multi, s_weekend_multi, multiday_markers=True,
+                 cache_years=16):
         """initialize a C{HolidayProvider} object
 
         @param s_normal: style class object for normal (weekday) day cells
@@ -194,15 +370,23 @@ class HolidayProvider(object):
         @param s_weekend_multi: style for multi-day holiday weekend cells
         @param multiday_markers: if C{True}, then use end-of-multiday-holiday markers and range markers (with dots),
         otherwise only first day and first-day-of-month are marked
+        @param cache_years: see L{cache_years}
         """
         self.annual = dict() # key = (d,m)
         self.monthly = dict() # key = d
         self.fixed = dict() # key = date()
+        self.fixed_years = dict() # key = year
+        self.multi = []
+        self.multi_years = dict() # key = year
+        self.recurring = []
+        self._seq = 0
         self.orth_easter = dict() # key = daysdelta
         self.george = [] # key = n/a
         self.cath_easter = dict() # key = daysdelta
-        self.cache = dict() # key = date()
-        self.ycache = set() # key = year
+        self.cache = OrderedDict() # key = year, then date()
+        self.cache_years = cache_years
+        self.cache_hits = 0
+        self.cache_misses = 0
         self.s_normal = s_normal
         self.s_weekend = s_weekend
         self.s_holiday = s_holiday
@@ -259,6 +443,21 @@ class HolidayProvider(object):
             res = int(fields[1])
         return (fields[0],res,fields[2],fields[3],fields[4])
 
+    def _add_fixed(self, dt, hol):
+        """add L{Holiday} object I{hol} to the fixed date events of C{date()} I{dt}"""
+        if dt not in self.fixed:
+            self.fixed[dt] = []
+            self.fixed_years.setdefault(dt.year, []).append(dt)
+        self.fixed[dt].append((self._seq, hol))
+
+    def _add_multi(self, dt1, dt2, hols):
+        """add a multi-day event from I{dt1} to I{dt2} (inclusive), annotated by the
+        L{Holiday} tuple I{hols} (see L{_multi_holiday_tuple})"""
+        interval = (self._seq, dt1, dt2, hols)
+        self.multi.append(interval)
+        for y in range(dt1.year, dt2.year + 1):
+            self.multi_years.setdefault(y, []).append(interval)
+
     def _multi_holiday_tuple(self, header, footer, flags):
         """returns a 4-tuple of L{Holiday} objects representing (beginning, end, first-day-of-month, rest)
 
@@ -283,7 +482,7 @@ class HolidayProvider(object):
             footer_tuple = (None, None, None, None)
         return tuple([Holiday([header_tuple[k]], [footer_tuple[k]], flags) for k in range(4)])
 
-    def load_holiday_file(self, filename):
+    def load_holiday_file(self, filename, cache_dir = None):
         """load a holiday file into the C{HolidayProvider} object
 
         B{File Format:}
@@ -301,6 +500,8 @@ class HolidayProvider(object):
 
         I{date*span} and range I{date1-date2} supported only for I{date}=YYYYMMDD (fixed) events
 
+        Files with an C{.ics} extension are read as iCalendar files instead, see L{_add_ics_event}.
+
         I{flags:} comma-separated list of the following:
             1. off
             2. multi
@@ -316,7 +517,87 @@ class HolidayProvider(object):
             d|20130223-20130310|winter vacations (B)||multi
 
         @param filename: file to be loaded
+        @param cache_dir: if given, parsed files are kept in compiled form in this directory
+        (see L{_load_compiled}) and reused while the file does not change
+        """
+        if filename.lower().endswith('.ics'):
+            self._load_ics(filename)
+            return
+        if cache_dir:
+            records = self._load_compiled(filename, cache_dir)
+        else:
+            records = self._read_holiday_records(filename)
+        for rec in records:
+            self._add_record(*rec)
+
+    def _load_ics(self, filename):
+        """load the events of an iCalendar file
+
+        Events are read one at a time; events that cannot be handled are reported to the
+        standard error and skipped.
+        """
+        with open(filename, 'r') as f:
+            for event in ical.read_events(f):
+                try:
+                    self._add_ics_event(event)
+                except (ValueError, KeyError, IndexError) as e:
+                    summary = event.get('SUMMARY', [(None, '?')])[0][1]
+                    print("callirhoe: %s: skipping event '%s': %s" % (filename, summary, e), file=sys.stderr)
+
+    def _add_ics_event(self, event):
+        """add a VEVENT, as returned by L{lib.ical.read_events}
+
+        SUMMARY becomes the header and X-CALLIRHOE-FOOTER the footer. Flags are taken from
+        X-CALLIRHOE-FLAGS if present; otherwise C{off} is set for events with a HOLIDAY or OFF
+        category, C{reminder} for transparent events and C{multi} for multi-day events.
+        Recurring events (RRULE, with EXDATE) are kept in L{recurring}; RDATE is not supported.
+        """
+        def _text(name):
+            return ical.unescape(event[name][0][1]) or None if name in event else None
+        dt1, midnight = ical.parse_date(event['DTSTART'][0][1])
+        dt2 = dt1
+        if 'DTEND' in event:
+            end, midnight = ical.parse_date(event['DTEND'][0][1])
+            dt2 = max(dt1, end - timedelta(1) if midnight else end)
+        elif 'DURATION' in event:
+            m = re.match(r'P(?:(\d+)W)?(?:(\d+)D)?', event['DURATION'][0][1])
+            days = 7*int(m.group(1) or 0) + int(m.group(2) or 0)
+            dt2 = dt1 + timedelta(max(0, days - 1))
+        header = _text('SUMMARY')
+        footer = _text('X-CALLIRHOE-FOOTER')
+        if 'X-CALLIRHOE-FLAGS' in event:
+            flags = event['X-CALLIRHOE-FLAGS'][0][1]
+        else:
+            categories = set(c.strip().upper() for p, v in event.get('CATEGORIES', []) for c in v.split(','))
+            flags = []
+            if categories & set(['HOLIDAY', 'OFF']): flags.append('off')
+            if _text('TRANSP') == 'TRANSPARENT': flags.append('reminder')
+            if dt2 > dt1: flags.append('multi')
+            flags = ','.join(flags)
+        if 'RRULE' not in event:
+            self._add_record(_FIXED, dt1.toordinal(), dt2.toordinal(), footer, header, flags)
+            return
+        exdates = [ical.parse_date(v)[0] for p, val in event.get('EXDATE', []) for v in val.split(',')]
+        rule = ical.resolve_until(event['RRULE'][0][1], event['DTSTART'][0][1])
+        self._add_recurring(rule, dt1, exdates, (dt2 - dt1).days + 1, footer, header, flags)
+
+    def _add_recurring(self, rule, dtstart, exdates, span, footer, header, flags):
+        """add a recurring event of I{span} days, with RRULE value I{rule}, to L{recurring}"""
+        rule = ical.RecurrenceRule(rule, dtstart, exdates)
+        self._seq += 1
+        hol = self._multi_holiday_tuple(header, footer, flags) if span > 1 else Holiday([header], [footer], flags)
+        self.recurring.append((self._seq, rule, span, hol))
+
+    def _read_holiday_records(self, filename):
+        """parse a holiday file into a list of records I{(kind,a,b,footer,header,flags)}
+
+        I{kind} is one of C{_ANNUAL} (I{a}=month, I{b}=day), C{_MONTHLY} (I{b}=day),
+        C{_FIXED} (I{a},I{b}=first and last day ordinal), C{_ORTH_EASTER}, C{_CATH_EASTER}
+        (I{a}=offset in days) and C{_GEORGE}.
+
+        @rtype: [(int,int,int,str,str,str),...]
         """
+        records = []
         with open(filename, 'r') as f:
             for line in f:
                 line = line.strip()
@@ -324,93 +605,184 @@ class HolidayProvider(object):
                 if line[0] == '#': continue
                 fields = line.split('|')
                 etype,ddef,footer,header,flags = self._parse_day_record(fields)
-                hol = Holiday([header], [footer], flags)
                 if etype == 'd':
                     if len(ddef) == 1:
                         y,m,d = ddef[0]
                         if m > 0:           # annual event
-                            if (d,m) not in self.annual: self.annual[(d,m)] = []
-                            self.annual[(d,m)].append(hol)
+                            records.append((_ANNUAL, m, d, footer, header, flags))
                         else:               # monthly event
-                            if d not in self.monthly: self.monthly[d] = []
-                            self.monthly[d].append(hol)
+                            records.append((_MONTHLY, 0, d, footer, header, flags))
                     else:                   # fixed date event
-                        dt1,dt2 = date(*ddef[0]),date(*ddef[1])
-                        span = (dt2-dt1).days + 1
-                        if span == 1:
-                            if dt1 not in self.fixed: self.fixed[dt1] = []
-                            self.fixed[dt1].append(hol)
-                        else:
-                            # properly annotate multi-day events
-                            hols = self._multi_holiday_tuple(header, footer, flags)
-                            dt = dt1
-                            while dt <= dt2:
-                                if dt not in self.fixed: self.fixed[dt] = []
-                                if dt == dt1: hol = hols[0]
-                                elif dt == dt2: hol = hols[1]
-                                elif dt.day == 1: hol = hols[2]
-                                else: hol = hols[3]
-                                self.fixed[dt].append(hol)
-                                dt += timedelta(1)
-
+                        records.append((_FIXED, date(*ddef[0]).toordinal(), date(*ddef[1]).toordinal(),
+                                        footer, header, flags))
                 elif etype == 'oe':
-                    d = ddef
-                    if d not in self.orth_easter: self.orth_easter[d] = []
-                    self.orth_easter[d].append(hol)
+                    records.append((_ORTH_EASTER, ddef, 0, footer, header, flags))
                 elif etype == 'ge':
-                    self.george.append(hol)
+                    records.append((_GEORGE, 0, 0, footer, header, flags))
                 elif etype == 'ce':
-                    d = ddef
-                    if d not in self.cath_easter: self.cath_easter[d] = []
-                    self.cath_easter[d].append(hol)
+                    records.append((_CATH_EASTER, ddef, 0, footer, header, flags))
+        return records
+
+    def _load_compiled(self, filename, cache_dir):
+        """return the records of holiday file I{filename}, as L{_read_holiday_records}, using
+        its compiled form in I{cache_dir}
+
+        The compiled file is named after the absolute path of I{filename}, and is valid while
+        the size and modification time of I{filename} match the ones stored in it, or else,
+        while the content hash matches. Otherwise, I{filename} is parsed and compiled again.
+
+        @rtype: [(int,int,int,str,str,str),...]
+        """
+        st = os.stat(filename)
+        path = os.path.join(cache_dir, hashlib.sha256(os.path.abspath(filename).encode('utf-8')).hexdigest()[:32] + '.hc')
+        compiled = _read_compiled(path)
+        if compiled is not None:
+            size, mtime, digest, records = compiled
+            if (size, mtime) == (st.st_size, st.st_mtime_ns):
+                return records
+        with open(filename, 'rb') as f:
+            content_digest = hashlib.sha256(f.read()).digest()
+        if compiled is None or digest != content_digest:
+            records = self._read_holiday_records(filename)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        _write_compiled(path, (st.st_size, st.st_mtime_ns, content_digest), records)
+        return records
+
+    def _add_record(self, kind, a, b, footer, header, flags):
+        """add a holiday record, as returned by L{_read_holiday_records}"""
+        self._seq += 1
+        hol = Holiday([header], [footer], flags)
+        if kind == _ANNUAL:
+            if (b,a) not in self.annual: self.annual[(b,a)] = []
+            self.annual[(b,a)].append(hol)
+        elif kind == _MONTHLY:
+            if b not in self.monthly: self.monthly[b] = []
+            self.monthly[b].append(hol)
+        elif kind == _FIXED:
+            if a == b:
+                self._add_fixed(date.fromordinal(a), hol)
+            elif a < b:
+                # multi-day events are annotated when a year is requested
+                self._add_multi(date.fromordinal(a), date.fromordinal(b),
+                                self._multi_holiday_tuple(header, footer, flags))
+        elif kind == _ORTH_EASTER:
+            if a not in self.orth_easter: self.orth_easter[a] = []
+            self.orth_easter[a].append(hol)
+        elif kind == _GEORGE:
+            self.george.append(hol)
+        elif kind == _CATH_EASTER:
+            if a not in self.cath_easter: self.cath_easter[a] = []
+            self.cath_easter[a].append(hol)
+
+    def _year_events(self, y):
+        """return the fixed date, multi-day and recurring events of year I{y}, not yet merged
+
+        @rtype: dict
+        @return: dict of lists of (seq, L{Holiday}) tuples, indexed by C{date()} objects
+        """
+        # fixed, merged in loading order
+        events = dict((dt, list(self.fixed[dt])) for dt in self.fixed_years.get(y, ()))
+        # multi-day, clipped to year y, properly annotated
+        jan1, dec31 = date(y,1,1), date(y,12,31)
+        for seq, dt1, dt2, hols in self.multi_years.get(y, ()):
+            _annotate_range(events, seq, dt1, dt2, hols, jan1, dec31)
+        # recurring (iCalendar), expanded for year y only
+        for seq, rule, span, hols in self.recurring:
+            for y0 in range(date.fromordinal(max(jan1.toordinal() - span + 1, 1)).year, y + 1):
+                for dt1 in rule.occurrences(y0):
+                    dt2 = date.fromordinal(min(dt1.toordinal() + span - 1, date.max.toordinal()))
+                    if dt2 < jan1: continue
+                    if span == 1:
+                        events.setdefault(dt1, []).append((seq, hols))
+                    else:
+                        _annotate_range(events, seq, dt1, dt2, hols, jan1, dec31)
+        return events
+
+    def _year_holidays(self, y, events = None):
+        """return a dict of all holidays that belong in year I{y}, indexed by C{date()} objects
+
+        @param events: events to use instead of L{_year_events}(y)
+        @rtype: dict
+        """
+        if events is None: events = self._year_events(y)
+        ycache = dict()
+        # annual
+        for d0,m0 in self.annual:
+            dt = date(y,m0,d0)
+            if not dt in ycache: ycache[dt] = Holiday()
+            ycache[dt].merge_with(self.annual[(d0,m0)])
+        # monthly
+        for d0 in self.monthly:
+          for m0 in range(1,13):
+            dt = date(y,m0,d0)
+            if not dt in ycache: ycache[dt] = Holiday()
+            ycache[dt].merge_with(self.monthly[m0])
+        # fixed date, multi-day and recurring, merged in loading order
+        for dt in events:
+            if not dt in ycache: ycache[dt] = Holiday()
+            ycache[dt].merge_with([hol for seq, hol in sorted(events[dt], key=lambda z: z[0])])
+        # orthodox easter
+        edt, cath_edt, george_dt = _feasts_of_year(y)
+        for delta in self.orth_easter:
+            dt = edt + timedelta(delta)
+            if not dt in ycache: ycache[dt] = Holiday()
+            ycache[dt].merge_with(self.orth_easter[delta])
+        # Georgios day
+        if self.george:
+            dt = george_dt  # moved after easter if edt >= 23/4 (>= or > ??)
+            if not dt in ycache: ycache[dt] = Holiday()
+            ycache[dt].merge_with(self.george)
+        # catholic easter
+        edt = cath_edt
+        for delta in self.cath_easter:
+            dt = edt + timedelta(delta)
+            if not dt in ycache: ycache[dt] = Holiday()
+            ycache[dt].merge_with(self.cath_easter[delta])
+        return ycache
 
     def get_holiday(self, y, m, d):
         """return a L{Holiday} object for the specified date (y,m,d) or C{None} if no holiday is defined
 
         @rtype: Holiday
-        @note: If year I{y} has not been requested before, the cache is updated first
-        with all holidays that belong in I{y}, indexed by C{date()} objects.
+        @note: If year I{y} is not in the cache, the cache is updated first
+        with all holidays that belong in I{y}, evicting the least recently used year
+        if the cache holds more than L{cache_years} years.
+        """
+        return self._year_cache(y).get(date(y,m,d))
+
+    def _year_cache(self, y):
+        """return the L{cache} entry of year I{y}, filling it first if needed
+
+        @rtype: dict
+        """
+        ycache = self.cache.get(y)
+        if ycache is None:
+            self.cache_misses += 1
+            ycache = self.cache[y] = self._year_holidays(y)
+            if len(self.cache) > self.cache_years:
+                self.cache.popitem(last=False)
+        else:
+            self.cache_hits += 1
+            self.cache.move_to_end(y)
+        return ycache
+
+    def _day_map(self, year, month):
+        """return a dict holding (at least) the holidays of a month, indexed by C{date()}
+
+        @rtype: dict
         """
-        if y not in self.ycache:
-            # fill-in events for year y
-            # annual
-            for d0,m0 in self.annual:
-                dt = date(y,m0,d0)
-                if not dt in self.cache: self.cache[dt] = Holiday()
-                self.cache[dt].merge_with(self.annual[(d0,m0)])
-            # monthly
-            for d0 in self.monthly:
-              for m0 in range(1,13):
-                dt = date(y,m0,d0)
-                if not dt in self.cache: self.cache[dt] = Holiday()
-                self.cache[dt].merge_with(self.monthly[m0])
-            # fixed
-            for dt in [z for z in self.fixed if z.year == y]:
-                if not dt in self.cache: self.cache[dt] = Holiday()
-                self.cache[dt].merge_with(self.fixed[dt])
-            # orthodox easter
-            edt = _get_orthodox_easter(y)
-            for delta in self.orth_easter:
-                dt = edt + timedelta(delta)
-                if not dt in self.cache: self.cache[dt] = Holiday()
-                self.cache[dt].merge_with(self.orth_easter[delta])
-            # Georgios day
-            if self.george:
-                dt = date(y,4,23)
-                if edt >= dt: dt = edt + timedelta(1)  # >= or > ??
-                if not dt in self.cache: self.cache[dt] = Holiday()
-                self.cache[dt].merge_with(self.george)
-            # catholic easter
-            edt = _get_catholic_easter(y)
-            for delta in self.cath_easter:
-                dt = edt + timedelta(delta)
-                if not dt in self.cache: self.cache[dt] = Holiday()
-                self.cache[dt].merge_with(self.cath_easter[delta])
-
-            self.ycache.add(y)
-
-        dt = date(y,m,d)
-        return self.cache[dt] if dt in self.cache else None
+        return self._year_cache(year)
+
+    def prefetch(self, year, month, span):
+        """load the holidays of I{span} months starting from I{month} of I{year}, plus
+        one month before and after, ahead of rendering
+
+        Nothing to do here: years are filled into L{cache} on first use, and filling a span
+        longer than L{cache_years} ahead would only evict them before they are drawn.
+        Overridden by providers that can load many months at once.
+        """
+        pass
 
     def get_style(self, flags, dow):
         """return appropriate style object, depending on I{flags} and I{dow}
@@ -435,10 +807,30 @@ class HolidayProvider(object):
         """
         hol = self.get_holiday(year,month,dom)
         if hol:
-            return (hol.header(),hol.footer(),self.get_style(hol.flags,dow))
+            header, footer = hol.strings()
+            return (header,footer,self.get_style(hol.flags,dow))
         else:
             return (None,None,self.get_style(0,dow))
 
+    def month_table(self, year, month):
+        """return the holiday data of all days of a month at once
+
+        @rtype: [(str,str,int,Style),...]
+        @return: list of (header,footer,flags,day_style) tuples, for days 1 up to the end of the month
+        """
+        hols = self._day_map(year, month)
+        dow, ndays = calendar.monthrange(year, month)
+        table = []
+        for d in range(1, ndays + 1):
+            hol = hols.get(date(year,month,d))
+            if hol:
+                header, footer = hol.strings()
+                table.append((header,footer,hol.flags,self.get_style(hol.flags,dow)))
+            else:
+                table.append((None,None,0,self.get_style(0,dow)))
+            dow = (dow + 1) % 7
+        return table
+
 if __name__ == '__main__':
     import sys
     hp = HolidayProvider('n', 'w', 'h', 'wh', 'm', 'wm')
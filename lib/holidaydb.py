@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+#    callirhoe - high quality calendar rendering
+#    Copyright (C) 2012-2020 George M. Tzoumas
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see http://www.gnu.org/licenses/
+
+# *****************************************
+#                                         #
+"""   SQLite-backed holiday provider      """
+#                                         #
+# *****************************************
+
+import os
+import sqlite3
+import calendar
+from datetime import date, MINYEAR, MAXYEAR
+from collections import OrderedDict
+
+from . import ical
+from .holiday import HolidayProvider, Holiday, _FIXED, _annotate_range
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER);
+CREATE TABLE IF NOT EXISTS events (seq INTEGER PRIMARY KEY, source TEXT, kind INTEGER, a INTEGER, b INTEGER,
+    footer TEXT, header TEXT, flags TEXT);
+CREATE TABLE IF NOT EXISTS ranges (seq INTEGER PRIMARY KEY, source TEXT, first INTEGER, last INTEGER,
+    long INTEGER, footer TEXT, header TEXT, flags TEXT);
+CREATE INDEX IF NOT EXISTS ranges_source_first ON ranges (source, long, first);
+CREATE TABLE IF NOT EXISTS recurring (seq INTEGER PRIMARY KEY, source TEXT, rule TEXT, dtstart INTEGER,
+    exdates TEXT, span INTEGER, footer TEXT, header TEXT, flags TEXT);
+CREATE TEMP TABLE loaded (path TEXT PRIMARY KEY, rank INTEGER);
+"""
+
+_SCHEMA_VERSION = 1
+"""version of the imported records, kept in C{PRAGMA user_version}; when a database has an
+older one, all holiday files are imported again"""
+
+_ORDER = "(l.rank << 32) + %s.seq"
+"""SQL expression ordering events of loaded sources in loading order: by the position of
+their source in L{SQLiteHolidayProvider.sources}, then by their order in the source"""
+
+_LONG_SPAN = 64
+"""fixed date events spanning at least this many days are queried separately from short ones,
+so that short ones can be found by an index range scan on their first day"""
+
+def _month_last(y, m):
+    """return the last day of month I{m} of year I{y}
+
+    @rtype: datetime.date
+    """
+    return date(y, m, calendar.monthrange(y, m)[1])
+
+class SQLiteHolidayProvider(HolidayProvider):
+    """holiday provider keeping fixed date events in an SQLite database
+
+    Annual, monthly, easter-based and recurring events are few; they are loaded into memory
+    (see L{HolidayProvider}). Fixed date events (single or multi-day) stay in the database and
+    are queried one month range at a time, so memory use does not depend on their number.
+
+    Holiday files loaded with L{load_holiday_file} are imported into the database, replacing
+    any earlier import of the same file; unchanged files are not imported again. The database
+    may hold other files as well, imported by earlier runs; only events of the files loaded
+    by this object are used.
+
+    @ivar db: C{sqlite3.Connection} object
+    @ivar sources: absolute paths of the holiday files loaded, in loading order
+    @ivar mcache: holidays of recently queried months, indexed by I{(year,month)}, in least
+    recently used order; each entry is a dict indexed by C{date()}
+    @ivar cache_months: maximum number of months kept in L{mcache}
+    """
+    def __init__(self, path, s_normal, s_weekend, s_holiday, s_weekend_holiday, s_multi, s_weekend_multi,
+                 multiday_markers=True, cache_months=36):
+        """initialize a C{SQLiteHolidayProvider} object, creating database I{path} if needed
+
+        see L{HolidayProvider.__init__} for the other parameters
+        """
+        super(SQLiteHolidayProvider, self).__init__(s_normal, s_weekend, s_holiday, s_weekend_holiday,
+                                                    s_multi, s_weekend_multi, multiday_markers)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(_SCHEMA)
+        if self.db.execute("PRAGMA user_version").fetchone()[0] < _SCHEMA_VERSION:
+            with self.db:
+                self.db.execute("DELETE FROM sources")
+            self.db.execute("PRAGMA user_version = %d" % _SCHEMA_VERSION)
+        self.sources = []
+        self.mcache = OrderedDict()
+        self.cache_months = cache_months
+        self._source = None
+        self._rows = None
+        self._load_memory_events()
+
+    def _load_memory_events(self):
+        """load annual, monthly, easter-based and recurring events of the loaded sources from the database"""
+        for row in self.db.execute("SELECT %s,kind,a,b,footer,header,flags FROM events e "
+                                   "JOIN loaded l ON e.source = l.path ORDER BY 1" % (_ORDER % 'e')):
+            self._seq = row[0] - 1
+            HolidayProvider._add_record(self, *row[1:])
+        for row in self.db.execute("SELECT %s,rule,dtstart,exdates,span,footer,header,flags FROM recurring r "
+                                   "JOIN loaded l ON r.source = l.path ORDER BY 1" % (_ORDER % 'r')):
+            self._seq = row[0] - 1
+            exdates = [date.fromordinal(int(z)) for z in row[3].split(',') if z]
+            HolidayProvider._add_recurring(self, row[1], date.fromordinal(row[2]), exdates, *row[4:])
+
+    def load_holiday_file(self, filename, cache_dir = None):
+        """import a holiday file (C{.dat} or C{.ics}) into the database, unless it is unchanged
+        since its last import
+
+        @param cache_dir: see L{HolidayProvider.load_holiday_file}
+        """
+        path = os.path.abspath(filename)
+        st = os.stat(filename)
+        row = self.db.execute("SELECT size,mtime FROM sources WHERE path=?", (path,)).fetchone()
+        if row != (st.st_size, st.st_mtime_ns):
+            self._import(filename, path, st, cache_dir)
+        if path not in self.sources:
+            with self.db:
+                self.db.execute("INSERT INTO loaded VALUES (?,?)", (path, len(self.sources)))
+            self.sources.append(path)
+        # reload in-memory events, including those of this file
+        self._reload()
+
+    def _import(self, filename, path, st, cache_dir):
+        """import holiday file I{filename} into the database, replacing any earlier import
+
+        Records are numbered in file order while the file is read, and given their C{seq}
+        inside the write transaction, after the largest one in the database, so that other
+        processes importing into the same database cannot take the same numbers.
+
+        @param path: absolute path of I{filename}
+        @param st: C{os.stat()} result of I{filename}
+        @param cache_dir: see L{HolidayProvider.load_holiday_file}
+        """
+        self._source = path
+        self._rows = { 'events': [], 'ranges': [], 'recurring': [] }
+        self._seq = 0
+        try:
+            super(SQLiteHolidayProvider, self).load_holiday_file(filename, cache_dir)
+            with self.db:
+                self.db.execute("BEGIN IMMEDIATE")
+                for table in ('events', 'ranges', 'recurring'):
+                    self.db.execute("DELETE FROM %s WHERE source=?" % table, (path,))
+                top = max(self.db.execute("SELECT COALESCE(MAX(seq),0) FROM %s" % table).fetchone()[0]
+                          for table in ('events', 'ranges', 'recurring'))
+                for table, values in (('events', '?,?,?,?,?,?,?,?'), ('ranges', '?,?,?,?,?,?,?,?'),
+                                      ('recurring', '?,?,?,?,?,?,?,?,?')):
+                    self.db.executemany("INSERT INTO %s VALUES (%s)" % (table, values),
+                                        ((top + r[0],) + r[1:] for r in self._rows[table]))
+                self.db.execute("INSERT OR REPLACE INTO sources VALUES (?,?,?)", (path, st.st_size, st.st_mtime_ns))
+        finally:
+            self._source = self._rows = None
+
+    def _reload(self):
+        """clear all in-memory events and caches and load them again from the database"""
+        self.annual.clear(); self.monthly.clear(); self.orth_easter.clear(); self.cath_easter.clear()
+        del self.george[:]
+        del self.recurring[:]
+        self.cache.clear()
+        self.mcache.clear()
+        self._load_memory_events()
+
+    def _add_record(self, kind, a, b, footer, header, flags):
+        """queue a holiday record for insertion into the database"""
+        self._seq += 1
+        if kind == _FIXED:
+            if a <= b:
+                self._rows['ranges'].append((self._seq, self._source, a, b, int(b - a + 1 >= _LONG_SPAN),
+                                             footer, header, flags))
+        else:
+            self._rows['events'].append((self._seq, self._source, kind, a, b, footer, header, flags))
+
+    def _add_recurring(self, rule, dtstart, exdates, span, footer, header, flags):
+        """queue a recurring event for insertion into the database"""
+        ical.RecurrenceRule(rule, dtstart, exdates)  # reject unsupported rules now
+        self._seq += 1
+        self._rows['recurring'].append((self._seq, self._source, rule, dtstart.toordinal(),
+                                        ','.join(str(d.toordinal()) for d in exdates), span, footer, header, flags))
+
+    def _query_ranges(self, o1, o2):
+        """return the fixed date events of the loaded sources overlapping day ordinals I{o1}-I{o2},
+        in loading order
+
+        @rtype: [(int,int,int,str,str,str),...]
+        """
+        select = "SELECT %s,first,last,footer,header,flags FROM ranges r JOIN loaded l ON r.source = l.path " % \
+                 (_ORDER % 'r')
+        return self.db.execute(select + "WHERE long=0 AND first BETWEEN ? AND ? AND last >= ? UNION ALL " +
+                               select + "WHERE long=1 AND first <= ? AND last >= ? ORDER BY 1",
+                               (o1 - _LONG_SPAN + 1, o2, o1, o2, o1)).fetchall()
+
+    def prefetch(self, year, month, span):
+        """load the holidays of I{span} months starting from I{month} of I{year}, plus
+        one month before and after, with a single database query"""
+        k1, k2 = year*12 + month - 2, year*12 + month + span - 1
+        months = [divmod(k, 12) for k in range(k1, k2 + 1)]
+        months = [(y, m + 1) for y, m in months if MINYEAR <= y <= MAXYEAR and (y, m + 1) not in self.mcache]
+        if months:
+            self._fetch_months(months)
+
+    def _fetch_months(self, months):
+        """load the holidays of the I{(year,month)} tuples of sorted list I{months} into L{mcache}
+
+        Least recently used months are evicted afterwards, but never the ones of I{months},
+        even if they are more than L{cache_months}.
+        """
+        first = date(months[0][0], months[0][1], 1)
+        rows = self._query_ranges(first.toordinal(), _month_last(*months[-1]).toordinal())
+        years = OrderedDict()
+        for y, m in months:
+            years.setdefault(y, []).append(m)
+        for y, ymonths in years.items():
+            events = dict((dt, hols) for dt, hols in self._year_events(y).items() if dt.month in ymonths)
+            for m in ymonths:
+                m1, m2 = date(y, m, 1), _month_last(y, m)
+                o1, o2 = m1.toordinal(), m2.toordinal()
+                for seq, a, b, footer, header, flags in rows:
+                    if b < o1 or a > o2: continue
+                    if a == b:
+                        events.setdefault(date.fromordinal(a), []).append((seq, Holiday([header], [footer], flags)))
+                    else:
+                        _annotate_range(events, seq, date.fromordinal(a), date.fromordinal(b),
+                                        self._multi_holiday_tuple(header, footer, flags), m1, m2)
+            ycache = self._year_holidays(y, events)
+            for m in ymonths:
+                self.mcache[(y, m)] = dict((dt, hol) for dt, hol in ycache.items() if dt.month == m)
+        while len(self.mcache) > max(self.cache_months, len(months)):
+            self.mcache.popitem(last=False)
+
+    def _day_map(self, year, month):
+        """return a dict holding the holidays of a month, indexed by C{date()}
+
+        @rtype: dict
+        """
+        mcache = self.mcache.get((year, month))
+        if mcache is None:
+            self._fetch_months([(year, month)])
+            mcache = self.mcache[(year, month)]
+        else:
+            self.mcache.move_to_end((year, month))
+        return mcache
+
+    def get_holiday(self, y, m, d):
+        """return a L{Holiday} object for the specified date (y,m,d) or C{None} if no holiday is defined
+
+        @rtype: Holiday
+        """
+        return self._day_map(y, m).get(date(y,m,d))
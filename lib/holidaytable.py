@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+
+#    callirhoe - high quality calendar rendering
+#    Copyright (C) 2012-2020 George M. Tzoumas
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see http://www.gnu.org/licenses/
+
+# *****************************************
+#                                         #
+"""  compiled holiday tables and queries  """
+#                                         #
+# *****************************************
+
+import os
+import sys
+import csv
+import json
+import struct
+from array import array
+from datetime import date
+try:
+    from .holiday import Holiday, HolidayProvider
+except (ImportError, ValueError):  # run as a script
+    from holiday import Holiday, HolidayProvider
+
+_TABLE_MAGIC = b'CHU' + (b'l' if sys.byteorder == 'little' else b'b')
+_TABLE_HEADER = struct.Struct('=4sqii')
+"""holiday table file header: magic, ordinal of first day, number of days, size of string table"""
+
+CSV_FIELDS = ('date', 'off', 'multi', 'reminder', 'header', 'footer')
+
+class HolidayTable(object):
+    """holidays of a range of days, indexed by day ordinal
+
+    Flags are kept in one bitset per flag, header and footer strings as indices into a
+    shared string table, so that looking up a day costs a few array accesses.
+
+    @ivar first_ordinal: ordinal of the first day in the table
+    @ivar ndays: number of days in the table
+    @ivar off: bitset (C{bytearray}) of days with flag L{Holiday.OFF}
+    @ivar multi: bitset of days with flag L{Holiday.MULTI}
+    @ivar reminder: bitset of days with flag L{Holiday.REMINDER}
+    @ivar header: array of string table indices of the header of each day, -1 for none
+    @ivar footer: array of string table indices of the footer of each day, -1 for none
+    @ivar strings: string table
+    """
+    def __init__(self, first_ordinal, ndays, off, multi, reminder, header, footer, strings):
+        self.first_ordinal = first_ordinal
+        self.ndays = ndays
+        self.off = off
+        self.multi = multi
+        self.reminder = reminder
+        self.header = header
+        self.footer = footer
+        self.strings = strings
+
+    def first_date(self):
+        """return the first day in the table
+
+        @rtype: datetime.date
+        """
+        return date.fromordinal(self.first_ordinal)
+
+    def last_date(self):
+        """return the last day in the table
+
+        @rtype: datetime.date
+        """
+        return date.fromordinal(self.first_ordinal + self.ndays - 1)
+
+    def _index(self, d):
+        """return the table index of date I{d}
+
+        @raise ValueError: if I{d} is not in the table
+        @rtype: int
+        """
+        i = d.toordinal() - self.first_ordinal
+        if not 0 <= i < self.ndays:
+            raise ValueError("date %s out of holiday table range %s - %s" %
+                             (d.isoformat(), self.first_date().isoformat(), self.last_date().isoformat()))
+        return i
+
+    def __contains__(self, d):
+        return 0 <= d.toordinal() - self.first_ordinal < self.ndays
+
+    def _flags(self, i):
+        k, b = i >> 3, i & 7
+        return ((self.off[k] >> b) & 1) * Holiday.OFF | ((self.multi[k] >> b) & 1) * Holiday.MULTI | \
+               ((self.reminder[k] >> b) & 1) * Holiday.REMINDER
+
+    def flags(self, d):
+        """return the holiday flags of date I{d}, as L{Holiday.flags}
+
+        @rtype: int
+        """
+        return self._flags(self._index(d))
+
+    def is_off(self, d):
+        """return C{True} if date I{d} is a day off
+
+        @rtype: bool
+        """
+        i = self._index(d)
+        return bool((self.off[i >> 3] >> (i & 7)) & 1)
+
+    def _row(self, i):
+        h, f = self.header[i], self.footer[i]
+        return (date.fromordinal(self.first_ordinal + i), self._flags(i),
+                self.strings[h] if h >= 0 else None, self.strings[f] if f >= 0 else None)
+
+    def lookup(self, d):
+        """return the holiday data of date I{d}
+
+        @rtype: (datetime.date,int,str,str)
+        @return: tuple (date, flags, header, footer)
+        """
+        return self._row(self._index(d))
+
+    def query_dates(self, dates):
+        """return the holiday data of a batch of dates, as L{lookup}
+
+        @rtype: iterator of (datetime.date,int,str,str)
+        """
+        for d in dates:
+            yield self._row(self._index(d))
+
+    def query_range(self, d1, d2, holidays_only = False):
+        """return the holiday data of dates I{d1} up to (including) I{d2}, as L{lookup}
+
+        @param holidays_only: skip days without flags and strings
+        @rtype: iterator of (datetime.date,int,str,str)
+        """
+        i1, i2 = self._index(d1), self._index(d2)
+        for i in range(i1, i2 + 1):
+            row = self._row(i)
+            if not holidays_only or row[1] or row[2] is not None or row[3] is not None:
+                yield row
+
+    def write(self, path):
+        """write the table to file I{path}
+
+        The file consists of L{_TABLE_HEADER}, the three bitsets, the int32 header
+        and footer index arrays and a string table of NUL-terminated UTF-8 strings.
+        """
+        strtab = ''.join(t + '\0' for t in self.strings).encode('utf-8')
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(_TABLE_HEADER.pack(_TABLE_MAGIC, self.first_ordinal, self.ndays, len(strtab)))
+            f.write(self.off)
+            f.write(self.multi)
+            f.write(self.reminder)
+            f.write(self.header.tobytes())
+            f.write(self.footer.tobytes())
+            f.write(strtab)
+        os.replace(tmp, path)
+
+def _bitset(ndays):
+    return bytearray((ndays + 7) >> 3)
+
+def build_table(provider, year1, year2):
+    """compile the holidays of years I{year1} up to (including) I{year2}
+
+    @param provider: L{HolidayProvider} object
+    @rtype: HolidayTable
+    """
+    o1 = date(year1, 1, 1).toordinal()
+    ndays = date(year2, 12, 31).toordinal() + 1 - o1
+    off, multi, reminder = _bitset(ndays), _bitset(ndays), _bitset(ndays)
+    header, footer = array('i', [-1])*ndays, array('i', [-1])*ndays
+    strings = dict()
+    provider.prefetch(year1, 1, 12*(year2 - year1 + 1))
+    for y in range(year1, year2 + 1):
+        for m in range(1, 13):
+            for dt, hol in provider._day_map(y, m).items():
+                if dt.month != m: continue  # the map may hold other months as well
+                i = dt.toordinal() - o1
+                k, b = i >> 3, 1 << (i & 7)
+                if hol.flags & Holiday.OFF: off[k] |= b
+                if hol.flags & Holiday.MULTI: multi[k] |= b
+                if hol.flags & Holiday.REMINDER: reminder[k] |= b
+                h, f = hol.strings()
+                if h is not None: header[i] = strings.setdefault(h, len(strings))
+                if f is not None: footer[i] = strings.setdefault(f, len(strings))
+    return HolidayTable(o1, ndays, off, multi, reminder, header, footer, sorted(strings, key=strings.get))
+
+def read_table(path):
+    """read a table written by L{HolidayTable.write}
+
+    @raise ValueError: if I{path} is not a valid holiday table file
+    @rtype: HolidayTable
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < _TABLE_HEADER.size:
+        raise ValueError("invalid holiday table file '%s'" % path)
+    magic, o1, ndays, nstr = _TABLE_HEADER.unpack_from(data)
+    nbits = (ndays + 7) >> 3
+    pos = [_TABLE_HEADER.size + k*nbits for k in range(4)]
+    pos += [pos[-1] + 4*ndays, pos[-1] + 8*ndays]
+    if magic != _TABLE_MAGIC or len(data) != pos[-1] + nstr or nstr and data[-1:] != b'\0':
+        raise ValueError("invalid holiday table file '%s'" % path)
+    off, multi, reminder = [bytearray(data[pos[k]:pos[k+1]]) for k in range(3)]
+    header, footer = array('i', data[pos[3]:pos[4]]), array('i', data[pos[4]:pos[5]])
+    strings = data[pos[5]:-1].decode('utf-8').split('\0') if nstr else []
+    return HolidayTable(o1, ndays, off, multi, reminder, header, footer, strings)
+
+def row_dict(row):
+    """convert a row returned by L{HolidayTable.lookup} to a dict with keys L{CSV_FIELDS}
+
+    @rtype: dict
+    """
+    dt, flags, header, footer = row
+    return { 'date': dt.isoformat(), 'off': bool(flags & Holiday.OFF), 'multi': bool(flags & Holiday.MULTI),
+             'reminder': bool(flags & Holiday.REMINDER), 'header': header, 'footer': footer }
+
+def write_json(rows, f, flush = False):
+    """write I{rows} to file object I{f} as JSON lines, one object per row
+
+    @param flush: flush I{f} after each row
+    """
+    for row in rows:
+        f.write(json.dumps(row_dict(row), ensure_ascii=False) + '\n')
+        if flush: f.flush()
+
+def write_csv(rows, f, flush = False):
+    """write I{rows} to file object I{f} as CSV, with a header line
+
+    @param flush: flush I{f} after each row
+    """
+    w = csv.DictWriter(f, CSV_FIELDS, lineterminator='\n')
+    w.writeheader()
+    for row in rows:
+        w.writerow(row_dict(row))
+        if flush: f.flush()
+
+def _parse_date(s):
+    """parse an ISO date (YYYY-MM-DD)
+
+    @rtype: datetime.date
+    """
+    y, m, d = s.strip().split('-')
+    return date(int(y), int(m), int(d))
+
+def get_parser():
+    """get the argument parser object
+
+    @rtype: optparse.OptionParser
+    """
+    import optparse
+    parser = optparse.OptionParser(usage="usage: %prog [options] [holiday_file ...]",
+        description="Query holidays of a date range or a batch of dates, using a table compiled from holiday "
+        "files (or read from a table file), and print them as JSON lines or CSV.")
+    parser.add_option("-y", "--years", default=None, metavar="Y1[:Y2]",
+                    help="compile the table for years Y1 up to Y2 [current year]")
+    parser.add_option("-t", "--table", metavar="FILE",
+                    help="read a compiled table from FILE instead of holiday files")
+    parser.add_option("-o", "--write-table", metavar="FILE",
+                    help="write the compiled table to FILE")
+    parser.add_option("--from", dest="date1", metavar="DATE",
+                    help="first date (YYYY-MM-DD) of the range to query [first date of the table]")
+    parser.add_option("--to", dest="date2", metavar="DATE",
+                    help="last date (YYYY-MM-DD) of the range to query [last date of the table]")
+    parser.add_option("-d", "--dates", metavar="FILE",
+                    help="query the dates (YYYY-MM-DD) read from FILE, one per line, instead of a range; "
+                    "use '-' for standard input; output is written as each date is read")
+    parser.add_option("-f", "--format", default="json", choices=("json", "csv"),
+                    help="output format, one of json, csv [%default]")
+    parser.add_option("--holidays-only", action="store_true", default=False,
+                    help="omit days without holidays from range queries")
+    return parser
+
+def main_program():
+    parser = get_parser()
+    (options, args) = parser.parse_args()
+    try:
+        if options.table:
+            table = read_table(options.table)
+        else:
+            if not args:
+                parser.error("no holiday files or table given")
+            y1 = y2 = date.today().year
+            if options.years:
+                y1, _, y2 = options.years.partition(':')
+                y1 = int(y1); y2 = int(y2) if y2 else y1
+            hp = HolidayProvider('n', 'w', 'h', 'wh', 'm', 'wm')
+            for f in args:
+                hp.load_holiday_file(f)
+            table = build_table(hp, y1, y2)
+        if options.write_table:
+            table.write(options.write_table)
+        if options.dates:
+            fin = sys.stdin if options.dates == '-' else open(options.dates)
+            rows = table.query_dates(_parse_date(line) for line in fin if line.strip())
+        else:
+            d1 = _parse_date(options.date1) if options.date1 else table.first_date()
+            d2 = _parse_date(options.date2) if options.date2 else table.last_date()
+            rows = table.query_range(d1, d2, options.holidays_only)
+        write = write_csv if options.format == 'csv' else write_json
+        write(rows, sys.stdout, flush = bool(options.dates))
+    except (IOError, OSError, ValueError) as e:
+        sys.exit("holidaytable: %s" % e)
+
+if __name__ == '__main__':
+    main_program()
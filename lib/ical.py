@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+#    callirhoe - high quality calendar rendering
+#    Copyright (C) 2012-2020 George M. Tzoumas
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see http://www.gnu.org/licenses/
+
+# *****************************************
+#                                         #
+"""   iCalendar (.ics) event reading      """
+#                                         #
+# *****************************************
+
+import calendar
+from datetime import date, timedelta
+
+_WEEKDAYS = { 'MO': 0, 'TU': 1, 'WE': 2, 'TH': 3, 'FR': 4, 'SA': 5, 'SU': 6 }
+
+_SUPPORTED_PARTS = set(['FREQ', 'INTERVAL', 'COUNT', 'UNTIL', 'BYMONTH', 'BYMONTHDAY', 'BYDAY', 'WKST'])
+
+def _unfold(f):
+    """join folded content lines of file object I{f}
+
+    @rtype: iterator of str
+    """
+    prev = None
+    for line in f:
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t'):
+            if prev is not None: prev += line[1:]
+            continue
+        if prev is not None: yield prev
+        prev = line
+    if prev is not None: yield prev
+
+def _parse_line(line):
+    """split a content line into (name, params, value)
+
+    @rtype: (str,dict,str)
+    """
+    i = line.find(':')
+    if i < 0: raise ValueError("invalid iCalendar line '%s'" % line)
+    head, value = line[:i], line[i+1:]
+    fields = head.split(';')
+    params = dict()
+    for p in fields[1:]:
+        k, _, v = p.partition('=')
+        params[k.upper()] = v.strip('"')
+    return (fields[0].upper(), params, value)
+
+def unescape(text):
+    """decode an iCalendar TEXT value
+
+    @rtype: str
+    """
+    return text.replace('\\n', ' ').replace('\\N', ' ').replace('\\,', ',').replace('\\;', ';').replace('\\\\', '\\')
+
+def read_events(f):
+    """read VEVENT components from file object I{f}, one at a time
+
+    Properties of nested components (e.g. VALARM) are ignored.
+
+    @rtype: iterator of dict
+    @return: for each event, a dict of property lists of (params,value) tuples, indexed by name
+    """
+    event = None
+    depth = 0
+    for line in _unfold(f):
+        if not line: continue
+        name, params, value = _parse_line(line)
+        if name == 'BEGIN':
+            if event is not None:
+                depth += 1
+            elif value.upper() == 'VEVENT':
+                event = dict()
+                depth = 0
+        elif name == 'END':
+            if event is not None:
+                if depth > 0:
+                    depth -= 1
+                elif value.upper() == 'VEVENT':
+                    yield event
+                    event = None
+        elif event is not None and depth == 0:
+            event.setdefault(name, []).append((params, value))
+
+def parse_date(value):
+    """parse a DATE or DATE-TIME value
+
+    @rtype: (datetime.date,bool)
+    @return: tuple (date, midnight), where I{midnight} is C{True} for DATE values and
+    DATE-TIME values at 00:00:00
+    """
+    d = date(int(value[:4]), int(value[4:6]), int(value[6:8]))
+    return (d, len(value) < 15 or value[9:15] == '000000')
+
+def resolve_until(rule, dtstart):
+    """return RRULE value I{rule} with a DATE-TIME UNTIL replaced by the DATE of the last day
+    an occurrence may fall on, given DTSTART value I{dtstart}
+
+    UNTIL is inclusive: occurrences start at the time of day of I{dtstart} (00:00:00 for DATE
+    values), so the day of UNTIL is excluded when that time is later than the time of UNTIL.
+    Time zones are not taken into account.
+
+    @rtype: str
+    """
+    parts = rule.split(';')
+    for i, p in enumerate(parts):
+        name, _, value = p.partition('=')
+        if name.upper() == 'UNTIL' and len(value) >= 15:
+            u = parse_date(value)[0]
+            if dtstart[9:15] > value[9:15]:
+                u = date.fromordinal(max(1, u.toordinal() - 1))
+            parts[i] = 'UNTIL=%04d%02d%02d' % (u.year, u.month, u.day)
+    return ';'.join(parts)
+
+class RecurrenceRule(object):
+    """recurrence rule (RRULE) of an event, expanded lazily one year at a time
+
+    Supported rule parts are FREQ (DAILY, WEEKLY, MONTHLY, YEARLY), INTERVAL, COUNT, UNTIL,
+    BYMONTH, BYMONTHDAY, BYDAY (with optional ordinal for MONTHLY and YEARLY) and WKST.
+
+    Rules with COUNT are expanded one year at a time as well: the occurrences of the years
+    before a requested one are counted (not kept) once, as far as needed.
+
+    @ivar dtstart: date of the first occurrence
+    @ivar exdates: set of excluded dates
+    @ivar count: number of occurrences (from COUNT), C{None} if not limited
+    @ivar last: last possible date (from UNTIL, see L{resolve_until}), C{None} if unbounded
+    """
+    def __init__(self, rule, dtstart, exdates = ()):
+        """parse RRULE value I{rule}
+
+        @raise ValueError: if the rule is invalid or uses unsupported parts
+        """
+        parts = dict(p.split('=', 1) for p in rule.upper().split(';') if p)
+        unsupported = set(parts) - _SUPPORTED_PARTS
+        if unsupported:
+            raise ValueError("unsupported RRULE part(s) %s" % ','.join(sorted(unsupported)))
+        self.freq = parts.get('FREQ')
+        if self.freq not in ('DAILY', 'WEEKLY', 'MONTHLY', 'YEARLY'):
+            raise ValueError("unsupported RRULE frequency '%s'" % self.freq)
+        self.interval = int(parts.get('INTERVAL', 1))
+        self.count = int(parts['COUNT']) if 'COUNT' in parts else None
+        self.bymonth = [int(z) for z in parts['BYMONTH'].split(',')] if 'BYMONTH' in parts else None
+        self.bymonthday = [int(z) for z in parts['BYMONTHDAY'].split(',')] if 'BYMONTHDAY' in parts else None
+        self.byday = [(int(z[:-2]) if z[:-2] else 0, _WEEKDAYS[z[-2:]])
+                      for z in parts['BYDAY'].split(',')] if 'BYDAY' in parts else None
+        self.wkst = _WEEKDAYS[parts.get('WKST', 'MO')]
+        self.dtstart = dtstart
+        self.exdates = set(exdates)
+        self.last = parse_date(parts['UNTIL'])[0] if 'UNTIL' in parts else None
+        self._counts = [0] # occurrences before each year, from the year of dtstart on
+
+    @staticmethod
+    def _nth(matches, nth):
+        """return the days of sorted list I{matches} selected by BYDAY ordinal I{nth} (0 for all)"""
+        if nth == 0: return matches
+        if -len(matches) <= nth <= len(matches): return [matches[nth - 1 if nth > 0 else nth]]
+        return []
+
+    def _month_days(self, y, m):
+        """return the days of month I{m} selected by BYMONTHDAY/BYDAY, or the start day
+
+        @rtype: [datetime.date,...]
+        """
+        n = calendar.monthrange(y, m)[1]
+        days = set()
+        if self.bymonthday:
+            for d in self.bymonthday:
+                d = d if d > 0 else n + 1 + d
+                if 1 <= d <= n: days.add(d)
+        elif self.byday:
+            first = date(y, m, 1).weekday()
+            for nth, wd in self.byday:
+                days.update(self._nth(list(range(1 + (wd - first) % 7, n + 1, 7)), nth))
+        elif self.dtstart.day <= n:
+            days.add(self.dtstart.day)
+        return [date(y, m, d) for d in sorted(days)]
+
+    def _candidates(self, y):
+        """return all occurrences in year I{y}, ignoring COUNT and EXDATE
+
+        @rtype: [datetime.date,...]
+        """
+        s = self.dtstart
+        if y < s.year: return []
+        if self.freq == 'YEARLY':
+            if (y - s.year) % self.interval: return []
+            if self.byday and not self.bymonth and not self.bymonthday:
+                # weekdays within the year, ordinals count within the year
+                jan1 = date(y, 1, 1)
+                ndays = 366 if calendar.isleap(y) else 365
+                days = set()
+                for nth, wd in self.byday:
+                    days.update(self._nth(list(range((wd - jan1.weekday()) % 7, ndays, 7)), nth))
+                result = [jan1 + timedelta(k) for k in sorted(days)]
+            elif self.bymonth:
+                result = [d for m in self.bymonth for d in self._month_days(y, m)]
+            elif self.bymonthday:
+                # BYMONTHDAY alone expands over all months of the year
+                result = [d for m in range(1, 13) for d in self._month_days(y, m)]
+            else:
+                result = self._month_days(y, s.month)
+        elif self.freq == 'MONTHLY':
+            result = [d for m in range(1, 13) if ((y - s.year)*12 + m - s.month) % self.interval == 0
+                      and (not self.bymonth or m in self.bymonth) for d in self._month_days(y, m)]
+        else:
+            d1 = max(s, date(y, 1, 1))
+            d2 = date(y, 12, 31)
+            if self.freq == 'DAILY':
+                step = self.interval
+                start = s + timedelta(((d1 - s).days + step - 1)//step*step)
+                result = [start + timedelta(k) for k in range(0, (d2 - start).days + 1, step)]
+                if self.byday: result = [d for d in result if d.weekday() in [wd for nth, wd in self.byday]]
+                if self.bymonthday:
+                    result = [d for d in result if d.day in self.bymonthday or
+                              d.day - calendar.monthrange(d.year, d.month)[1] - 1 in self.bymonthday]
+            else: # WEEKLY
+                # in day ordinals, since weeks may extend beyond date.min and date.max
+                wdays = [wd for nth, wd in self.byday] if self.byday else [s.weekday()]
+                week0 = s.toordinal() - (s.weekday() - self.wkst) % 7
+                o1, o2 = date(y, 1, 1).toordinal(), d2.toordinal()
+                result = []
+                o = d1.toordinal() - (d1.weekday() - self.wkst) % 7
+                while o <= o2:
+                    if ((o - week0)//7) % self.interval == 0:
+                        result.extend(o + (wd - self.wkst) % 7 for wd in wdays)
+                    o += 7
+                result = [date.fromordinal(z) for z in sorted(result) if o1 <= z <= o2]
+            if self.bymonth: result = [d for d in result if d.month in self.bymonth]
+        return [d for d in result if d >= s and (self.last is None or d <= self.last)]
+
+    def _count_before(self, y):
+        """return the number of occurrences before year I{y}, ignoring EXDATE, for COUNT rules
+
+        Years are counted from the year of L{dtstart} on, once, and no further than needed.
+
+        @rtype: int
+        """
+        y0 = self.dtstart.year
+        if y <= y0: return 0
+        counts = self._counts
+        while y - y0 >= len(counts) and counts[-1] < self.count:
+            counts.append(counts[-1] + len(self._candidates(y0 + len(counts) - 1)))
+        return counts[min(y - y0, len(counts) - 1)]
+
+    def occurrences(self, y):
+        """return the dates of all occurrences in year I{y}
+
+        @rtype: [datetime.date,...]
+        """
+        result = self._candidates(y)
+        if self.count is not None:
+            result = result[:max(0, self.count - self._count_before(y))]
+        return [d for d in result if d not in self.exdates]
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+#    callirhoe - high quality calendar rendering
+#    Copyright (C) 2012-2020 George M. Tzoumas
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see http://www.gnu.org/licenses/
+
+# *****************************************
+#                                         #
+"""  indexed-colour (palette) PNG output """
+#                                         #
+# *****************************************
+
+import struct
+import zlib
+from array import array
+from collections import Counter
+
+def _pixel_array(data, width, height, stride):
+    """return a flat array of 32-bit native-endian pixels, dropping any row padding
+
+    @rtype: array.array
+    """
+    px = array('I')
+    if px.itemsize != 4: px = array('L')
+    raw = bytes(data)
+    if stride == 4*width:
+        px.frombytes(raw[:stride*height])
+    else:
+        for y in range(height):
+            px.frombytes(raw[y*stride:y*stride + 4*width])
+    return px
+
+def _decode_pixel(v, alpha = True):
+    """decode a cairo (premultiplied ARGB32 or RGB24) pixel value into straight (r,g,b,a)
+
+    @rtype: (int,int,int,int)
+    """
+    a = (v >> 24) & 255 if alpha else 255
+    if a == 0: return (0,0,0,0)
+    r, g, b = (v >> 16) & 255, (v >> 8) & 255, v & 255
+    if a == 255: return (r,g,b,a)
+    return (min(255, (r*255 + a//2)//a), min(255, (g*255 + a//2)//a), min(255, (b*255 + a//2)//a), a)
+
+def _median_cut(colors, max_colors):
+    """partition a weighted colour list into at most I{max_colors} boxes by median cut
+
+    @param colors: list of ((r,g,b,a),count) tuples
+    @rtype: [[((r,g,b,a),count),...],...]
+    """
+    def _score(box):
+        # (weighted extent of widest channel, channel, box)
+        if len(box) < 2: return (0, 0, box)
+        weight = sum(c for _, c in box)
+        ext = [max(col[ch] for col, _ in box) - min(col[ch] for col, _ in box) for ch in range(4)]
+        ch = ext.index(max(ext))
+        return (ext[ch]*weight, ch, box)
+
+    boxes = [_score(colors)]
+    while len(boxes) < max_colors:
+        best = max(range(len(boxes)), key = lambda i: boxes[i][0])
+        score, ch, box = boxes[best]
+        if score == 0: break
+        box = sorted(box, key = lambda z: z[0][ch])
+        half = sum(c for _, c in box)/2.0
+        acc, k = 0, 0
+        while k < len(box) - 1:
+            acc += box[k][1]
+            k += 1
+            if acc >= half: break
+        boxes[best:best+1] = [_score(box[:k]), _score(box[k:])]
+    return [box for _, _, box in boxes]
+
+def quantize(px, max_colors = 256, max_error = 3.0, alpha = True):
+    """compute a palette for pixel array I{px}
+
+    The palette is exact if the image contains at most I{max_colors} distinct colours,
+    otherwise colours are reduced by median cut.
+
+    @param px: array of cairo pixel values
+    @param max_colors: maximum palette size (2-256)
+    @param max_error: maximum RMS error (in 0-255 units per channel) allowed for the
+    reduced palette
+    @param alpha: C{True} for ARGB32, C{False} for RGB24 pixels
+    @rtype: ([(int,int,int,int),...],dict)
+    @return: tuple (palette,lut), where I{lut} maps pixel values to palette indices,
+    or C{None} if the palette cannot represent the image within I{max_error}
+    """
+    hist = Counter(px)
+    merged = Counter()
+    for v, count in hist.items():
+        merged[_decode_pixel(v, alpha)] += count
+    if len(merged) <= max_colors:
+        boxes = [[z] for z in merged.items()]
+    else:
+        boxes = _median_cut(list(merged.items()), max_colors)
+    palette = []
+    cmap = dict()
+    sqerr, total = 0.0, 0
+    for box in boxes:
+        weight = sum(c for _, c in box)
+        mean = tuple(int(sum(col[ch]*c for col, c in box)/float(weight) + 0.5) for ch in range(4))
+        for col, c in box:
+            cmap[col] = len(palette)
+            sqerr += c*sum((col[ch] - mean[ch])**2 for ch in range(4))
+        total += weight
+        palette.append(mean)
+    if total and (sqerr/(4.0*total))**0.5 > max_error:
+        return None
+    # translucent entries go first, so that the tRNS chunk stays short
+    order = sorted(range(len(palette)), key = lambda i: palette[i][3] == 255)
+    remap = dict((old, new) for new, old in enumerate(order))
+    palette = [palette[i] for i in order]
+    lut = dict((v, remap[cmap[_decode_pixel(v, alpha)]]) for v in hist)
+    return (palette, lut)
+
+def _chunk(tag, data):
+    """return a PNG chunk
+
+    @rtype: bytes
+    """
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+def write_png(filename, width, height, palette, indices):
+    """write an 8-bit palette PNG file
+
+    @param palette: list of (r,g,b,a) tuples
+    @param indices: palette index per pixel, row-major
+    """
+    raw = bytearray()
+    for y in range(height):
+        raw.append(0) # filter: none
+        raw += indices[y*width:(y+1)*width]
+    with open(filename, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0)))
+        f.write(_chunk(b'PLTE', b''.join(struct.pack('BBB', *c[:3]) for c in palette)))
+        trns = bytes(c[3] for c in palette if c[3] < 255)
+        if trns: f.write(_chunk(b'tRNS', trns))
+        f.write(_chunk(b'IDAT', zlib.compress(bytes(raw), 9)))
+        f.write(_chunk(b'IEND', b''))
+
+def write_surface(surface, filename, max_colors = 256, max_error = 3.0, alpha = True):
+    """write a cairo image surface as an indexed-colour PNG file
+
+    @param surface: cairo.ImageSurface in ARGB32 or RGB24 format
+    @param alpha: C{True} if I{surface} is ARGB32
+    @rtype: bool
+    @return: C{False} if quantisation exceeds I{max_error} and nothing was written
+    """
+    surface.flush()
+    width, height = surface.get_width(), surface.get_height()
+    px = _pixel_array(surface.get_data(), width, height, surface.get_stride())
+    q = quantize(px, max_colors, max_error, alpha)
+    if q is None: return False
+    palette, lut = q
+    write_png(filename, width, height, palette, bytes(map(lut.__getitem__, px)))
+    return True
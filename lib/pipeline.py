@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+#    callirhoe - high quality calendar rendering
+#    Copyright (C) 2012-2020 George M. Tzoumas
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see http://www.gnu.org/licenses/
+
+# *****************************************
+#                                         #
+"""   staged pipeline with bounded queues """
+#                                         #
+# *****************************************
+
+import sys
+import time
+import queue
+import threading
+
+_END = object()
+"""queue item telling a stage worker to exit"""
+
+class Stage(object):
+    """pipeline stage
+
+    @ivar name: stage name, used in messages and in the report
+    @ivar func: function called for each item; its return value is passed to the next
+    stage, unless it is C{None}, in which case the item is dropped
+    @ivar workers: number of worker threads
+    @ivar maxsize: capacity of the input queue of the stage (0 for unbounded)
+    @ivar items: number of items processed so far
+    @ivar busy: total time (in seconds) spent in L{func} by all workers
+    """
+    def __init__(self, name, func, workers = 1, maxsize = 0):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.maxsize = maxsize
+        self.items = 0
+        self.busy = 0.0
+
+class Pipeline(object):
+    """items flow through a list of stages, each one with its own worker threads and a bounded
+    input queue, so that a slow stage blocks the stages feeding it (back-pressure)
+
+    When a stage raises an exception, the error is reported and the pipeline stops:
+    all remaining items are discarded, without being processed.
+
+    @ivar stages: list of L{Stage} objects
+    @ivar discard: function called for each item dropped because of an error (e.g. to
+    remove temporary files), or C{None}
+    @ivar failed: C{threading.Event} set when a stage has failed
+    @ivar elapsed: wall time (in seconds) of the last L{run}
+    """
+    def __init__(self, stages, discard = None):
+        self.stages = stages
+        self.discard = discard
+        self.failed = threading.Event()
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def _drop(self, item):
+        if self.discard is not None:
+            try:
+                self.discard(item)
+            except Exception:
+                pass
+
+    def _worker(self, k, qin, qout):
+        stage = self.stages[k]
+        while True:
+            item = qin.get()
+            if item is _END: break
+            if self.failed.is_set():
+                self._drop(item)
+                continue
+            t = time.perf_counter()
+            try:
+                result = stage.func(item)
+            except Exception as e:
+                print("Exception in stage '%s': %s" % (stage.name, e.args), file=sys.stderr)
+                self.failed.set()
+                self._drop(item)
+                continue
+            finally:
+                with self._lock:
+                    stage.busy += time.perf_counter() - t
+                    stage.items += 1
+            if result is not None and qout is not None:
+                qout.put(result)
+
+    def run(self, items):
+        """feed I{items} into the pipeline and wait until all of them have gone through
+
+        @rtype: bool
+        @return: C{False} if a stage failed
+        """
+        t0 = time.perf_counter()
+        queues = [queue.Queue(s.maxsize) for s in self.stages] + [None]
+        threads = []
+        for k, s in enumerate(self.stages):
+            threads.append([threading.Thread(target=self._worker, args=(k, queues[k], queues[k+1]))
+                            for i in range(s.workers)])
+            for t in threads[-1]:
+                t.daemon = True
+                t.start()
+        for item in items:
+            if self.failed.is_set():
+                self._drop(item)
+            else:
+                queues[0].put(item)
+        # stop stages in order, once all items have left the previous one
+        for k, s in enumerate(self.stages):
+            for i in range(s.workers): queues[k].put(_END)
+            for t in threads[k]: t.join()
+        self.elapsed = time.perf_counter() - t0
+        return not self.failed.is_set()
+
+    def report(self, f = None):
+        """print the number of items, busy time and utilisation (busy time over worker time)
+        of each stage to file object I{f} (default standard output)"""
+        if f is None: f = sys.stdout
+        wall = max(self.elapsed, 1e-9)
+        print("%-12s %7s %7s %9s %6s" % ('stage', 'workers', 'items', 'busy (s)', 'util'), file=f)
+        for s in self.stages:
+            print("%-12s %7d %7d %9.2f %5.0f%%" % (s.name, s.workers, s.items, s.busy,
+                                                   100.0*s.busy/(s.workers*wall)), file=f)
+        print("%-12s %25s %9.2f" % ('total', '', self.elapsed), file=f)
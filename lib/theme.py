@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+#    callirhoe - high quality calendar rendering
+#    Copyright (C) 2012-2020 George M. Tzoumas
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see http://www.gnu.org/licenses/
+
+# *****************************************
+#                                         #
+"""  compiled (flattened) theme records  """
+#                                         #
+# *****************************************
+
+import types
+
+MM_FIELDS = ('frame_thickness',)
+"""fields given in mm, for which a pre-converted I{field}C{_dots} companion is added"""
+
+class Record(object):
+    """immutable record holding the resolved attributes of a plugin module or class
+
+    Records are created by L{compile_module}; every attribute lives in a slot of a
+    record type specific to the set of field names, so that attribute access needs
+    no MRO walk. Records are picklable, hashable and compare by value, thus they
+    can be used as cache keys.
+    """
+    __slots__ = ('_dpi',)
+    _fields = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError("theme records are immutable, use _replace()")
+
+    def __delattr__(self, name):
+        raise AttributeError("theme records are immutable")
+
+    def _values(self):
+        """return field values in L{_fields} order
+
+        @rtype: tuple
+        """
+        return tuple(getattr(self, f) for f in self._fields)
+
+    def _asdict(self):
+        """return a dict of the original (non-derived) fields
+
+        @rtype: dict
+        """
+        return dict((f, getattr(self, f)) for f in self._fields
+                    if not (f.endswith('_dots') and f[:-5] in MM_FIELDS))
+
+    def _replace(self, **kwargs):
+        """return a copy of this record with some fields replaced (derived fields are updated)
+
+        @rtype: L{Record}
+        """
+        d = self._asdict()
+        d.update(kwargs)
+        return make_record(d, self._dpi)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._values() == other._values()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self._fields, self._values()))
+
+    def __reduce__(self):
+        return (make_record, (self._asdict(), self._dpi))
+
+    def __repr__(self):
+        return "Record(%s)" % ', '.join("%s=%r" % (f, getattr(self, f)) for f in self._fields)
+
+_record_types = dict()
+"""record types created so far, indexed by field name tuple"""
+
+def _record_type(fields):
+    """return the record type with slots I{fields}
+
+    @rtype: type
+    """
+    t = _record_types.get(fields)
+    if t is None:
+        t = type('Record', (Record,), { '__slots__': fields, '_fields': fields })
+        _record_types[fields] = t
+    return t
+
+def make_record(values, dpi):
+    """create a record from dict I{values}, adding C{_dots} companions of L{MM_FIELDS}
+
+    @param dpi: output dots per inch, used for the unit conversions
+    @rtype: L{Record}
+    """
+    values = dict(values)
+    for f in MM_FIELDS:
+        if f in values and isinstance(values[f], (int, float)):
+            values[f + '_dots'] = values[f]*dpi/25.4
+    fields = tuple(sorted(values))
+    rec = object.__new__(_record_type(fields))
+    object.__setattr__(rec, '_dpi', dpi)
+    for f in fields:
+        object.__setattr__(rec, f, values[f])
+    return rec
+
+def _freeze(value, dpi):
+    """return an immutable equivalent of I{value}"""
+    if isinstance(value, type):
+        return compile_module(value, dpi)
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v, dpi) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v, dpi)) for k, v in value.items()))
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
+
+def compile_module(obj, dpi):
+    """resolve all public attributes of a plugin module or class (including inherited ones)
+
+    Nested classes are compiled recursively; modules, functions and attributes starting
+    with an underscore are skipped.
+
+    @param obj: module or class
+    @param dpi: output dots per inch, used for the unit conversions
+    @rtype: L{Record}
+    """
+    values = dict()
+    for name in dir(obj):
+        if name.startswith('_'): continue
+        value = getattr(obj, name)
+        if isinstance(value, (types.ModuleType, types.FunctionType, types.BuiltinFunctionType,
+                              types.MethodType, staticmethod, classmethod)):
+            continue
+        values[name] = _freeze(value, dpi)
+    return make_record(values, dpi)
+
+def compile_theme(Style, Geometry, Language, dpi):
+    """compile the I{(Style,Geometry,Language)} plugin modules into a tuple of records
+
+    Call it after all module overrides (e.g. C{--style-var}) have been applied.
+
+    @param dpi: output dots per inch, used for the unit conversions
+    @rtype: (L{Record},L{Record},L{Record})
+    """
+    return (compile_module(Style, dpi), compile_module(Geometry, dpi), compile_module(Language, dpi))
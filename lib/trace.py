@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+#    callirhoe - high quality calendar rendering
+#    Copyright (C) 2012-2020 George M. Tzoumas
+
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see http://www.gnu.org/licenses/
+
+# *****************************************
+#                                         #
+"""   draw-call tracing and overdraw     """
+#                                         #
+# *****************************************
+
+import sys
+
+COUNTERS = ('paths', 'fills', 'strokes', 'texts', 'saves', 'restores')
+"""names of the drawing operation counters, in report order"""
+
+class DrawStats(object):
+    """drawing operation counters for a month or a page
+
+    @ivar label: label used in the report
+    @ivar counts: dict of counters, indexed by name (see L{COUNTERS})
+    @ivar painted: total painted area in device units (sum of bounding boxes)
+    """
+    def __init__(self, label):
+        self.label = label
+        self.counts = dict((k, 0) for k in COUNTERS)
+        self.painted = 0.0
+
+    def add(self, other):
+        """accumulate the counters of I{other} into this object"""
+        for k in COUNTERS:
+            self.counts[k] += other.counts[k]
+        self.painted += other.painted
+
+class CoverageGrid(object):
+    """coarse coverage map of a page, used to estimate overdraw
+
+    @ivar size: page size in device units
+    @ivar cols: grid columns
+    @ivar rows: grid rows
+    @ivar cells: 2-dimensional list of paint counts
+    """
+    def __init__(self, size, resolution = 256):
+        self.size = size
+        k = float(resolution)/max(size[0], size[1], 1)
+        self.cols = max(1, int(size[0]*k + 0.5))
+        self.rows = max(1, int(size[1]*k + 0.5))
+        self.cells = [[0]*self.cols for y in range(self.rows)]
+
+    def add(self, box):
+        """mark device-space box (x1,y1,x2,y2) as painted once"""
+        x1, y1, x2, y2 = box
+        fx, fy = float(self.cols)/self.size[0], float(self.rows)/self.size[1]
+        c1, c2 = max(0, int(x1*fx)), min(self.cols, int(x2*fx + 0.999))
+        r1, r2 = max(0, int(y1*fy)), min(self.rows, int(y2*fy + 0.999))
+        for row in self.cells[r1:r2]:
+            for c in range(c1, c2):
+                row[c] += 1
+
+    def overdraw(self):
+        """return the estimated area (in device units) painted more than once
+
+        @rtype: float
+        """
+        cell = float(self.size[0]*self.size[1])/(self.cols*self.rows)
+        return cell*sum(max(0, c - 1) for row in self.cells for c in row)
+
+class TraceContext(object):
+    """cairo context proxy that forwards every call and records drawing operations
+
+    @ivar tracer: owner L{DrawTracer}
+    """
+    def __init__(self, cr, tracer):
+        self._cr = cr
+        self.tracer = tracer
+
+    def __getattr__(self, name):
+        return getattr(self._cr, name)
+
+    def _device_box(self, ext):
+        """convert user-space extents (x1,y1,x2,y2) into a device-space box"""
+        x1, y1, x2, y2 = ext
+        pts = [self._cr.user_to_device(x, y) for x in (x1, x2) for y in (y1, y2)]
+        return (min(p[0] for p in pts), min(p[1] for p in pts),
+                max(p[0] for p in pts), max(p[1] for p in pts))
+
+    def _paint(self, op, ext, consume):
+        if consume: self.tracer.count('paths')
+        self.tracer.count(op)
+        self.tracer.cover(self._device_box(ext))
+
+    def fill(self):
+        self._paint('fills', self._cr.fill_extents(), True)
+        self._cr.fill()
+
+    def fill_preserve(self):
+        self._paint('fills', self._cr.fill_extents(), False)
+        self._cr.fill_preserve()
+
+    def stroke(self):
+        self._paint('strokes', self._cr.stroke_extents(), True)
+        self._cr.stroke()
+
+    def stroke_preserve(self):
+        self._paint('strokes', self._cr.stroke_extents(), False)
+        self._cr.stroke_preserve()
+
+    def show_text(self, text):
+        x, y = self._cr.get_current_point()
+        te = self._cr.text_extents(text)
+        self.tracer.count('texts')
+        self.tracer.cover(self._device_box((x + te[0], y + te[1], x + te[0] + te[2], y + te[1] + te[3])))
+        self._cr.show_text(text)
+
+    def save(self):
+        self.tracer.count('saves')
+        self._cr.save()
+
+    def restore(self):
+        self.tracer.count('restores')
+        self._cr.restore()
+
+class DrawTracer(object):
+    """collect drawing statistics per month and per page
+
+    @ivar months: list of L{DrawStats} objects, one per month drawn
+    @ivar pages: list of (L{DrawStats}, L{CoverageGrid}) tuples, one per page
+    """
+    def __init__(self):
+        self.months = []
+        self.pages = []
+        self._month = None
+
+    def begin_page(self, cr, size):
+        """start tracing a new page
+
+        @param cr: cairo context of the page
+        @param size: page size (width,height) in device units
+        @rtype: L{TraceContext}
+        """
+        self.pages.append((DrawStats("page %d" % (len(self.pages) + 1)), CoverageGrid(size)))
+        return TraceContext(cr, self)
+
+    def begin_month(self, month, year):
+        """attribute subsequent operations to month I{month} of I{year}"""
+        self._month = DrawStats("%04d-%02d" % (year, month))
+        self.months.append(self._month)
+
+    def end_month(self):
+        """stop attributing operations to the current month"""
+        self._month = None
+
+    def count(self, name):
+        """increase counter I{name} of the current page and month"""
+        self.pages[-1][0].counts[name] += 1
+        if self._month: self._month.counts[name] += 1
+
+    def cover(self, box):
+        """record a painted device-space box (x1,y1,x2,y2)"""
+        area = max(0.0, box[2] - box[0])*max(0.0, box[3] - box[1])
+        self.pages[-1][0].painted += area
+        self.pages[-1][1].add(box)
+        if self._month: self._month.painted += area
+
+    def report(self, f = None):
+        """print a report with per-month and per-page statistics to file I{f} (standard output by default)"""
+        if f is None: f = sys.stdout
+        fmt = "%-10s" + " %8s"*len(COUNTERS) + " %12s"
+        print(fmt % (("",) + COUNTERS + ("painted",)), file=f)
+        total = DrawStats("total")
+        for st in self.months:
+            print(fmt % ((st.label,) + tuple(st.counts[k] for k in COUNTERS) + ("%.0f" % st.painted,)), file=f)
+        for st, grid in self.pages:
+            total.add(st)
+            print(fmt % ((st.label,) + tuple(st.counts[k] for k in COUNTERS) + ("%.0f" % st.painted,)), file=f)
+        print(fmt % ((total.label,) + tuple(total.counts[k] for k in COUNTERS) + ("%.0f" % total.painted,)), file=f)
+        for st, grid in self.pages:
+            area = grid.size[0]*grid.size[1]
+            over = grid.overdraw()
+            print("%s: overdrawn area %.0f (%.1f%% of page), painted/page area ratio %.2f" % (
+                  st.label, over, 100.0*over/area, st.painted/area), file=f)
@@ -27,6 +27,7 @@ import math
 import random
 from os.path import splitext
 from .geom import *
+from . import palette as _palette
 
 XDPI = 72.0
 """dots per inch of output device"""
@@ -126,33 +127,48 @@ class PageWriter(Page):
     @ivar ext: filename extension (with dot)
     @type curpage: int
     @ivar curpage: current page
+    @ivar outfiles: list of files written so far (PDF output is complete after L{finish})
     @ivar format: output format: L{PDF} or L{PNG}
     @type keep_transparency: bool
     @ivar keep_transparency: C{True} to use transparent instead of white fill color
     @ivar img_format: C{cairo.FORMAT_ARGB32} or C{cairo.FORMAT_RGB24} depending on
     L{keep_transparency}
+    @type palette: int
+    @ivar palette: maximum palette size for indexed-colour PNG output, 0 for 32-bit PNG
+    @type palette_error: float
+    @ivar palette_error: maximum RMS quantisation error; if exceeded, a 32-bit PNG is written instead
+    @ivar creation_date: fixed creation date (ISO 8601) stored in PDF output, so that identical
+    input gives identical files; C{None} for the current time
     @ivar Surface: cairo surface (set by L{_setup_surface_and_context})
     @ivar cr: cairo context (set by L{_setup_surface_and_context})
     """
 
     PDF = 0
     PNG = 1
-    def __init__(self, filename, pagespec = None, keep_transparency = True, landscape = False, b = 0.0):
+    def __init__(self, filename, pagespec = None, keep_transparency = True, landscape = False, b = 0.0,
+                 palette = 0, palette_error = 3.0, creation_date = None):
         """initialize PageWriter object
 
         see also L{Page.__init__}
         @param filename: output filename (extension determines format PDF or PNG)
         @param pagespec: iso page spec, see L{page_spec}
         @param keep_transparency: see L{keep_transparency}
+        @param palette: see L{palette}
+        @param palette_error: see L{palette_error}
+        @param creation_date: see L{creation_date}
         """
         self.base,self.ext = splitext(filename)
         self.filename = filename
         self.curpage = 1
+        self.outfiles = []
         if self.ext.lower() == ".pdf": self.format = PageWriter.PDF
         elif self.ext.lower() == ".png": self.format = PageWriter.PNG
         else:
             raise InvalidFormat(self.ext)
         self.keep_transparency = keep_transparency
+        self.palette = palette
+        self.palette_error = palette_error
+        self.creation_date = creation_date
         if keep_transparency:
             self.img_format = cairo.FORMAT_ARGB32
         else:
@@ -169,6 +185,9 @@ class PageWriter(Page):
         z = int(self.landscape)
         if self.format == PageWriter.PDF:
             self.Surface = cairo.PDFSurface(self.filename, self.Size[z], self.Size[1-z])
+            if self.creation_date and hasattr(self.Surface, 'set_metadata'):
+                self.Surface.set_metadata(cairo.PDFMetadata.CREATE_DATE, self.creation_date)
+                self.Surface.set_metadata(cairo.PDFMetadata.MOD_DATE, self.creation_date)
         else:
             self.Surface = cairo.ImageSurface(self.img_format, int(self.Size[z]), int(self.Size[1-z]))
                 
@@ -189,7 +208,10 @@ class PageWriter(Page):
         """in PNG mode, output a separate file for each page"""
         if self.format == PageWriter.PNG:
             outfile = self.filename if self.curpage < 2 else self.base + "%02d" % (self.curpage) + self.ext 
-            self.Surface.write_to_png(outfile)
+            if not self.palette or not _palette.write_surface(self.Surface, outfile, self.palette,
+                                                             self.palette_error, self.keep_transparency):
+                self.Surface.write_to_png(outfile)
+            self.outfiles.append(outfile)
             
     def new_page(self):
         """setup next page"""
@@ -199,7 +221,36 @@ class PageWriter(Page):
             self.curpage += 1
             self._setup_surface_and_context()
 
+    def finish(self):
+        """finish the output, so that all files are completely written"""
+        self.Surface.finish()
+        if self.format == PageWriter.PDF:
+            self.outfiles.append(self.filename)
+
             
+def cairo_version():
+    """return the versions of pycairo and the cairo library, which affect the output bytes
+
+    @rtype: (str,str)
+    """
+    return (getattr(cairo, 'version', None),
+            cairo.cairo_version_string() if hasattr(cairo, 'cairo_version_string') else None)
+
+def preload_fonts(fonts):
+    """load fonts in advance, so that rendering with them later does not pay the loading cost
+
+    @param fonts: sequence of font names or (font,slant,weight) tuples, as in L{draw_str}
+    """
+    cr = cairo.Context(cairo.ImageSurface(cairo.FORMAT_ARGB32, 8, 8))
+    for font in fonts:
+        slant = weight = 0
+        if type(font) is str: fontname = font
+        elif len(font) == 3: fontname, slant, weight = font
+        elif len(font) == 2: fontname, slant = font
+        elif len(font) == 1: fontname = font[0]
+        cr.select_font_face(fontname, slant, weight)
+        cr.text_extents("0")
+
 def set_color(cr, rgba):
     """set stroke color
 
@@ -315,6 +366,160 @@ def draw_box(cr, rect, stroke_rgba = None, fill_rgba = None, stroke_width = 1.0,
         cr.set_line_width(stroke_width)
     cr.stroke()
 
+def _opaque(rgba):
+    """return C{True} if color I{rgba} is fully opaque"""
+    return len(rgba) == 3 or rgba[3] >= 1.0
+
+class _BoxGroup(object):
+    """boxes of a L{BoxBatch} stroked with the same opaque color and width, drawn together
+
+    @ivar stroke: tuple (stroke color, stroke width)
+    @ivar fills: dict of rect lists, indexed by fill color
+    @ivar filled: rounded (x1,y1,x2,y2) corners of the filled boxes
+    @ivar edges: set of rounded box sides, as (orientation, coordinate, start, end) tuples
+    """
+    def __init__(self, stroke):
+        self.stroke = stroke
+        self.fills = dict()
+        self.filled = []
+        self.edges = set()
+
+    def accepts(self, corners, filled):
+        """return C{True} if a box with rounded corners I{corners} can be added to the group,
+        giving the same result as drawing it after all boxes of the group
+
+        A filled box covers the strokes of earlier boxes lying inside it, apart from the band
+        that its own sides stroke again; a group draws all fills first, so neither such strokes,
+        nor overlapping fills are allowed.
+        """
+        if not filled: return True
+        x1, y1, x2, y2 = corners
+        for u1, v1, u2, v2 in self.filled:
+            if u1 < x2 and u2 > x1 and v1 < y2 and v2 > y1: return False
+        for o, c, a, b in self.edges:
+            if o == 0 and y1 < c < y2 and a < x2 and b > x1: return False
+            if o == 1 and x1 < c < x2 and a < y2 and b > y1: return False
+        return True
+
+    def add(self, rect, corners, fill_rgba):
+        x1, y1, x2, y2 = corners
+        if fill_rgba:
+            self.fills.setdefault(tuple(fill_rgba), []).append(rect)
+            self.filled.append(corners)
+        self.edges.update([(0, y1, x1, x2), (0, y2, x1, x2), (1, x1, y1, y2), (1, x2, y1, y2)])
+
+    def _lines(self):
+        """merge collinear, touching edges into (orientation, coordinate, start, end) lines"""
+        lines = []
+        for e in sorted(self.edges):
+            if lines and lines[-1][0:2] == e[0:2] and e[2] <= lines[-1][3]:
+                if e[3] > lines[-1][3]: lines[-1] = lines[-1][0:3] + (e[3],)
+            else:
+                lines.append(e)
+        return lines
+
+    def draw(self, cr):
+        """draw the group, leaving the source and line width as the last L{draw_box} would"""
+        for color, rects in self.fills.items():
+            for x, y, w, h in rects:
+                cr.rectangle(x, y, w, h)
+            set_color(cr, color)
+            cr.fill()
+        for o, c, a, b in self._lines():
+            if o == 0:
+                cr.move_to(a, c); cr.line_to(b, c)
+            else:
+                cr.move_to(c, a); cr.line_to(c, b)
+        set_color(cr, self.stroke[0])
+        cr.set_line_width(self.stroke[1])
+        # square caps cover box corners, as the miter joins of closed boxes do
+        cap = cr.get_line_cap()
+        cr.set_line_cap(cairo.LINE_CAP_SQUARE)
+        cr.stroke()
+        cr.set_line_cap(cap)
+
+class BoxBatch(object):
+    """accumulate boxes and draw them with as few fill and stroke operations as possible
+
+    Boxes are collected with L{add} (same arguments as L{draw_box}) and drawn by L{flush},
+    giving the same result as drawing them one by one with L{draw_box}. Consecutive boxes
+    with an opaque stroke color, the same stroke width and an opaque fill color (or none) form
+    a group: all fills of the same color become a single path, and box sides are merged into
+    grid lines, stroked as a single path. A box whose fill would overlap the fill or cover the
+    sides of earlier boxes of the group starts a new group, as it happens only when boxes
+    overlap; cells of a grid share a group. Other boxes (translucent, without a stroke color,
+    or lightweight and filled) are drawn one by one, in order.
+
+    @ivar ops: list of L{_BoxGroup} objects and dicts of L{draw_box} arguments, in drawing order
+    """
+    def __init__(self):
+        self.ops = []
+
+    @staticmethod
+    def _key(v):
+        return round(v, 3)
+
+    def add(self, rect, stroke_rgba = None, fill_rgba = None, stroke_width = 1.0, lightweight = False):
+        """add a box to the batch, see L{draw_box}"""
+        if (stroke_width <= 0): return
+        if not stroke_rgba or not _opaque(stroke_rgba) or (fill_rgba and (lightweight or not _opaque(fill_rgba))):
+            self.ops.append(dict(rect = rect, stroke_rgba = stroke_rgba, fill_rgba = fill_rgba,
+                                 stroke_width = stroke_width, lightweight = lightweight))
+            return
+        x, y, w, h = rect
+        k = self._key
+        corners = (k(min(x, x + w)), k(min(y, y + h)), k(max(x, x + w)), k(max(y, y + h)))
+        stroke = (tuple(stroke_rgba), stroke_width)
+        group = self.ops[-1] if self.ops else None
+        if not isinstance(group, _BoxGroup) or group.stroke != stroke or not group.accepts(corners, fill_rgba):
+            group = _BoxGroup(stroke)
+            self.ops.append(group)
+        group.add(rect, corners, fill_rgba)
+
+    def flush(self, cr):
+        """draw all accumulated boxes and empty the batch
+
+        @param cr: cairo context
+        """
+        for op in self.ops:
+            if isinstance(op, _BoxGroup):
+                op.draw(cr)
+            else:
+                draw_box(cr, **op)
+        self.ops = []
+
+class FormCache(object):
+    """cache of static graphics that are drawn once and reused
+
+    Each graphic is recorded into a C{cairo.RecordingSurface} the first time it is
+    requested, and painted from there every other time. In PDF output, cairo emits
+    such a surface once, as a form XObject, and references it from every page.
+
+    @ivar forms: dict of recording surfaces, indexed by (key,width,height)
+    """
+    def __init__(self):
+        self.forms = dict()
+
+    def draw(self, cr, key, rect, func):
+        """draw graphic I{key} at I{rect}, recording it first if needed
+
+        @param cr: cairo context
+        @param key: hashable key identifying the graphic, apart from its size
+        @param rect: target rect (x,y,w,h)
+        @param func: function C{func(cr, rect)} drawing the graphic, called with
+        a recording context and I{rect} moved to the origin
+        """
+        k = (key, round(rect[2], 3), round(rect[3], 3))
+        form = self.forms.get(k)
+        if form is None:
+            form = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA, None)
+            func(cairo.Context(form), rect_from_origin(rect))
+            self.forms[k] = form
+        cr.save()
+        cr.set_source_surface(form, rect[0], rect[1])
+        cr.paint()
+        cr.restore()
+
 def draw_str(cr, text, rect, scaling = -1, stroke_rgba = None, align = (2,0), bbox = False,
              font = "Times", measure = None, shadow = None):
     """draw text